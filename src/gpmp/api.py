@@ -4,23 +4,64 @@ import os
 import random
 import re
 from socket import AddressFamily
+import threading
+import time
 
-import psutil
-import requests
-
-import gmusicapi.clients.mobileclient as mc
-from gmusicapi import Mobileclient
-
+from gpmp.executor import LimitedExecutor
 from gpmp.log import get_logger
-from gpmp.threading import Atomic
+from gpmp.metrics import REGISTRY
+from gpmp.resilience import (FAIL, INVALID, REAUTH, RETRY, CallPolicy, CircuitOpenError,
+                             ResilientCaller)
+from gpmp.simulation import LognormalLatency, Throttle, api_errors, raise_fault
+from gpmp.singleflight import SingleFlight
 
 log = get_logger()
 
-OAUTH_FILE = Mobileclient.OAUTH_FILEPATH
+# Calls to each Mobileclient method allowed in flight at once. Further calls
+# wait for one to finish. Methods not listed are limited to the number of
+# workers. For incremental calls, which return a generator of pages, each
+# page's request is limited as it is fetched.
+DEFAULT_ENDPOINT_LIMITS = {
+   # Large paged downloads, which are only needed once at a time
+   'get_all_songs': 1,
+   'get_all_playlists': 1,
+   'get_all_user_playlist_contents': 1,
+   'get_stream_url': 2,
+}
+
+# How calls are retried, and when they are failed straight away because the
+# endpoint keeps failing. Methods not listed use CallPolicy's defaults.
+ENDPOINT_POLICIES = {
+   # The user is usually waiting on it to start the track
+   'get_stream_url': CallPolicy(base_delay=0.2, max_delay=1.0),
+}
+
+# Read-only methods for which identical calls made at the same time share one
+# request, and how many seconds their results are remembered for after it.
+SHARED_ENDPOINTS = {
+   # Stream urls stay valid for about a minute
+   'get_stream_url': 10.0,
+   'get_all_user_playlist_contents': 5.0,
+   'get_shared_playlist_contents': 5.0,
+}
+
+# Used when latency simulation is switched on without any latencies set
+DEFAULT_SIMULATED_LATENCY = LognormalLatency(0.15, 2.0)
+# Used when slow downloads are switched on without a rate set, in bytes/s
+DEFAULT_SIMULATED_BANDWIDTH = 64 * 1024
 
-_orig_getmac = mc.getmac
+class _Paging(threading.local):
+   # The method whose next page is to be fetched on this thread, if any. It is
+   # cleared by the request for the page, so that the requests made while
+   # retrying it, such as those to log in again, are not taken as pages.
+   endpoint = None
+
+_orig_getmac = None
+
+_HTTP_ERROR_RE = re.compile(r'(\d{3}) (?:Client|Server) Error')
 
 def _get_intf_mac():
+   import psutil # pylint: disable-msg=import-outside-toplevel
    lowest_mac = 0x1000000000000
    lowest_mac_str = None
    lowest_mac_name = None
@@ -59,36 +100,227 @@ def _getmac():
          return intf_mac_int
    return mac_int
 
-mc.getmac = _getmac
+def _new_http_session(pool_size):
+   """Returns a keep-alive session, which keeps up to pool_size idle
+   connections open to each host.
+   """
+   import requests # pylint: disable-msg=import-outside-toplevel
+   session = requests.Session()
+   adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+   session.mount('https://', adapter)
+   session.mount('http://', adapter)
+   return session
+
+def _new_mobileclient(http_session=None):
+   """gmusicapi takes around half a second to import, so it is imported when
+   the first client is created. That is normally on the startup thread which
+   authenticates, rather than before the window can be shown.
+
+   If http_session is given, the client sends its requests with it rather
+   than a session of its own.
+   """
+   # pylint: disable-msg=import-outside-toplevel,global-statement
+   global _orig_getmac
+   import gmusicapi.clients.mobileclient as mc
+   if mc.getmac is not _getmac:
+      _orig_getmac = mc.getmac
+      mc.getmac = _getmac
+   client = mc.Mobileclient()
+   if http_session is not None:
+      # gmusicapi sends requests with session._rsession, after configuring it
+      # with session._rsession_setup.
+      # pylint: disable-msg=protected-access
+      client.session._rsession.close()
+      client.session._rsession_setup(http_session)
+      client.session._rsession = http_session
+   return client
+
+def _http_status(error):
+   """Returns the HTTP status of the response a call failed with, if known.
+   gmusicapi raises CallFailure from the requests.HTTPError, with its
+   message, such as "404 Client Error: Not Found for url: ...".
+   """
+   for cause in (error, error.__cause__, error.__context__):
+      response = getattr(cause, 'response', None)
+      if response is not None and getattr(response, 'status_code', None):
+         return response.status_code
+   match = _HTTP_ERROR_RE.match(str(error.args[0]) if error.args else '')
+   return int(match.group(1)) if match else None
 
 class Client:
-   # pylint: disable-msg=too-many-instance-attributes
-   def __init__(self):
-      self.api = Mobileclient()
+   """Wraps a Mobileclient, whose methods can be called on the Client
+   directly, or run on the Client's thread pool with submit().
+
+   Requests are sent on one pooled keep-alive HTTP session, which is kept
+   when the Mobileclient is replaced to reauthenticate. Calls to each method
+   are limited by endpoint_limits (see DEFAULT_ENDPOINT_LIMITS), and retried
+   according to policies (see ENDPOINT_POLICIES). Identical calls to the
+   shared_endpoints (see SHARED_ENDPOINTS) made together share one request.
+
+   mobileclient_factory(http_session) creates the Mobileclient, which is a
+   gmusicapi one by default (see gpmp.fakeapi for a local stand-in).
+   """
+   # pylint: disable-msg=too-many-instance-attributes,too-many-arguments
+   def __init__(self, max_workers=4, endpoint_limits=None, pool_size=10, policies=None,
+                min_reauth_secs=10.0, shared_endpoints=None, metrics=REGISTRY,
+                mobileclient_factory=_new_mobileclient):
+      # Wrappers of the Mobileclient's methods, by name
+      self._wrappers = {}
+      self.executor = LimitedExecutor(
+         max_workers=max_workers, name="api",
+         endpoint_limits=(DEFAULT_ENDPOINT_LIMITS if endpoint_limits is None
+                          else endpoint_limits))
+      self.single_flight = SingleFlight(
+         SHARED_ENDPOINTS if shared_endpoints is None else shared_endpoints)
+      self.pool_size = pool_size
+      self.mobileclient_factory = mobileclient_factory
+      # The HTTP session and Mobileclient, created on first use
+      self._http = None
+      self._api = None
+      self._api_lock = threading.Lock()
+      self._paging = _Paging()
+      self.reauths = 0
       self._client_authenticated = False
-      self._reauthenticating = Atomic(False)
+      # Held while authenticating. _generation counts the attempts, so a
+      # call which failed on a stale login can tell if it has been replaced.
+      self._auth_lock = threading.RLock()
+      self._generation = 0
+      self._auth_error = None
+      self._auth_time = None
+      # Failures this soon after logging in are retried without logging in
+      # again, in case it is the server rather than the login at fault.
+      self.min_reauth_secs = min_reauth_secs
+      self.resilience = ResilientCaller(
+         self._classify_error, reauthenticate=self._reauthenticate,
+         generation=lambda: self._generation,
+         policies=ENDPOINT_POLICIES if policies is None else policies)
+
+      self._call_seconds = metrics.histogram(
+         'api_call_seconds', "Time taken by API calls, including retries")
+      self._calls = metrics.counter('api_calls_total', "API calls")
+      metrics.gauge('api_in_flight', "API calls in flight").labels().set_function(
+         lambda: sum(self.executor.stats()['in_flight'].values()))
+      metrics.gauge('api_dedup_ratio',
+                    "Fraction of shared API calls answered by another call").labels(
+                    ).set_function(lambda: self.single_flight.stats()['dedup_ratio'])
+      metrics.gauge('api_reauths', "Reauthentications of the API client").labels(
+         ).set_function(lambda: self.reauths)
 
       self.simulated_timeout_delay = 0 # seconds
       self.simulate_timeouts = False
       self.simulate_immediate_error = False
       self._simulated_error_function_re = None
       self._simulated_error_random_rate = 1.0
+      # (endpoint regex, latency distribution), the first matching of which
+      # delays each call while simulate_latency is set
+      self.simulated_latencies = []
+      self.simulate_latency = False
+      self._simulation_rng = random.Random()
+      # Scripted faults, which apply while it is running
+      self.fault_timeline = None
+      # Limits stream downloads (see AudioCache) while its rate is set
+      self.download_throttle = Throttle()
+      self.simulated_bandwidth = DEFAULT_SIMULATED_BANDWIDTH
+
+   @property
+   def api(self):
+      with self._api_lock:
+         if self._api is None:
+            if self._http is None:
+               self._http = _new_http_session(self.pool_size)
+            self._api = self._new_api()
+         return self._api
+
+   def _new_api(self):
+      """Returns a new Mobileclient, whose requests for the pages of
+      incremental calls are made by _page_request
+      """
+      api = self.mobileclient_factory(self._http)
+      # Every request the Mobileclient makes goes through _make_call
+      make_call = api._make_call # pylint: disable-msg=protected-access
+      def paging_make_call(*args, **kwargs):
+         endpoint = self._paging.endpoint
+         if endpoint is None:
+            return make_call(*args, **kwargs)
+         self._paging.endpoint = None
+         return self._page_request(endpoint, args, kwargs)
+      api._make_call = paging_make_call # pylint: disable-msg=protected-access
+      return api
+
+   def is_authenticated(self):
+      # Without a Mobileclient yet, it can't have been authenticated.
+      return self._api is not None and self._api.is_authenticated()
 
    def _authenticate_client(self):
-      if not os.path.exists(OAUTH_FILE):
+      api = self.api
+      oauth_file = api.OAUTH_FILEPATH
+      if not os.path.exists(oauth_file):
          self._maybe_simulate_error("perform_oauth")
-         self.api.perform_oauth(OAUTH_FILE)
+         api.perform_oauth(oauth_file)
 
-      device_id = Mobileclient.FROM_MAC_ADDRESS
+      device_id = api.FROM_MAC_ADDRESS
       self._maybe_simulate_error("oauth_login")
-      self.api.oauth_login(device_id, oauth_credentials=OAUTH_FILE)
+      api.oauth_login(device_id, oauth_credentials=oauth_file)
 
    def authenticate(self):
-      if self._client_authenticated:
-         # Get a new client and reauthenticate
-         self.api = Mobileclient()
-      self._authenticate_client()
-      self._client_authenticated = True
+      with self._auth_lock:
+         try:
+            if self._client_authenticated:
+               # Get a new client and reauthenticate. The HTTP session's open
+               # connections are reused, as nothing in the session depends on
+               # the login except its cookies, which are dropped.
+               with self._api_lock:
+                  self._http.cookies.clear()
+                  self._api = self._new_api()
+               self.reauths += 1
+            self._authenticate_client()
+            self._client_authenticated = True
+         except Exception as e:
+            self._auth_error = e
+            raise
+         else:
+            self._auth_error = None
+            self._auth_time = time.monotonic()
+         finally:
+            self._generation += 1
+
+   def _reauthenticate(self, generation):
+      """Reauthenticates, unless that has been done since the login of
+      generation. Calls which fail together wait for one reauthentication,
+      rather than each doing their own. Returns False if the login is too
+      recent to replace.
+      """
+      with self._auth_lock:
+         if self._generation != generation:
+            if self._auth_error is not None:
+               raise self._auth_error
+            return True
+         if (self._auth_error is None and self._auth_time is not None and
+               time.monotonic() - self._auth_time < self.min_reauth_secs):
+            return False
+         self.authenticate()
+         return True
+
+   def _classify_error(self, error):
+      # Already imported by the Mobileclient
+      import requests # pylint: disable-msg=import-outside-toplevel
+      _, not_logged_in = api_errors()
+      # Sometimes we will get timeouts when the API has existed for a while.
+      # In this case, we need to get a new Mobileclient and reauthenticate it.
+      if isinstance(error, requests.exceptions.ReadTimeout):
+         return REAUTH
+      # A reauthentication failed, leaving a Mobileclient which isn't logged in
+      if isinstance(error, not_logged_in) and self._client_authenticated:
+         return REAUTH
+      if isinstance(error, (requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout)):
+         return RETRY
+      status = _http_status(error)
+      # Other than being rate limited, a 4xx is down to the call, such as a
+      # track which is not available, rather than the server failing.
+      if status is not None and 400 <= status < 500 and status != 429:
+         return INVALID
+      return FAIL
 
    def set_simulated_error_function_re(self, pattern: str):
       self._simulated_error_function_re = re.compile(pattern)
@@ -96,7 +328,39 @@ class Client:
    def set_simulated_error_rate(self, rate: float):
       self._simulated_error_random_rate = rate
 
+   def add_simulated_latency(self, endpoint_re, distribution):
+      """Delays calls to endpoints matching endpoint_re by a time from
+      distribution (see gpmp.simulation), while simulate_latency is set
+      """
+      self.simulated_latencies.append((re.compile(endpoint_re), distribution))
+
+   def set_simulated_bandwidth(self, enable):
+      self.download_throttle.rate = self.simulated_bandwidth if enable else 0
+
+   def _simulated_delay(self, call_name):
+      delay = 0.0
+      if self.simulate_latency:
+         latencies = self.simulated_latencies or [(None, DEFAULT_SIMULATED_LATENCY)]
+         for pattern, distribution in latencies:
+            if pattern is None or pattern.search(call_name):
+               delay += distribution.sample(self._simulation_rng)
+               break
+      fault = None
+      if self.fault_timeline is not None:
+         for event in self.fault_timeline.events_for(call_name):
+            if event.latency is not None:
+               delay += event.latency.sample(self._simulation_rng)
+            elif fault is None:
+               fault = event.fault
+      return delay, fault
+
    def _maybe_simulate_error(self, call_name):
+      delay, fault = self._simulated_delay(call_name)
+      if delay > 0:
+         time.sleep(delay)
+      if fault is not None:
+         raise_fault(fault, call_name)
+
       if (self._simulated_error_function_re is not None and
           not self._simulated_error_function_re.search(call_name)):
          return
@@ -106,35 +370,105 @@ class Client:
             return
 
       if self.simulate_timeouts:
+         import requests # pylint: disable-msg=import-outside-toplevel
+         time.sleep(self.simulated_timeout_delay)
          raise requests.exceptions.ReadTimeout("Simulated timeout for " + call_name)
       if self.simulate_immediate_error:
          raise Exception("Simulated immediate error for " + call_name)
 
+   def _attempt(self, attr, args, kwargs):
+      self._maybe_simulate_error(attr)
+      return getattr(self.api, attr)(*args, **kwargs)
+
+   def _call(self, attr, args, kwargs):
+      return self._resilient_call(attr, lambda: self._attempt(attr, args, kwargs))
+
+   def _resilient_call(self, attr, attempt):
+      start = time.monotonic()
+      outcome = 'error'
+      try:
+         result = self.resilience.call(attr, attempt)
+         outcome = 'ok'
+         return result
+      except CircuitOpenError:
+         outcome = 'circuit_open'
+         raise
+      finally:
+         self._call_seconds.labels(endpoint=attr, outcome=outcome).observe(
+            time.monotonic() - start)
+         self._calls.labels(endpoint=attr, outcome=outcome).inc()
+
+   def _limited_call(self, attr, args, kwargs):
+      with self.executor.limit(attr):
+         return self._call(attr, args, kwargs)
+
+   def _page_request(self, endpoint, args, kwargs):
+      """Makes the request for one page of an incremental call to endpoint,
+      as a call of its own. It is retried on the current Mobileclient, which
+      is replaced when reauthenticating.
+      """
+      def attempt():
+         self._maybe_simulate_error(endpoint)
+         return self.api._make_call(*args, **kwargs) # pylint: disable-msg=protected-access
+      with self.executor.limit(endpoint):
+         return self._resilient_call(endpoint, attempt)
+
+   def _pages(self, attr, pages):
+      """Yields the pages of an incremental call, fetching each with
+      _page_request
+      """
+      while True:
+         self._paging.endpoint = attr
+         try:
+            page = next(pages)
+         except StopIteration:
+            return
+         finally:
+            self._paging.endpoint = None
+         yield page
+
+   def _forget_shared_results(self, attr):
+      # Other calls may change the library, and so the shared results.
+      if attr not in self.single_flight.ttls:
+         self.single_flight.clear()
+
    def __getattr__(self, attr):
       '''For other attributes, grab it from the Mobileclient'''
+      cached = self._wrappers.get(attr)
+      if cached is not None:
+         return cached
       attrval = getattr(self.api, attr)
       if callable(attrval):
-         # Sometimes we will get timeouts (and possibly other exceptions) when
-         # the API has existed for a while. In this case, we need to get a new
-         # Mobileclient and reauthenticate it.
-         # Wrap the Mobileclient's method such that it can handle this kind
-         # of failure once.
+         # Looks the method up on each call, as the Mobileclient is replaced
+         # when reauthenticating.
          def wrapper(*args, **kwargs):
-            try:
-               self._maybe_simulate_error(attr)
-               return attrval(*args, **kwargs)
-            except requests.exceptions.ReadTimeout as e:
-               log.warning("ReadTimeout calling %s:%r"
-                           "\nReauthenticating client and retrying.", attr, e)
-
-               if self._reauthenticating.set_if_equal(False, True):
-                  # Do not reauth and retry if we are currently doing this.
-                  self.authenticate()
-                  self._maybe_simulate_error(attr)
-                  ret = getattr(self.api, attr)(*args, **kwargs)
-                  self._reauthenticating.value = False
-                  return ret
-               raise
-
+            self._forget_shared_results(attr)
+            if kwargs.get('incremental'):
+               # A generator, which makes a request for each page as it is
+               # iterated, rather than when it is created
+               return self._pages(attr, getattr(self.api, attr)(*args, **kwargs))
+            return self.single_flight.call(
+               attr, args, kwargs, lambda: self._limited_call(attr, args, kwargs))
+         self._wrappers[attr] = wrapper
          return wrapper
       return attrval
+
+   def submit(self, method, *args, **kwargs):
+      """Calls the Mobileclient method on the thread pool. Returns a Future
+      for its result.
+      """
+      self._forget_shared_results(method)
+      return self.single_flight.submit(
+         method, args, kwargs,
+         lambda: self.executor.submit(method, self._call, method, args, kwargs))
+
+   def stats(self):
+      return dict(self.executor.stats(), reauths=self.reauths,
+                  endpoints=self.resilience.stats(),
+                  shared=self.single_flight.stats())
+
+   def shutdown(self):
+      log.info("API client: %r", self.stats())
+      self.executor.shutdown()
+      if self._http is not None:
+         self._http.close()
@@ -0,0 +1,243 @@
+"""Album art thumbnails, fetched and scaled off the GUI thread"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+
+from PySide2 import QtCore, QtGui
+
+from gpmp.cache import PART_EXT, cache_stats, scan_cache_dir, user_cache_dir
+from gpmp.loader import PRIORITY_BACKGROUND, LoaderService
+from gpmp.log import get_logger
+
+log = get_logger()
+
+ART_CACHE_DIR = os.path.join(user_cache_dir(), "art")
+_EXT = ".png"
+
+class ArtworkCache:
+   """Album art scaled down to square thumbnails of a given size in pixels,
+   kept in a memory LRU limited to max_memory_bytes of decoded images, and a
+   disk LRU of the scaled thumbnails limited to max_disk_bytes.
+
+   get() never blocks. If the thumbnail is not in memory it returns None and
+   the thumbnail is read from disk, or downloaded, decoded and scaled, on a
+   pool of worker threads. loaded_callbacks are then called with
+   (url, size), from the worker thread.
+
+   Only the last max_pending requests are kept. Older ones are cancelled,
+   so scrolling quickly through a long list doesn't queue up a download
+   for every row that went past.
+   """
+   # pylint: disable-msg=too-many-instance-attributes
+   def __init__(self, directory=ART_CACHE_DIR, max_memory_bytes=16 * 1024 * 1024,
+                max_disk_bytes=64 * 1024 * 1024, max_workers=2, max_pending=64):
+      self.directory = directory
+      self.max_memory_bytes = max_memory_bytes
+      self.max_disk_bytes = max_disk_bytes
+      self.max_pending = max_pending
+      self._lock = threading.RLock()
+      # (url, size) -> QImage, least recently used first
+      self._memory = OrderedDict()
+      self._memory_bytes = 0
+      # file name -> size in bytes, least recently used first
+      self._disk = OrderedDict()
+      self._disk_bytes = 0
+      # (url, size) -> loader job, oldest request first
+      self._pending = OrderedDict()
+      self._failed = set()
+      self._loader = LoaderService(max_workers=max_workers)
+      self.loaded_callbacks = []
+
+      self.hits = 0
+      self.misses = 0
+      self.disk_hits = 0
+      self.downloads = 0
+      self.bytes_downloaded = 0
+      self.failures = 0
+      self.cancelled = 0
+      self.memory_evictions = 0
+      self.disk_evictions = 0
+
+      self._load_disk_entries()
+
+   @staticmethod
+   def _file_name(url, size):
+      return "{}-{:d}{}".format(hashlib.sha1(url.encode()).hexdigest(), size, _EXT)
+
+   def _load_disk_entries(self):
+      for _, name, size in scan_cache_dir(self.directory, _EXT):
+         self._disk[name] = size
+         self._disk_bytes += size
+      self._evict_disk()
+
+   def _evict_memory(self):
+      """Must be called with the lock held"""
+      while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+         _, image = self._memory.popitem(last=False)
+         self._memory_bytes -= image.sizeInBytes()
+         self.memory_evictions += 1
+
+   def _evict_disk(self):
+      """Must be called with the lock held"""
+      while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+         name, size = self._disk.popitem(last=False)
+         self._disk_bytes -= size
+         self.disk_evictions += 1
+         try:
+            os.remove(os.path.join(self.directory, name))
+         except OSError as e:
+            log.warning("Failed to remove %s from art cache: %s", name, e)
+
+   def get(self, url, size, priority=PRIORITY_BACKGROUND):
+      """Returns the thumbnail of the image at url as a QImage, or None if it
+      is not loaded yet or could not be loaded.
+      """
+      if not url:
+         return None
+      key = (url, size)
+      with self._lock:
+         image = self._memory.get(key)
+         if image is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return image
+         if key not in self._failed:
+            self._request(key, priority)
+      return None
+
+   def _request(self, key, priority):
+      """Must be called with the lock held"""
+      job = self._pending.get(key)
+      if job is not None:
+         self._pending.move_to_end(key)
+         if priority < job.priority:
+            # Raises the queued job's priority
+            self._loader.submit(job.name, job.func, priority=priority, key=key)
+         return
+
+      self.misses += 1
+      url, size = key
+      job = self._loader.submit("art {}".format(size),
+                                lambda job: self._load(job, url, size),
+                                priority=priority, key=key)
+      self._pending[key] = job
+      job.add_done_callback(lambda job: self._on_job_done(key, job))
+      while len(self._pending) > self.max_pending:
+         _, old_job = self._pending.popitem(last=False)
+         old_job.cancel()
+         self.cancelled += 1
+
+   def _on_job_done(self, key, job):
+      with self._lock:
+         if self._pending.get(key) is job:
+            del self._pending[key]
+
+   def _read_disk(self, name):
+      with self._lock:
+         if name not in self._disk:
+            return None
+         self._disk.move_to_end(name)
+      path = os.path.join(self.directory, name)
+      image = QtGui.QImage(path)
+      if image.isNull():
+         log.warning("Could not read %s from art cache", name)
+         with self._lock:
+            size = self._disk.pop(name, None)
+            if size is not None:
+               self._disk_bytes -= size
+         return None
+      try:
+         os.utime(path)
+      except OSError:
+         pass
+      return image
+
+   def _write_disk(self, name, image):
+      path = os.path.join(self.directory, name)
+      part_path = path + PART_EXT
+      if not image.save(part_path, "PNG"):
+         log.warning("Failed to write %s to art cache", name)
+         return
+      try:
+         os.replace(part_path, path)
+         n_bytes = os.path.getsize(path)
+      except OSError as e:
+         log.warning("Failed to write %s to art cache: %s", name, e)
+         return
+      with self._lock:
+         self._disk_bytes += n_bytes - self._disk.pop(name, 0)
+         self._disk[name] = n_bytes
+         self._evict_disk()
+
+   def _download(self, job, url, size):
+      import requests # pylint: disable-msg=import-outside-toplevel
+      job.token.raise_if_cancelled()
+      resp = requests.get(url, timeout=30)
+      resp.raise_for_status()
+      data = resp.content
+      job.report_progress(1, len(data))
+      with self._lock:
+         self.downloads += 1
+         self.bytes_downloaded += len(data)
+
+      image = QtGui.QImage()
+      if not image.loadFromData(data):
+         raise ValueError("Could not decode image from {}".format(url))
+      return image.scaled(size, size, QtCore.Qt.KeepAspectRatio,
+                          QtCore.Qt.SmoothTransformation)
+
+   def _load(self, job, url, size):
+      # Not imported before the window is shown, since it is slow to import.
+      import requests # pylint: disable-msg=import-outside-toplevel
+      name = self._file_name(url, size)
+      image = self._read_disk(name)
+      if image is not None:
+         with self._lock:
+            self.disk_hits += 1
+      else:
+         try:
+            image = self._download(job, url, size)
+         except (requests.exceptions.RequestException, ValueError) as e:
+            log.warning("Failed to load album art %s: %r", url, e)
+            with self._lock:
+               self.failures += 1
+               self._failed.add((url, size))
+            return
+         self._write_disk(name, image)
+
+      with self._lock:
+         key = (url, size)
+         old = self._memory.pop(key, None)
+         if old is not None:
+            self._memory_bytes -= old.sizeInBytes()
+         self._memory[key] = image
+         self._memory_bytes += image.sizeInBytes()
+         self._evict_memory()
+
+      for callback in self.loaded_callbacks:
+         try:
+            callback(url, size)
+         except Exception as e: # pylint: disable-msg=broad-except
+            log.error("Album art callback failed: %r", e)
+
+   def stats(self):
+      with self._lock:
+         return cache_stats(
+            self.hits, self.misses,
+            disk_hits=self.disk_hits,
+            downloads=self.downloads,
+            bytes_downloaded=self.bytes_downloaded,
+            failures=self.failures,
+            cancelled=self.cancelled,
+            memory_bytes=self._memory_bytes,
+            memory_images=len(self._memory),
+            memory_evictions=self.memory_evictions,
+            disk_bytes=self._disk_bytes,
+            disk_files=len(self._disk),
+            disk_evictions=self.disk_evictions)
+
+   def shutdown(self):
+      log.info("Album art: %r", self.stats())
+      self._loader.shutdown()
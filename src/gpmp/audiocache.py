@@ -0,0 +1,176 @@
+"""On-disk LRU cache of downloaded track audio"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+from gpmp.cache import PART_EXT, cache_stats, scan_cache_dir, user_cache_dir
+from gpmp.log import get_logger
+
+log = get_logger()
+
+AUDIO_CACHE_DIR = os.path.join(user_cache_dir(), "audio")
+_EXT = ".mp3"
+_CHUNK_SIZE = 64 * 1024
+
+class AudioCache:
+   """Audio files keyed by song id, limited to max_bytes in total.
+   The least recently played files are evicted first. File mtimes are used
+   to remember the order between runs.
+
+   Downloads go no faster than throttle (a gpmp.simulation.Throttle) allows,
+   if given.
+   """
+   # pylint: disable-msg=too-many-instance-attributes
+   def __init__(self, directory=AUDIO_CACHE_DIR, max_bytes=1024 * 1024 * 1024,
+                throttle=None):
+      self.directory = directory
+      self.max_bytes = max_bytes
+      self.throttle = throttle
+      # song id -> size, least recently used first
+      self._entries = OrderedDict()
+      self._bytes_used = 0
+      self._lock = threading.Lock()
+      self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audio-dl")
+      self._downloads = {}
+      self._wanted = set()
+
+      self.hits = 0
+      self.misses = 0
+      self.bytes_saved = 0
+      self.bytes_downloaded = 0
+      self.evictions = 0
+
+      self._load_entries()
+
+   def _path(self, song_id):
+      return os.path.join(self.directory, song_id + _EXT)
+
+   def _load_entries(self):
+      for _, name, size in scan_cache_dir(self.directory, _EXT):
+         self._entries[name[:-len(_EXT)]] = size
+         self._bytes_used += size
+      self._evict()
+
+   def _evict(self, keep=None):
+      """Removes the least recently used files until within max_bytes.
+      Must be called with the lock held.
+      """
+      while self._bytes_used > self.max_bytes and self._entries:
+         song_id = next(iter(self._entries))
+         if song_id == keep:
+            if len(self._entries) == 1:
+               break
+            self._entries.move_to_end(song_id)
+            continue
+         size = self._entries.pop(song_id)
+         self._bytes_used -= size
+         self.evictions += 1
+         try:
+            os.remove(self._path(song_id))
+         except OSError as e:
+            log.warning("Failed to remove %s from audio cache: %s", song_id, e)
+
+   def get_path(self, song_id):
+      """Returns the path of the cached audio for song_id and marks it as
+      recently used, or returns None if it is not cached.
+      """
+      with self._lock:
+         size = self._entries.get(song_id)
+         if size is None:
+            self.misses += 1
+            return None
+         self._entries.move_to_end(song_id)
+         self.hits += 1
+         self.bytes_saved += size
+
+      path = self._path(song_id)
+      try:
+         os.utime(path)
+      except OSError:
+         # Removed from under us
+         with self._lock:
+            if self._entries.pop(song_id, None) is not None:
+               self._bytes_used -= size
+         return None
+      return path
+
+   def __contains__(self, song_id):
+      return song_id in self._entries
+
+   def _download(self, song_id, url):
+      """Downloads the audio at url into the cache, unless song_id stops being
+      wanted part way through.
+      """
+      # Not imported at startup, since it is slow to import.
+      import requests # pylint: disable-msg=import-outside-toplevel
+      path = self._path(song_id)
+      part_path = path + PART_EXT
+      size = 0
+      try:
+         with requests.get(url, stream=True, timeout=30) as resp:
+            resp.raise_for_status()
+            with open(part_path, 'wb') as f:
+               for chunk in resp.iter_content(chunk_size=_CHUNK_SIZE):
+                  if song_id not in self._wanted:
+                     log.debug("Download of %s no longer wanted", song_id)
+                     os.remove(part_path)
+                     return False
+                  if self.throttle is not None:
+                     self.throttle.consume(len(chunk))
+                  f.write(chunk)
+                  size += len(chunk)
+         os.replace(part_path, path)
+      except (requests.exceptions.RequestException, OSError) as e:
+         log.warning("Failed to download %s: %r", song_id, e)
+         if os.path.exists(part_path):
+            os.remove(part_path)
+         return False
+
+      with self._lock:
+         old_size = self._entries.pop(song_id, 0)
+         self._entries[song_id] = size
+         self._bytes_used += size - old_size
+         self.bytes_downloaded += size
+         self._evict(keep=song_id)
+      log.info("Cached %s (%d bytes)", song_id, size)
+      return True
+
+   def prefetch(self, song_ids, get_url):
+      """Downloads the audio for song_ids in the background, one at a time.
+      get_url(song_id) is called from the download thread to get the url.
+      Downloads for songs no longer in song_ids are abandoned.
+      """
+      with self._lock:
+         self._wanted = set(song_ids)
+         for song_id in list(self._downloads):
+            if song_id not in self._wanted and self._downloads[song_id].cancel():
+               del self._downloads[song_id]
+         for song_id in song_ids:
+            if song_id not in self._entries and song_id not in self._downloads:
+               self._downloads[song_id] = self._executor.submit(
+                  self._prefetch_one, song_id, get_url)
+
+   def _prefetch_one(self, song_id, get_url):
+      try:
+         if song_id in self._wanted:
+            self._download(song_id, get_url(song_id))
+      except Exception as e: # pylint: disable-msg=broad-except
+         log.warning("Failed to prefetch audio for %s: %r", song_id, e)
+      finally:
+         with self._lock:
+            self._downloads.pop(song_id, None)
+
+   def stats(self):
+      return cache_stats(
+         self.hits, self.misses,
+         bytes_saved=self.bytes_saved,
+         bytes_downloaded=self.bytes_downloaded,
+         bytes_used=self._bytes_used,
+         files=len(self._entries),
+         evictions=self.evictions)
+
+   def shutdown(self):
+      self.prefetch([], None)
+      self._executor.shutdown(wait=False)
@@ -0,0 +1,161 @@
+"""Persistent on-disk cache of the library metadata, and helpers for the
+file caches of audio and album art"""
+
+import json
+import os
+import sqlite3
+import threading
+
+from gpmp.log import get_logger
+
+log = get_logger()
+
+def user_cache_dir():
+   base = os.environ.get("XDG_CACHE_HOME")
+   if not base:
+      base = os.path.join(os.path.expanduser("~"), ".cache")
+   return os.path.join(base, "gplaymusicplayer")
+
+PART_EXT = ".part"
+
+def scan_cache_dir(directory, ext):
+   """Creates directory if needed, removes any files left over from
+   interrupted downloads, and returns (mtime, name, size) of the files
+   ending in ext, oldest first
+   """
+   os.makedirs(directory, exist_ok=True)
+   files = []
+   for name in os.listdir(directory):
+      path = os.path.join(directory, name)
+      if name.endswith(PART_EXT):
+         os.remove(path)
+      elif name.endswith(ext):
+         stat = os.stat(path)
+         files.append((stat.st_mtime, name, stat.st_size))
+   return sorted(files)
+
+def cache_stats(hits, misses, **counts):
+   """Returns a dict of a cache's hits, misses, hit rate and counts"""
+   lookups = hits + misses
+   return dict(hits=hits, misses=misses,
+               hit_rate=hits / lookups if lookups else 0.0, **counts)
+
+LIBRARY_CACHE_FILE = os.path.join(user_cache_dir(), "library.sqlite3")
+
+class LibraryCache:
+   """SQLite store of the raw song and playlist dicts returned by gmusicapi,
+   keyed by id and tagged with each item's lastModifiedTimestamp (microseconds).
+
+   The newest lastModifiedTimestamp stored is used as the point to sync
+   from, since it is in server time rather than local time.
+   """
+   SCHEMA_VERSION = 1
+   TABLES = ('songs', 'playlists')
+
+   def __init__(self, path=LIBRARY_CACHE_FILE):
+      self.path = path
+      self._conn = None
+      self._lock = threading.Lock()
+
+   def _connection(self):
+      if self._conn is None:
+         os.makedirs(os.path.dirname(self.path), exist_ok=True)
+         # Written from the loader thread, but may be opened from anywhere.
+         self._conn = sqlite3.connect(self.path, check_same_thread=False)
+         self._init_schema()
+      return self._conn
+
+   def _init_schema(self):
+      conn = self._conn
+      version = conn.execute("PRAGMA user_version").fetchone()[0]
+      if version != self.SCHEMA_VERSION:
+         log.info("Library cache schema %d != %d. Recreating.",
+                  version, self.SCHEMA_VERSION)
+         for table in self.TABLES:
+            conn.execute("DROP TABLE IF EXISTS {}".format(table))
+
+      for table in self.TABLES:
+         conn.execute("CREATE TABLE IF NOT EXISTS {} ("
+                      "id TEXT PRIMARY KEY, "
+                      "last_modified INTEGER NOT NULL, "
+                      "data TEXT NOT NULL)".format(table))
+      conn.execute("PRAGMA user_version = {:d}".format(self.SCHEMA_VERSION))
+      conn.commit()
+
+   def close(self):
+      with self._lock:
+         if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+   def _load(self, table):
+      with self._lock:
+         rows = self._connection().execute(
+            "SELECT data FROM {}".format(table)).fetchall()
+      return [json.loads(data) for (data,) in rows]
+
+   def _load_one(self, table, item_id):
+      with self._lock:
+         row = self._connection().execute(
+            "SELECT data FROM {} WHERE id = ?".format(table), (item_id,)).fetchone()
+      return None if row is None else json.loads(row[0])
+
+   def _last_modified(self, table):
+      with self._lock:
+         row = self._connection().execute(
+            "SELECT MAX(last_modified) FROM {}".format(table)).fetchone()
+      return row[0]
+
+   def _update(self, table, items, replace_all=False):
+      """Upserts items, and removes those marked as deleted.
+      If replace_all is set, any item not in items is dropped.
+      """
+      upserts = []
+      deletes = []
+      for item in items:
+         if item.get('deleted'):
+            deletes.append((item['id'],))
+         else:
+            upserts.append((item['id'],
+                            int(item.get('lastModifiedTimestamp', 0)),
+                            json.dumps(item)))
+
+      with self._lock:
+         conn = self._connection()
+         with conn:
+            if replace_all:
+               conn.execute("DELETE FROM {}".format(table))
+            conn.executemany("DELETE FROM {} WHERE id = ?".format(table), deletes)
+            conn.executemany("INSERT OR REPLACE INTO {} (id, last_modified, data) "
+                             "VALUES (?, ?, ?)".format(table), upserts)
+
+   def load_songs(self):
+      return self._load('songs')
+
+   def load_song(self, song_id):
+      return self._load_one('songs', song_id)
+
+   def load_playlists(self):
+      return self._load('playlists')
+
+   def songs_last_modified(self):
+      """Returns the newest song lastModifiedTimestamp in microseconds,
+      or None if there are no cached songs.
+      """
+      return self._last_modified('songs')
+
+   def playlists_last_modified(self):
+      return self._last_modified('playlists')
+
+   def update_songs(self, songs, replace_all=False):
+      self._update('songs', songs, replace_all=replace_all)
+
+   def update_playlists(self, playlists, replace_all=False):
+      self._update('playlists', playlists, replace_all=replace_all)
+
+   def clear(self):
+      with self._lock:
+         conn = self._connection()
+         with conn:
+            for table in self.TABLES:
+               conn.execute("DELETE FROM {}".format(table))
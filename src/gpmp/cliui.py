@@ -2,27 +2,30 @@
 
 import threading
 from time import sleep
+from typing import TYPE_CHECKING
 
-from gmusicapi import Mobileclient
 from progress.bar import IncrementalBar
 
 from gpmp.log import get_logger
 from gpmp.player import TrackPlayer
 
+if TYPE_CHECKING:
+   from gmusicapi import Mobileclient
+
 log = get_logger()
 
 class CliUI:
-   def __init__(self, player: TrackPlayer, api: Mobileclient,
-                play_all_songs=False):
+   def __init__(self, player: TrackPlayer, api: 'Mobileclient',
+                play_all_songs=False, search_query=None):
       self.player = player
       self.api = api
       self.library = self.player.library
       self.play_all_songs = play_all_songs
+      self.search_query = search_query
       self.progress_bar = None
       self.current_song_info = None
 
    def get_user_selected_playlist_tracks(self):
-      self.library.load_playlist_contents()
       playlists = self.library.playlist_meta
       for i, playlist in enumerate(playlists):
          print("[{0}]: {1}".format(i, playlist['name']))
@@ -33,17 +36,28 @@ class CliUI:
          return None
 
       playlist = playlists[index]
-      return self.library.playlist_contents[playlist['id']]
+      return self.library.load_playlist(playlist['id'])
+
+   def get_search_result_tracks(self):
+      track_ids = self.library.search(self.search_query, limit=100)
+      for i, song_id in enumerate(track_ids):
+         song_info = self.library.songs.get(song_id)
+         print("[{0}]: {1} - {2}".format(i, song_info['title'], song_info['artist']))
+      return track_ids
 
    def run_player(self):
       self.player.initialize()
-      if self.play_all_songs:
-         track_ids = list(self.library.songs.keys())
+      shuffle = True
+      if self.search_query:
+         track_ids = self.get_search_result_tracks()
+         # Play in order of relevance
+         shuffle = False
+      elif self.play_all_songs:
+         track_ids = self.library.songs.ids
       else:
          track_ids = self.get_user_selected_playlist_tracks()
 
-      self.player.set_tracks_to_play(track_ids)
-      self.player.shuffle_tracks()
+      self.player.set_tracks_to_play(track_ids, shuffle=shuffle)
 
       self.player.toggle_play()
 
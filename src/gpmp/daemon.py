@@ -0,0 +1,388 @@
+"""Headless player daemon, controlled over a Unix socket
+
+Front ends (see gpmp.rpc) send JSON-RPC requests, or batches of them, which
+are run in order, one line per message. A client which calls 'subscribe' is
+also sent 'state' notifications as the player's published state changes,
+and 'queue' notifications as its queue is edited.
+"""
+
+from collections import Counter, deque
+from dataclasses import asdict
+import inspect
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+from gpmp.log import get_logger
+from gpmp.metrics import REGISTRY
+from gpmp.player import Library, TrackPlayer
+from gpmp.rpc import (DEFAULT_SOCKET_PATH, INTERNAL_ERROR, INVALID_PARAMS, INVALID_REQUEST,
+                      METHOD_NOT_FOUND, PARSE_ERROR, RpcError, encode)
+
+log = get_logger()
+
+# Outgoing messages queued for a client, above which it is disconnected
+# rather than holding on to more.
+_MAX_OUTGOING = 1000
+
+def _check_position(name, value, length):
+   """Raises an invalid params RpcError unless value is a position in a
+   queue of length tracks
+   """
+   # bool is an int, but true isn't a position
+   if not isinstance(value, int) or isinstance(value, bool):
+      raise RpcError(INVALID_PARAMS, "{} must be an integer, not {!r}".format(name, value))
+   if not 0 <= value < length:
+      raise RpcError(INVALID_PARAMS, "{} {} is not in the queue of {} tracks".format(
+         name, value, length))
+
+class PlayerService:
+   """The methods served by the daemon. Each takes JSON params and returns
+   a JSON result.
+   """
+   def __init__(self, player: TrackPlayer, library: Library):
+      self.player = player
+      self.library = library
+      self.methods = {
+         'ping': self.ping,
+         'status': self.status,
+         'toggle_play': player.toggle_play,
+         'next': player.play_next_track,
+         'previous': player.handle_previous_track_action,
+         'skip_to_end': player.skip_to_end,
+         'seek': self.seek,
+         'play_index': self.play_index,
+         'play_all': self.play_all,
+         'play_playlist': self.play_playlist,
+         'play_tracks': self.play_tracks,
+         'queue': self.queue,
+         'queue_next': self.queue_next,
+         'queue_move': self.queue_move,
+         'queue_remove': self.queue_remove,
+         'playlists': self.playlists,
+         'search': self.search,
+         'songs': self.songs,
+      }
+
+   @staticmethod
+   def ping():
+      return 'pong'
+
+   def _song(self, song_id):
+      songs = self.library.songs
+      row = songs.row_of(song_id) if songs is not None else None
+      if row is None:
+         return {'id': song_id}
+      return {'id': song_id, 'title': songs.titles[row], 'artist': songs.artists[row],
+              'album': songs.albums[row], 'duration_ms': songs.durations[row]}
+
+   def status(self):
+      player = self.player
+      index = player.current_track_index.value
+      song_id = None
+      if index is not None:
+         try:
+            song_id = player.tracks_to_play[index]
+         except IndexError:
+            pass
+      timing = player.get_timing_info()
+      return {
+         'track_index': index,
+         'song_id': song_id,
+         'song_info': player.current_song_info.value,
+         'playing': player.is_playing(),
+         'position': timing.position_fract if timing else 0.0,
+         'duration_secs': timing.duration_secs if timing else 0.0,
+         'queue_length': len(player.tracks_to_play),
+      }
+
+   def seek(self, position):
+      """Seeks to a fraction (0.0 to 1.0) of the way through the track"""
+      self.player.set_position(float(position))
+
+   def play_index(self, index):
+      """Plays the track at position index in the queue"""
+      _check_position('index', index, len(self.player.tracks_to_play))
+      return self.player.play_track_at_index(index)
+
+   def play_tracks(self, track_ids, shuffle=False):
+      self.player.set_tracks_to_play(track_ids, shuffle=shuffle)
+      return self.player.play_next_track()
+
+   def play_all(self, shuffle=True):
+      if not self.library.songs:
+         raise RpcError(INTERNAL_ERROR, "No songs loaded yet")
+      track_ids = self.library.songs.ids
+      if not shuffle:
+         # Only a shuffle skips the None left by removed songs
+         track_ids = [song_id for song_id in track_ids if song_id is not None]
+      return self.play_tracks(track_ids, shuffle=shuffle)
+
+   def play_playlist(self, playlist_id, shuffle=True):
+      track_ids = self.library.load_playlist(playlist_id)
+      if track_ids is None:
+         raise RpcError(INVALID_PARAMS, "No playlist {}".format(playlist_id))
+      return self.play_tracks(track_ids, shuffle=shuffle)
+
+   def queue(self, start=0, count=50):
+      """Returns the songs in the queue from position start"""
+      start = max(int(start), 0)
+      song_ids = self.player.tracks_to_play[start:start + int(count)]
+      return [dict(self._song(song_id), index=start + i)
+              for i, song_id in enumerate(song_ids)]
+
+   def queue_next(self, track_ids):
+      self.player.queue_next(track_ids)
+
+   def queue_move(self, index, dest):
+      length = len(self.player.tracks_to_play)
+      _check_position('index', index, length)
+      _check_position('dest', dest, length)
+      self.player.tracks_to_play.move(index, dest)
+
+   def queue_remove(self, index, count=1):
+      _check_position('index', index, len(self.player.tracks_to_play))
+      if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+         raise RpcError(INVALID_PARAMS, "count must be a positive integer, not {!r}".format(
+            count))
+      self.player.tracks_to_play.remove(index, count)
+
+   def playlists(self):
+      return [{'id': p['id'], 'name': p.get('name')}
+              for p in self.library.playlist_meta or ()]
+
+   def search(self, query, limit=50):
+      return [self._song(song_id) for song_id in self.library.search(query, limit=limit)]
+
+   def songs(self, song_ids):
+      return [self._song(song_id) for song_id in song_ids]
+
+class _Connection(socketserver.StreamRequestHandler):
+   """One client. Requests are handled in order on the connection's thread.
+   Everything sent to the client, including notifications from the player's
+   threads, goes through a queue to a writer thread, so a slow client never
+   blocks the player.
+   """
+   def setup(self):
+      super().setup()
+      self.outgoing = queue.SimpleQueue()
+      self.closed = False
+      self.writer = threading.Thread(target=self._write_messages, name="daemon-writer",
+                                     daemon=True)
+      self.writer.start()
+
+   def _write_messages(self):
+      while True:
+         data = self.outgoing.get()
+         if data is None:
+            return
+         try:
+            self.wfile.write(data)
+            self.wfile.flush()
+         except OSError:
+            self.close()
+            return
+
+   def send(self, message):
+      if self.closed:
+         return
+      if self.outgoing.qsize() >= _MAX_OUTGOING:
+         log.warning("Daemon client is not reading. Disconnecting it.")
+         self.close()
+         return
+      self.outgoing.put(encode(message))
+
+   def close(self):
+      if not self.closed:
+         self.closed = True
+         try:
+            self.request.shutdown(socket.SHUT_RDWR)
+         except OSError:
+            pass
+
+   def handle(self):
+      for line in self.rfile:
+         if not line.strip():
+            continue
+         response = self.server.daemon.handle_message(line, self)
+         if response is not None:
+            self.send(response)
+
+   def finish(self):
+      self.server.daemon.unsubscribe(self)
+      self.outgoing.put(None)
+      self.writer.join()
+      super().finish()
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+   daemon_threads = True
+
+   def __init__(self, path, daemon):
+      self.daemon = daemon
+      super().__init__(path, _Connection)
+
+def _error_response(request_id, error: RpcError):
+   return {'jsonrpc': '2.0', 'error': error.to_json(), 'id': request_id}
+
+class PlayerDaemon:
+   """Serves a PlayerService on a Unix socket, which only the user can
+   connect to.
+   """
+   # pylint: disable-msg=too-many-instance-attributes
+   def __init__(self, player: TrackPlayer, library: Library, path=DEFAULT_SOCKET_PATH):
+      self.player = player
+      self.service = PlayerService(player, library)
+      self.path = path
+      self.server = None
+      self._thread = None
+      self._subscribers = set()
+      self._lock = threading.Lock()
+
+      self.counts = Counter()
+      # Seconds taken to handle each of the last requests, excluding I/O
+      self.handle_times = deque(maxlen=1000)
+
+   def _remove_stale_socket(self):
+      if not os.path.exists(self.path):
+         return
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+         sock.connect(self.path)
+      except OSError:
+         # Left behind by a daemon which didn't exit cleanly
+         os.remove(self.path)
+      else:
+         raise RuntimeError("A daemon is already listening on {}".format(self.path))
+      finally:
+         sock.close()
+
+   def start(self):
+      self._remove_stale_socket()
+      old_umask = os.umask(0o177)
+      try:
+         self.server = _Server(self.path, self)
+      finally:
+         os.umask(old_umask)
+      self.player.state_callbacks.append(self._on_state_changed)
+      self.player.tracks_to_play.change_callbacks.append(self._on_queue_changed)
+      self._thread = threading.Thread(target=self.server.serve_forever, name="daemon",
+                                      daemon=True)
+      self._thread.start()
+      log.info("Daemon listening on %s", self.path)
+
+   def shutdown(self):
+      if self.server is None:
+         return
+      self.player.state_callbacks.remove(self._on_state_changed)
+      self.player.tracks_to_play.change_callbacks.remove(self._on_queue_changed)
+      self.server.shutdown()
+      self.server.server_close()
+      self.server = None
+      with self._lock:
+         subscribers = list(self._subscribers)
+      for connection in subscribers:
+         connection.close()
+      try:
+         os.remove(self.path)
+      except OSError:
+         pass
+      log.info("Daemon: %r", self.stats())
+
+   def unsubscribe(self, connection):
+      with self._lock:
+         self._subscribers.discard(connection)
+
+   def _broadcast(self, method, params):
+      with self._lock:
+         subscribers = list(self._subscribers)
+      message = {'jsonrpc': '2.0', 'method': method, 'params': params}
+      for connection in subscribers:
+         connection.send(message)
+
+   def _on_state_changed(self, key, value):
+      self._broadcast('state', {'key': key, 'value': value})
+
+   def _on_queue_changed(self, change):
+      self._broadcast('queue', asdict(change))
+
+   def handle_message(self, line, connection):
+      """Returns the response to a line received from connection, or None if
+      it only had notifications.
+      """
+      try:
+         message = json.loads(line)
+      except ValueError as e:
+         return _error_response(None, RpcError(PARSE_ERROR, str(e)))
+
+      if isinstance(message, list):
+         if not message:
+            return _error_response(None, RpcError(INVALID_REQUEST, "Empty batch"))
+         self.counts['batches'] += 1
+         responses = [self._handle_request(request, connection) for request in message]
+         return [response for response in responses if response is not None] or None
+      return self._handle_request(message, connection)
+
+   def _handle_request(self, request, connection):
+      start = time.perf_counter()
+      if (not isinstance(request, dict) or not isinstance(request.get('method'), str)
+            or not isinstance(request.get('params', []), (list, dict))):
+         return _error_response(None, RpcError(INVALID_REQUEST, "Invalid request"))
+      request_id = request.get('id')
+      method = request['method']
+      params = request.get('params', [])
+      self.counts['requests'] += 1
+
+      try:
+         result = self._call(method, params, connection)
+      except RpcError as e:
+         self.counts['errors'] += 1
+         response = _error_response(request_id, e)
+      else:
+         response = {'jsonrpc': '2.0', 'result': result, 'id': request_id}
+      self.handle_times.append(time.perf_counter() - start)
+      # Requests without an id are notifications, which get no response.
+      return response if 'id' in request else None
+
+   def _call(self, method, params, connection):
+      if method == 'subscribe':
+         with self._lock:
+            self._subscribers.add(connection)
+         return self.service.status()
+      if method == 'unsubscribe':
+         self.unsubscribe(connection)
+         return None
+      if method == 'stats':
+         return self.stats()
+      if method == 'metrics':
+         return REGISTRY.snapshot()
+
+      func = self.service.methods.get(method)
+      if func is None:
+         raise RpcError(METHOD_NOT_FOUND, "No method {}".format(method))
+      args, kwargs = (params, {}) if isinstance(params, list) else ((), params)
+      try:
+         inspect.signature(func).bind(*args, **kwargs)
+      except TypeError as e:
+         raise RpcError(INVALID_PARAMS, str(e)) from e
+      try:
+         return func(*args, **kwargs)
+      except RpcError:
+         raise
+      except Exception as e: # pylint: disable-msg=broad-except
+         log.error("Daemon method %s failed: %r", method, e)
+         raise RpcError(INTERNAL_ERROR, repr(e)) from e
+
+   def stats(self):
+      times = sorted(self.handle_times)
+      def percentile_us(fract):
+         if not times:
+            return 0.0
+         return times[min(int(len(times) * fract), len(times) - 1)] * 1e6
+      with self._lock:
+         n_subscribers = len(self._subscribers)
+      return dict(self.counts, subscribers=n_subscribers,
+                  handle_p50_us=percentile_us(0.5), handle_p99_us=percentile_us(0.99))
@@ -0,0 +1,149 @@
+"""A thread pool which limits the calls in flight to each endpoint"""
+
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+import itertools
+import threading
+
+class LimitedExecutor:
+   """Runs calls on up to max_workers threads. At most the endpoint's limit
+   (from endpoint_limits, or default_limit) of calls to each endpoint are in
+   flight at once, counting both those submitted here and those made
+   directly inside limit().
+
+   Submitted calls wait in a queue per endpoint. A free worker takes the
+   oldest call whose endpoint is under its limit, so calls to a busy
+   endpoint don't hold up calls to the others.
+   """
+   # pylint: disable-msg=too-many-instance-attributes
+   def __init__(self, max_workers=4, endpoint_limits=None, default_limit=None,
+                name="executor"):
+      self.max_workers = max_workers
+      self.endpoint_limits = dict(endpoint_limits or {})
+      self.default_limit = default_limit or max_workers
+      self.name = name
+      # Started as calls are submitted, so there are no threads until needed
+      self._threads = []
+      self._shut_down = False
+      self._cond = threading.Condition()
+      self._in_flight = Counter()
+      self._seq = itertools.count()
+      # endpoint -> (seq, future, func, args, kwargs) of calls waiting to start
+      self._waiting = defaultdict(deque)
+
+      self.peak_in_flight = Counter()
+      self.submitted = 0
+      self.direct_calls = 0
+      self.completed = 0
+      self.limit_waits = 0
+
+   def limit_of(self, endpoint):
+      return self.endpoint_limits.get(endpoint, self.default_limit)
+
+   def _try_acquire(self, endpoint):
+      """Must be called with the lock held"""
+      if self._in_flight[endpoint] >= self.limit_of(endpoint):
+         return False
+      self._in_flight[endpoint] += 1
+      self.peak_in_flight[endpoint] = max(self.peak_in_flight[endpoint],
+                                          self._in_flight[endpoint])
+      return True
+
+   def _release(self, endpoint):
+      with self._cond:
+         self._in_flight[endpoint] -= 1
+         self.completed += 1
+         self._cond.notify_all()
+
+   def _next_endpoint(self):
+      """Must be called with the lock held. Returns the endpoint of the
+      oldest waiting call which can start, or None.
+      """
+      best = None
+      for endpoint, calls in self._waiting.items():
+         if (calls and self._in_flight[endpoint] < self.limit_of(endpoint) and
+             (best is None or calls[0][0] < self._waiting[best][0][0])):
+            best = endpoint
+      return best
+
+   def _work(self):
+      while True:
+         with self._cond:
+            self._cond.wait_for(
+               lambda: self._shut_down or self._next_endpoint() is not None)
+            if self._shut_down:
+               return
+            endpoint = self._next_endpoint()
+            _, future, func, args, kwargs = self._waiting[endpoint].popleft()
+            self._try_acquire(endpoint)
+
+         try:
+            if future.set_running_or_notify_cancel():
+               try:
+                  result = func(*args, **kwargs)
+               except Exception as e: # pylint: disable-msg=broad-except
+                  future.set_exception(e)
+               else:
+                  future.set_result(result)
+         finally:
+            self._release(endpoint)
+
+   def submit(self, endpoint, func, *args, **kwargs):
+      """Calls func(*args, **kwargs) as a call to endpoint. Returns a Future.
+      It can be cancelled until the call has started.
+      """
+      future = Future()
+      with self._cond:
+         if self._shut_down:
+            raise RuntimeError("{} has been shut down".format(self.name))
+         self.submitted += 1
+         if self._in_flight[endpoint] >= self.limit_of(endpoint):
+            self.limit_waits += 1
+         self._waiting[endpoint].append((next(self._seq), future, func, args, kwargs))
+         if len(self._threads) < self.max_workers:
+            thread = threading.Thread(target=self._work, daemon=True,
+                                      name="{}-{}".format(self.name, len(self._threads)))
+            self._threads.append(thread)
+            thread.start()
+         self._cond.notify_all()
+      return future
+
+   @contextmanager
+   def limit(self, endpoint):
+      """Waits until a call to endpoint can be made on this thread, and counts
+      it as in flight while in the with block.
+      """
+      with self._cond:
+         self.direct_calls += 1
+         if not self._try_acquire(endpoint):
+            self.limit_waits += 1
+            self._cond.wait_for(lambda: self._try_acquire(endpoint))
+      try:
+         yield
+      finally:
+         self._release(endpoint)
+
+   def stats(self):
+      with self._cond:
+         return {
+            'submitted': self.submitted,
+            'direct_calls': self.direct_calls,
+            'completed': self.completed,
+            'limit_waits': self.limit_waits,
+            'in_flight': {e: n for e, n in self._in_flight.items() if n},
+            'waiting': sum(len(w) for w in self._waiting.values()),
+            'peak_in_flight': dict(self.peak_in_flight),
+         }
+
+   def shutdown(self):
+      """Cancels the calls which have not started. Those which have are
+      left to finish in the background.
+      """
+      with self._cond:
+         self._shut_down = True
+         waiting = [call for calls in self._waiting.values() for call in calls]
+         self._waiting.clear()
+         self._cond.notify_all()
+      for _, future, _, _, _ in waiting:
+         future.cancel()
@@ -0,0 +1,358 @@
+"""A local stand-in for gmusicapi's Mobileclient, for testing and
+benchmarking without Google's servers
+
+A FakeBackend generates a synthetic library from a FakeConfig, and creates
+FakeMobileclients which answer from it, with the configured latency, paging
+and failures. Stream urls point at a server on localhost, which generates
+a tone for each track. Give the backend to Client as its
+mobileclient_factory:
+   backend = FakeBackend(FakeConfig(songs=50000, latency=0.1))
+   api = Client(mobileclient_factory=backend)
+
+It needs requests, as the rest of gpmp does, but not gmusicapi. Without it,
+stand-ins for gmusicapi's exceptions are raised (see
+gpmp.simulation.api_errors).
+"""
+
+from dataclasses import dataclass
+import math
+import os
+import random
+import re
+import struct
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from gpmp.log import get_logger
+from gpmp.simulation import api_errors, raise_fault
+
+log = get_logger()
+
+@dataclass
+class FakeConfig:
+   # pylint: disable-msg=too-many-instance-attributes
+   songs: int = 1000
+   playlists: int = 20
+   playlist_size: int = 50
+   # Every nth playlist is shared, and fetched by its share token. Its
+   # entries include store tracks which are not in the library.
+   shared_every: int = 5
+   artists: int = 200
+   albums_per_artist: int = 3
+   # Items per page of the paged calls, each of which is a request
+   page_size: int = 1000
+   # Seconds each request takes, plus a random time of up to jitter
+   latency: float = 0.0
+   jitter: float = 0.0
+   # Fraction of requests which fail, to endpoints matching failure_re (all
+   # if None). failure is 'timeout', 'connection' or 'error'.
+   failure_rate: float = 0.0
+   failure_re: str = None
+   failure: str = 'connection'
+   # Length of the generated tracks, and how long stream urls are valid for
+   track_secs: int = 30
+   stream_url_ttl: int = 60
+   seed: int = 0
+
+def _now_usecs():
+   return int(time.time() * 1e6)
+
+def _song(index, config, rng, modified):
+   artist = index % config.artists
+   album = rng.randrange(config.albums_per_artist)
+   return {
+      'kind': 'sj#track',
+      'id': 'fake-{:08d}'.format(index),
+      'title': 'Track {}'.format(index),
+      'artist': 'Artist {}'.format(artist),
+      'album': 'Album {}-{}'.format(artist, album),
+      'trackNumber': rng.randint(1, 20),
+      'durationMillis': str(config.track_secs * 1000),
+      'lastModifiedTimestamp': str(modified),
+      'deleted': False,
+   }
+
+def _store_track(index, config):
+   return {
+      'kind': 'sj#track',
+      'storeId': 'Tfake-{:08d}'.format(index),
+      'title': 'Store track {}'.format(index),
+      'artist': 'Store artist {}'.format(index % config.artists),
+      'album': 'Store album {}'.format(index % config.artists),
+      'durationMillis': str(config.track_secs * 1000),
+   }
+
+class FakeBackend:
+   """The synthetic library, and the audio server, shared by the
+   FakeMobileclients created by calling it. It is safe to share between
+   threads.
+
+   If given a gpmp.simulation.Throttle, the audio server sends audio no
+   faster than it allows.
+   """
+   def __init__(self, config=None, throttle=None):
+      self.config = config or FakeConfig()
+      self.throttle = throttle
+      self._rng = random.Random(self.config.seed)
+      self._failure_re = (re.compile(self.config.failure_re)
+                          if self.config.failure_re else None)
+      self._lock = threading.Lock()
+      self.requests = 0
+      self.failures = 0
+      self._audio_server = None
+
+      start = time.monotonic()
+      self._generate()
+      log.info("Generated a fake library of %d songs and %d playlists in %.3fs",
+               len(self.songs), len(self.playlists), time.monotonic() - start)
+
+   def _generate(self):
+      config = self.config
+      rng = self._rng
+      modified = _now_usecs()
+      self.songs = [_song(i, config, rng, modified) for i in range(config.songs)]
+      self.songs_by_id = {song['id']: song for song in self.songs}
+      self.store_tracks = {}
+      self.playlists = []
+      # playlist id -> entries
+      self.entries = {}
+      for index in range(config.playlists):
+         playlist_id = 'fake-pl-{:04d}'.format(index)
+         playlist = {
+            'kind': 'sj#playlist',
+            'id': playlist_id,
+            'name': 'Playlist {}'.format(index),
+            'type': 'USER_GENERATED',
+            'lastModifiedTimestamp': str(modified),
+            'deleted': False,
+         }
+         shared = config.shared_every and index % config.shared_every == 0
+         if shared:
+            playlist['type'] = 'SHARED'
+            playlist['shareToken'] = 'fake-share-{:04d}'.format(index)
+         self.playlists.append(playlist)
+
+         entries = []
+         size = min(config.playlist_size, config.songs) if config.songs else 0
+         for position, song_index in enumerate(rng.sample(range(config.songs), size)):
+            entry = {
+               'kind': 'sj#playlistEntry',
+               'id': '{}-{}'.format(playlist_id, position),
+               'playlistId': playlist_id,
+               'trackId': self.songs[song_index]['id'],
+               'absolutePosition': str(position * 1000),
+               'deleted': False,
+            }
+            if shared and position % 4 == 3:
+               track = _store_track(len(self.store_tracks), config)
+               self.store_tracks[track['storeId']] = track
+               entry['trackId'] = track['storeId']
+               entry['track'] = track
+            entries.append(entry)
+         self.entries[playlist_id] = entries
+
+   def __call__(self, http_session=None):
+      """Returns a new FakeMobileclient. http_session is accepted, as it is by
+      Client's default factory, but not used.
+      """
+      return FakeMobileclient(self)
+
+   def touch_songs(self, count):
+      """Marks count random songs as modified now, so that the next
+      incremental sync fetches them
+      """
+      modified = str(_now_usecs())
+      with self._lock:
+         for song in self._rng.sample(self.songs, min(count, len(self.songs))):
+            song['lastModifiedTimestamp'] = modified
+
+   def request(self, endpoint):
+      """Waits for the latency of one request to endpoint, and may fail it"""
+      config = self.config
+      with self._lock:
+         self.requests += 1
+         delay = config.latency + self._rng.uniform(0, config.jitter)
+         fail = (config.failure_rate > 0 and
+                 (self._failure_re is None or self._failure_re.search(endpoint)) and
+                 self._rng.random() < config.failure_rate)
+         if fail:
+            self.failures += 1
+      if delay > 0:
+         time.sleep(delay)
+      if fail:
+         raise_fault(config.failure, endpoint)
+
+   def audio_server(self):
+      with self._lock:
+         if self._audio_server is None:
+            self._audio_server = start_audio_server(self.config.track_secs,
+                                                     throttle=self.throttle)
+         return self._audio_server
+
+   def stats(self):
+      with self._lock:
+         return {'requests': self.requests, 'failures': self.failures}
+
+   def shutdown(self):
+      with self._lock:
+         if self._audio_server is not None:
+            self._audio_server.shutdown()
+            self._audio_server.server_close()
+            self._audio_server = None
+
+class FakeMobileclient:
+   """Answers the Mobileclient methods which gpmp uses from a FakeBackend"""
+   OAUTH_FILEPATH = os.devnull
+   FROM_MAC_ADDRESS = object()
+
+   def __init__(self, backend):
+      self.backend = backend
+      self._authenticated = False
+
+   def is_authenticated(self):
+      return self._authenticated
+
+   def perform_oauth(self, storage_filepath=None, open_browser=False): # pylint: disable-msg=unused-argument
+      return None
+
+   def oauth_login(self, device_id, oauth_credentials=None, locale='en_US'): # pylint: disable-msg=unused-argument
+      self.backend.request('oauth_login')
+      self._authenticated = True
+      return True
+
+   def logout(self):
+      self._authenticated = False
+      return True
+
+   def _make_call(self, endpoint, func=lambda: None):
+      """Makes one request to endpoint, and returns func(). As in gmusicapi,
+      every request goes through here, which Client relies on to retry the
+      pages of paged calls one at a time.
+      """
+      if not self._authenticated:
+         _, not_logged_in = api_errors()
+         raise not_logged_in()
+      self.backend.request(endpoint)
+      return func()
+
+   def _pages(self, endpoint, items):
+      """Yields items a page at a time, each from a request"""
+      page_size = max(self.backend.config.page_size, 1)
+      for start in range(0, max(len(items), 1), page_size):
+         yield self._make_call(endpoint,
+                               lambda start=start: items[start:start + page_size])
+
+   def _paged(self, endpoint, items, incremental):
+      pages = self._pages(endpoint, items)
+      if incremental:
+         return pages
+      return [item for page in pages for item in page]
+
+   @staticmethod
+   def _changed(items, include_deleted, updated_after):
+      if updated_after is None:
+         return [dict(item) for item in items if include_deleted or not item['deleted']]
+      after = int(updated_after.timestamp() * 1e6)
+      return [dict(item) for item in items
+              if int(item['lastModifiedTimestamp']) > after]
+
+   def get_all_songs(self, incremental=False, include_deleted=None, updated_after=None):
+      with self.backend._lock: # pylint: disable-msg=protected-access
+         songs = self._changed(self.backend.songs, include_deleted, updated_after)
+      return self._paged('get_all_songs', songs, incremental)
+
+   def get_all_playlists(self, incremental=False, include_deleted=None, updated_after=None):
+      playlists = self._changed(self.backend.playlists, include_deleted, updated_after)
+      return self._paged('get_all_playlists', playlists, incremental)
+
+   def get_all_user_playlist_contents(self):
+      backend = self.backend
+      entries = [entry for playlist in backend.playlists
+                 if playlist['type'] == 'USER_GENERATED'
+                 for entry in backend.entries[playlist['id']]]
+      # The entries are fetched in pages, and grouped by playlist
+      list(self._pages('get_all_user_playlist_contents', entries))
+      return [dict(playlist, tracks=[dict(e) for e in backend.entries[playlist['id']]])
+              for playlist in backend.playlists if playlist['type'] == 'USER_GENERATED']
+
+   def get_shared_playlist_contents(self, share_token):
+      self._make_call('get_shared_playlist_contents')
+      for playlist in self.backend.playlists:
+         if playlist.get('shareToken') == share_token:
+            return [dict(e) for e in self.backend.entries[playlist['id']]]
+      call_failure, _ = api_errors()
+      raise call_failure("404 Client Error: No playlist with share token " + share_token,
+                         'get_shared_playlist_contents')
+
+   def get_stream_url(self, song_id, device_id=None, quality='hi'): # pylint: disable-msg=unused-argument
+      self._make_call('get_stream_url')
+      if song_id not in self.backend.songs_by_id and song_id not in self.backend.store_tracks:
+         call_failure, _ = api_errors()
+         # As gmusicapi raises it, from the server's response
+         raise call_failure("404 Client Error: Not Found for track " + song_id,
+                            'get_stream_url')
+      host, port = self.backend.audio_server().server_address[:2]
+      return 'http://{}:{}/stream/{}.wav?expire={}'.format(
+         host, port, song_id, int(time.time()) + self.backend.config.stream_url_ttl)
+
+_SAMPLE_RATE = 8000
+
+def tone_wav(song_id, secs):
+   """Returns a WAV file of a tone, whose pitch depends on song_id, as
+   8-bit mono audio
+   """
+   # One second of a whole number of cycles, repeated
+   freq = 220 + sum(song_id.encode()) % 440
+   second = bytes(int(128 + 60 * math.sin(2 * math.pi * freq * i / _SAMPLE_RATE))
+                  for i in range(_SAMPLE_RATE))
+   data = second * secs
+   header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + len(data), b'WAVE',
+                        b'fmt ', 16, 1, 1, _SAMPLE_RATE, _SAMPLE_RATE, 1, 8,
+                        b'data', len(data))
+   return header + data
+
+_CHUNK_SIZE = 16 * 1024
+
+def start_audio_server(track_secs, host='127.0.0.1', port=0, throttle=None):
+   """Serves /stream/<song id>.wav?expire=<unix time> on a background thread,
+   refusing urls which have expired, and sending no faster than throttle
+   allows if given. Returns the server, whose shutdown() stops it.
+   """
+   # pylint: disable-msg=import-outside-toplevel
+   from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+   class AudioHandler(BaseHTTPRequestHandler):
+      def do_GET(self): # pylint: disable-msg=invalid-name
+         url = urlparse(self.path)
+         match = re.fullmatch(r'/stream/([^/]+)\.wav', url.path)
+         expire = parse_qs(url.query).get('expire')
+         if match is None or not expire:
+            self.send_error(404)
+            return
+         if float(expire[0]) < time.time():
+            self.send_error(403, "Expired")
+            return
+         body = tone_wav(match.group(1), track_secs)
+         self.send_response(200)
+         self.send_header('Content-Type', 'audio/wav')
+         self.send_header('Content-Length', str(len(body)))
+         self.end_headers()
+         for start in range(0, len(body), _CHUNK_SIZE):
+            chunk = body[start:start + _CHUNK_SIZE]
+            if throttle is not None:
+               throttle.consume(len(chunk))
+            try:
+               self.wfile.write(chunk)
+            except OSError:
+               # The player stopped reading
+               return
+
+      def log_message(self, format, *args): # pylint: disable-msg=redefined-builtin
+         log.debug("Fake audio server: " + format, *args)
+
+   server = ThreadingHTTPServer((host, port), AudioHandler)
+   server.daemon_threads = True
+   threading.Thread(target=server.serve_forever, name="fake-audio", daemon=True).start()
+   log.info("Serving fake audio on http://%s:%d/stream/", host, server.server_address[1])
+   return server
@@ -1,24 +1,82 @@
 """Logic and layouts for Qt GUI"""
 
+import importlib.util
+import json
+import os
 import pdb # pylint: disable-msg=unused-import
-from time import sleep
+import sys
 
-import qdarkstyle
 from PySide2 import QtCore, QtWidgets, QtGui
 from PySide2.QtWidgets import QSizePolicy
 
 import gpmp.log
+from gpmp.artwork import ArtworkCache
+from gpmp.cache import user_cache_dir
+from gpmp.loader import PRIORITY_USER, LoaderService
 from gpmp.log import get_logger
-from gpmp.player import Library, TrackTimingInfo, TrackPlayer
-from gpmp.widgets import MediaSlider
+from gpmp.player import (STATE_PLAYING, STATE_SONG_INFO, STATE_TRACK_INDEX, Library,
+                         TrackTimingInfo, TrackPlayer)
+from gpmp.playqueue import RESET, QueueChange
+from gpmp.tracklist import TrackListModel
+from gpmp.widgets import MediaSlider, TrackListView
 
 log = get_logger()
 
+# Album art thumbnail sizes, in pixels
+TRACK_LIST_ART_SIZE = 24
+NOW_PLAYING_ART_SIZE = 96
+
+DARK_STYLESHEET_CACHE_FILE = os.path.join(user_cache_dir(), "dark_stylesheet.json")
+
 def seconds_to_minutes_str(secs):
    mins = int(secs / 60)
    secs = int(secs) % 60
    return "{}:{:02d}".format(mins, secs)
 
+def _qdarkstyle_version_key():
+   """Identifies the installed qdarkstyle without importing it"""
+   spec = importlib.util.find_spec('qdarkstyle')
+   if spec is None or spec.origin is None:
+      return None
+   stat = os.stat(spec.origin)
+   return [spec.origin, stat.st_mtime_ns, stat.st_size]
+
+def load_dark_stylesheet(cache_file=DARK_STYLESHEET_CACHE_FILE):
+   """Returns qdarkstyle's stylesheet for PySide2.
+
+   qdarkstyle reads the stylesheet out of its compiled resources and patches
+   it each time, so it is cached on disk for the installed version. A cached
+   stylesheet only needs qdarkstyle's resource modules, for its images.
+   """
+   key = _qdarkstyle_version_key()
+   try:
+      with open(cache_file) as f:
+         cached = json.load(f)
+      if cached['key'] == key:
+         # The resources import their Qt binding through qtpy with newer
+         # versions of qdarkstyle.
+         os.environ['QT_API'] = 'pyside2'
+         for name in cached['resource_modules']:
+            importlib.import_module(name)
+         return cached['stylesheet']
+   except (OSError, ValueError, KeyError, ImportError) as e:
+      log.debug("Not using cached dark stylesheet: %r", e)
+
+   import qdarkstyle # pylint: disable-msg=import-outside-toplevel
+   stylesheet = qdarkstyle.load_stylesheet_pyside2()
+   resource_modules = sorted(name for name in sys.modules
+                             if name.startswith('qdarkstyle.') and name.endswith('_rc'))
+   try:
+      os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+      part_file = cache_file + ".part"
+      with open(part_file, 'w') as f:
+         json.dump({'key': key, 'resource_modules': resource_modules,
+                    'stylesheet': stylesheet}, f)
+      os.replace(part_file, cache_file)
+   except OSError as e:
+      log.warning("Failed to cache dark stylesheet: %r", e)
+   return stylesheet
+
 class Settings:
    def __init__(self):
       self.settings = QtCore.QSettings("gplaymusicplayer")
@@ -52,18 +110,23 @@ class TextEditDialog(QtWidgets.QWidget):
 class Window(QtWidgets.QMainWindow):
    key_pressed_signal = QtCore.Signal(QtGui.QKeyEvent)
    theme_changed_signal = QtCore.Signal(str)
+   # Emitted with whether the window can be seen, when that changes
+   visibility_changed_signal = QtCore.Signal(bool)
 
-   def __init__(self, theme):
+   def __init__(self, theme, artwork: ArtworkCache = None):
       super().__init__()
       self.set_window_title()
       self.settings = Settings()
       self.theme_actions = {}
-      self.widget = WindowContent()
+      self.widget = WindowContent(artwork)
       self.setCentralWidget(self.widget)
       self.layout_menu()
       self.set_checked_theme(theme)
       self.log_dialog = None
       self.timeout_debug_action_changed_func = lambda checked: None
+      self.latency_debug_action_changed_func = lambda checked: None
+      self.bandwidth_debug_action_changed_func = lambda checked: None
+      self.timeline_debug_action_changed_func = lambda checked: None
 
    def layout_menu(self):
       mb = self.menuBar()
@@ -95,11 +158,41 @@ class Window(QtWidgets.QMainWindow):
       timeout_debug_action.triggered.connect(self.on_timeout_debug_action_checkbox)
       tools_menu.addAction(timeout_debug_action)
 
+      self.latency_debug_action = tools_menu.addAction("Simulate API Latency")
+      self.latency_debug_action.setCheckable(True)
+      self.latency_debug_action.triggered.connect(self.on_latency_debug_action_checkbox)
+
+      self.bandwidth_debug_action = tools_menu.addAction("Simulate Slow Downloads")
+      self.bandwidth_debug_action.setCheckable(True)
+      self.bandwidth_debug_action.triggered.connect(self.on_bandwidth_debug_action_checkbox)
+
+      # Only enabled if a timeline was given on the command line
+      self.timeline_debug_action = tools_menu.addAction("Run Fault Timeline")
+      self.timeline_debug_action.setCheckable(True)
+      self.timeline_debug_action.setEnabled(False)
+      self.timeline_debug_action.triggered.connect(self.on_timeline_debug_action_checkbox)
+
    # Overrides
    def keyPressEvent(self, event):
       super(Window, self).keyPressEvent(event)
       self.key_pressed_signal.emit(event)
 
+   def showEvent(self, event):
+      super().showEvent(event)
+      self.visibility_changed_signal.emit(self.is_visible_on_screen())
+
+   def hideEvent(self, event):
+      super().hideEvent(event)
+      self.visibility_changed_signal.emit(False)
+
+   def changeEvent(self, event):
+      super().changeEvent(event)
+      if event.type() == QtCore.QEvent.WindowStateChange:
+         self.visibility_changed_signal.emit(self.is_visible_on_screen())
+
+   def is_visible_on_screen(self):
+      return self.isVisible() and not self.isMinimized()
+
    def set_checked_theme(self, theme):
       if theme not in self.theme_actions:
          return
@@ -134,14 +227,24 @@ class Window(QtWidgets.QMainWindow):
    def on_timeout_debug_action_checkbox(self, checked):
       self.timeout_debug_action_changed_func(checked)
 
+   def on_latency_debug_action_checkbox(self, checked):
+      self.latency_debug_action_changed_func(checked)
+
+   def on_bandwidth_debug_action_checkbox(self, checked):
+      self.bandwidth_debug_action_changed_func(checked)
+
+   def on_timeline_debug_action_checkbox(self, checked):
+      self.timeline_debug_action_changed_func(checked)
+
 class WindowContent(QtWidgets.QWidget):
    # pylint: disable-msg=too-many-instance-attributes
    progress_bar_max = 500
 
    AllSongsItem = object()
 
-   def __init__(self):
+   def __init__(self, artwork: ArtworkCache = None):
       super().__init__()
+      self.artwork = artwork
       self.layout_player()
 
    # pylint: disable-msg=too-many-statements,attribute-defined-outside-init
@@ -153,18 +256,31 @@ class WindowContent(QtWidgets.QWidget):
       self.playlist_list.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
 
       self.selected_track_index = None
-      self.track_list = QtWidgets.QListView()
+      self.track_list = TrackListView()
       self.track_list.setAlternatingRowColors(True)
-      self.track_list_model = QtGui.QStandardItemModel()
+      self.track_list_model = TrackListModel(artwork=self.artwork,
+                                             art_size=TRACK_LIST_ART_SIZE)
       self.track_list.setModel(self.track_list_model)
+      if self.artwork is not None:
+         self.track_list.set_icon_size(TRACK_LIST_ART_SIZE)
       self.track_list.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
       self.track_list.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+      self.track_list.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
+
+      self.search_box = QtWidgets.QLineEdit()
+      self.search_box.setPlaceholderText("Search")
+      self.search_box.setClearButtonEnabled(True)
 
       self.track_info = QtWidgets.QLabel("Unknown - Unknown")
       self.track_info.setAlignment(QtCore.Qt.AlignHCenter)
       sp = QSizePolicy(QSizePolicy.Minimum, QSizePolicy.Maximum)
       self.track_info.setSizePolicy(sp)
 
+      self.album_art = QtWidgets.QLabel()
+      self.album_art.setFixedSize(NOW_PLAYING_ART_SIZE, NOW_PLAYING_ART_SIZE)
+      self.album_art.setAlignment(QtCore.Qt.AlignCenter)
+      self.album_art.setVisible(self.artwork is not None)
+
       self.progress_bar = MediaSlider()
       self.progress_bar.setOrientation(QtCore.Qt.Horizontal)
       self.progress_bar.setTickInterval(1)
@@ -206,9 +322,20 @@ class WindowContent(QtWidgets.QWidget):
       self.button_layout.addWidget(self.play_pause_button)
       self.button_layout.addWidget(self.next_button)
 
+      self.track_list_layout = QtWidgets.QVBoxLayout()
+      self.track_list_layout.setContentsMargins(0, 0, 0, 0)
+      self.track_list_layout.addWidget(self.search_box)
+      self.track_list_layout.addWidget(self.track_list)
+      self.track_list_container = QtWidgets.QWidget()
+      self.track_list_container.setLayout(self.track_list_layout)
+
+      self.now_playing_layout = QtWidgets.QHBoxLayout()
+      self.now_playing_layout.addWidget(self.album_art)
+      self.now_playing_layout.addWidget(self.track_info, 1)
+
       self.upper_layout = QtWidgets.QSplitter()
       self.upper_layout.addWidget(self.playlist_list)
-      self.upper_layout.addWidget(self.track_list)
+      self.upper_layout.addWidget(self.track_list_container)
       self.upper_layout.setSizes([200, 300])
 
       self.loading_status_layout = QtWidgets.QHBoxLayout()
@@ -217,7 +344,7 @@ class WindowContent(QtWidgets.QWidget):
 
       self.layout = QtWidgets.QVBoxLayout()
       self.layout.addWidget(self.upper_layout)
-      self.layout.addWidget(self.track_info)
+      self.layout.addLayout(self.now_playing_layout)
       self.layout.addWidget(self.progress_bar)
       self.layout.addLayout(self.button_layout)
       self.layout.addLayout(self.loading_status_layout)
@@ -250,6 +377,12 @@ class WindowContent(QtWidgets.QWidget):
       if song_info is not None:
          self.track_info.setText(song_info)
 
+   def set_album_art(self, image: QtGui.QImage = None):
+      if image is None:
+         self.album_art.clear()
+      else:
+         self.album_art.setPixmap(QtGui.QPixmap.fromImage(image))
+
    def set_playlist_list_content(self, playlists):
       self.playlist_list_model.clear()
       item = QtGui.QStandardItem("All Songs")
@@ -265,36 +398,34 @@ class WindowContent(QtWidgets.QWidget):
          item.setData(playlist)
          self.playlist_list_model.appendRow(item)
 
-   def set_track_list_content(self, song_ids, library):
-      self.track_list_model.clear()
-      unknown_song_str = "Unknown - Unknown"
-      for song_id in song_ids:
-         song_info = library.songs.get(song_id)
-         song_str = unknown_song_str
-         if song_info:
-            song_str = "{0} - {1}".format(song_info['title'], song_info['artist'])
-         else:
-            log.error("Could not find track info for %s", song_id)
-
-         item = QtGui.QStandardItem(song_str)
-         self.track_list_model.appendRow(item)
+   def set_track_list_content(self, song_ids, library, selected_index=0):
+      """song_ids is shown as it is, not copied"""
+      self.track_list_model.set_tracks(song_ids, library)
+      self.selected_track_index = None
 
       # first track always auto-plays right now
-      self.set_selected_track_in_list(0)
+      if selected_index is not None and selected_index < len(song_ids):
+         self.set_selected_track_in_list(selected_index)
+
+   def apply_queue_change(self, change: QueueChange):
+      """Updates just the rows of the track list affected by a change to the
+      queue it is showing.
+      """
+      self.track_list_model.apply_queue_change(change)
+      self.selected_track_index = change.adjust(self.selected_track_index)
 
    def set_selected_track_in_list(self, index, unselect=False):
       log.debug("index: %r, unselect: %r", index, unselect)
-      if not unselect and self.selected_track_index is not None:
-         self.set_selected_track_in_list(self.selected_track_index, unselect=True)
-
-      qindex = self.track_list_model.item(index).index()
-      rect = self.track_list.rectForIndex(qindex)
-
+      selection = self.track_list.selectionModel()
       if unselect:
-         self.track_list.setSelection(rect, QtCore.QItemSelectionModel.Clear)
-      else:
-         self.track_list.setSelection(rect, QtCore.QItemSelectionModel.Select)
+         selection.clearSelection()
+         self.selected_track_index = None
+         return
 
+      qindex = self.track_list_model.index(index)
+      if not qindex.isValid():
+         return
+      selection.select(qindex, QtCore.QItemSelectionModel.ClearAndSelect)
       self.selected_track_index = index
 
    def set_loading_status(self, loading_status_str):
@@ -304,93 +435,54 @@ class WindowContent(QtWidgets.QWidget):
          self.loading_text.setText(loading_status_str)
 
 class LibraryLoaderWorkerObject(QtCore.QObject):
-   load_library_done_signal = QtCore.Signal()
-   load_playlists_done_signal = QtCore.Signal()
+   """Relays library loading progress from the startup scheduler's and the
+   loader service's threads to the GUI thread.
+   """
+   startup_stage_done_signal = QtCore.Signal(str, bool)
+   load_library_progress_signal = QtCore.Signal(int)
+   load_playlists_progress_signal = QtCore.Signal(int)
+
+   load_playlist_done_signal = QtCore.Signal(str, bool)
 
-   def __init__(self, player: TrackPlayer, library: Library,
+   def __init__(self, player: TrackPlayer, library: Library, loader: LoaderService,
                 parent=None):
       super().__init__(parent)
       self.player = player
       self.library = library
+      self.loader = loader
 
-   def load_library(self):
-      log.debug("")
-      try:
-         self.player.initialize()
+   def on_startup_stage_done(self, stage, error):
+      self.startup_stage_done_signal.emit(stage, error is None)
 
-         self.library.load_core()
+   def on_startup_progress(self, stage, n_done):
+      if stage == 'songs':
+         self.load_library_progress_signal.emit(n_done)
+      elif stage == 'playlist_contents':
+         self.load_playlists_progress_signal.emit(n_done)
 
-         log.debug("done")
-         self.load_library_done_signal.emit()
-      except Exception as e: # pylint: disable-msg=broad-except
-         print("load_library caught exception", e)
-         log.error("caught exception: %s", e)
-
-   def load_playlist_contents(self):
-      log.debug("")
-      try:
-         self.library.load_playlist_contents()
-
-         log.debug("done")
-         self.load_playlists_done_signal.emit()
-      except Exception as e: # pylint: disable-msg=broad-except
-         print("load_playlist_contents caught exception", e)
-         log.error("caught exception: %s", e)
-
-class PlayerStateMonitorThread(QtCore.QThread):
-   prog_signal = QtCore.Signal(TrackTimingInfo)
-   song_index_signal = QtCore.Signal(int)
-   song_info_signal = QtCore.Signal(str)
-
-   def __init__(self, player: TrackPlayer):
-      QtCore.QThread.__init__(self)
-
-      self.player = player
-      self.current_song_index = None
-      self.current_song_info = None
-      self.interrupted = False
-      self.run_exited = False
-
-   def __del__(self):
-      if not self.run_exited:
-         self.wait()
-
-   def interrupt(self):
-      self.interrupted = True
-
-   def send_ui_update_signal(self):
-      if self.player is not None:
-         self.prog_signal.emit(self.player.get_timing_info())
-
-         player_current_song_index = self.player.current_track_index.value
-         if player_current_song_index != self.current_song_index:
-            self.current_song_index = player_current_song_index
-            self.song_index_signal.emit(player_current_song_index)
-
-         player_current_song_info = self.player.current_song_info.value
-         if player_current_song_info != self.current_song_info:
-            self.current_song_info = player_current_song_info
-            self.song_info_signal.emit(player_current_song_info)
-
-   def run(self):
-      log.debug("WorkerThread.run")
-      while not self.interrupted:
-         sleep(0.5)
-         self.send_ui_update_signal()
-
-      log.info("WorkerThread interrupted")
-      self.run_exited = True
+   def load_playlist(self, playlist_id):
+      """Loads a playlist ahead of any background loading. Returns the job."""
+      log.debug(playlist_id)
+      job = self.library.submit_playlist_load(self.loader, playlist_id,
+                                              priority=PRIORITY_USER)
+      job.add_done_callback(
+         lambda job: self.load_playlist_done_signal.emit(playlist_id,
+                                                         job.error() is None))
+      return job
 
 class QtController(QtCore.QObject):
    # pylint: disable-msg=too-many-instance-attributes
 
    worker_start_signal = QtCore.Signal()
-   load_player_start_signal = QtCore.Signal()
-   load_playlists_start_signal = QtCore.Signal()
-
-   worker_interrupt_signal = QtCore.Signal()
-
-   def __init__(self, qapp, api, player, init_player=True):
+   # Relays changes to the player's queue to the GUI thread
+   queue_changed_signal = QtCore.Signal(QueueChange)
+   # Relays the player's state changes to the GUI thread
+   player_state_signal = QtCore.Signal(str, object)
+   # Relays album art finishing loading to the GUI thread
+   art_loaded_signal = QtCore.Signal(str, int)
+
+   def __init__(self, qapp, api, player, startup=None, progress_interval_ms=500,
+                loader: LoaderService = None, artwork: ArtworkCache = None):
       # Note qapp is being used as the parent attribute in the super
       super().__init__(qapp)
 
@@ -398,14 +490,30 @@ class QtController(QtCore.QObject):
 
       self.api = api
       self.player = player
-      self.init_player = init_player
+      # The StartupScheduler loading the library, or None if not loading it.
+      self.startup = startup
+      self.loader = loader if loader is not None else LoaderService()
+      self.artwork = artwork
+      # Album art url of the track playing, or None
+      self.now_playing_art_url = None
 
       self.library = self.player.library
 
+      # (playlist id, action, loader job) for the playlist the user last
+      # opened, while it loads
       self.pending_playlist_action = None
+      # The progress bar is only updated on a timer while a track is playing
+      # and the window can be seen.
+      self.progress_timer = QtCore.QTimer(self)
+      self.progress_timer.setInterval(progress_interval_ms)
+      self.progress_timer.timeout.connect(self.update_progress)
+      self.playing = False
+      self.window_visible = False
+      # Song ids shown in the track list while searching, or None
+      self.search_results = None
 
       # Create a gui object.
-      self.window = Window(self.settings.theme())
+      self.window = Window(self.settings.theme(), artwork=artwork)
       self.gui = self.window.widget
       self.window.resize(500, 500)
 
@@ -434,76 +542,138 @@ class QtController(QtCore.QObject):
 
       self.gui.playlist_list.doubleClicked.connect(self.handle_playlist_item_click)
       self.gui.track_list.doubleClicked.connect(self.handle_track_item_click)
+      self.gui.track_list.customContextMenuRequested.connect(
+         self.handle_track_list_context_menu)
+      if self.player:
+         self.queue_changed_signal.connect(self.handle_queue_changed)
+         self.player.tracks_to_play.change_callbacks.append(self.queue_changed_signal.emit)
+      self.gui.search_box.textChanged.connect(self.handle_search_text_changed)
       self.gui.progress_bar.sliderReleased.connect(self.handle_track_progress_bar_change)
 
       self.window.theme_changed_signal.connect(self.set_theme)
+      self.window.visibility_changed_signal.connect(self.handle_window_visibility_changed)
       self.window.key_pressed_signal.connect(self.on_window_key_press)
+      if self.artwork is not None:
+         self.art_loaded_signal.connect(self.handle_art_loaded)
+         self.artwork.loaded_callbacks.append(self.art_loaded_signal.emit)
       def _set_sim_timouts(enable):
          self.api.simulate_timeouts = enable
       self.window.timeout_debug_action_changed_func = _set_sim_timouts
 
+      def _set_sim_latency(enable):
+         self.api.simulate_latency = enable
+      self.window.latency_debug_action_changed_func = _set_sim_latency
+      self.window.latency_debug_action.setChecked(self.api.simulate_latency)
+
+      self.window.bandwidth_debug_action_changed_func = self.api.set_simulated_bandwidth
+      self.window.bandwidth_debug_action.setChecked(self.api.download_throttle.rate > 0)
+
+      timeline = self.api.fault_timeline
+      if timeline is not None:
+         def _run_timeline(enable):
+            # Restarted from the beginning each time it is switched on
+            if enable:
+               timeline.start()
+            else:
+               timeline.stop()
+         self.window.timeline_debug_action_changed_func = _run_timeline
+         self.window.timeline_debug_action.setEnabled(True)
+         self.window.timeline_debug_action.setChecked(timeline.running)
+
    def create_worker_threads(self):
       self.parent().aboutToQuit.connect(self.force_worker_quit)
 
-      self.loader_worker = LibraryLoaderWorkerObject(self.player,
-                                                     self.library)
-      self.worker_thread = QtCore.QThread()
-      self.loader_worker.moveToThread(self.worker_thread)
-      self.loader_worker.load_library_done_signal.connect(self.handle_player_loaded)
-      self.loader_worker.load_playlists_done_signal.connect(
-         self.handle_playlists_loaded)
-      self.load_player_start_signal.connect(self.loader_worker.load_library)
-      self.load_playlists_start_signal.connect(
-         self.loader_worker.load_playlist_contents)
-      self.worker_thread.start()
-
-      if self.init_player:
+      self.loader_worker = LibraryLoaderWorkerObject(self.player, self.library,
+                                                     self.loader)
+      self.loader_worker.startup_stage_done_signal.connect(
+         self.handle_startup_stage_done)
+      self.loader_worker.load_library_progress_signal.connect(
+         self.handle_library_load_progress)
+      self.loader_worker.load_playlists_progress_signal.connect(
+         self.handle_playlists_load_progress)
+      self.loader_worker.load_playlist_done_signal.connect(
+         self.handle_playlist_loaded)
+
+      if self.startup is not None:
          self.gui.set_loading_status("Loading library...")
-         self.load_player_start_signal.emit()
-      #  pdb.set_trace()
-      #  self.loader_worker.load_library()
-
-      self.custom_worker_thread = PlayerStateMonitorThread(self.player)
-      self.custom_worker_thread.prog_signal.connect(self.gui.update_progress)
-      self.custom_worker_thread.song_info_signal.connect(self.handle_song_info_changed)
-      self.custom_worker_thread.song_index_signal.connect(self.handle_song_changed)
-      self.custom_worker_thread.start()
+         self.startup.stage_done_callbacks.append(self.loader_worker.on_startup_stage_done)
+         self.startup.progress_callbacks.append(self.loader_worker.on_startup_progress)
+         self.startup.start()
 
-      # Connect any worker signals
-      #  self.worker.signalStatus.connect(self.gui.updateStatus)
-      #  self.gui.button_start.clicked.connect(self.worker.startWork)
-      self.worker_interrupt_signal.connect(self.custom_worker_thread.interrupt)
+      if self.player:
+         self.player_state_signal.connect(self.handle_player_state_changed)
+         self.player.state_callbacks.append(self.player_state_signal.emit)
 
    def force_worker_quit(self):
       try:
-         if self.worker_thread.isRunning():
-            # Gracefully quit, once the thread reaches the event loop
-            self.worker_thread.quit()
-            self.worker_thread.wait()
-
-         if self.custom_worker_thread.isRunning():
-            self.worker_interrupt_signal.emit()
-            self.custom_worker_thread.wait()
+         if self.pending_playlist_action is not None:
+            _, _, job = self.pending_playlist_action
+            self.pending_playlist_action = None
+            job.release()
+
+         self.progress_timer.stop()
+         if self.player:
+            self.player.state_callbacks.remove(self.player_state_signal.emit)
+         if self.artwork is not None:
+            self.artwork.loaded_callbacks.remove(self.art_loaded_signal.emit)
       except Exception as e: # pylint: disable-msg=broad-except
          log.error("caught exception: %s", e)
 
-   def load_playlists_and_do(self, action):
-      if self.library.playlist_contents:
+   def load_playlist_and_do(self, playlist_id, action):
+      if playlist_id in self.library.playlist_contents:
          action()
       else:
-         self.gui.set_loading_status("Loading playlists...")
-         self.pending_playlist_action = action
-         self.load_playlists_start_signal.emit()
-
-   def handle_player_loaded(self):
-      self.gui.set_loading_status(None)
-      self.gui.set_playlist_list_content(self.library.playlist_meta)
-
-   def handle_playlists_loaded(self):
-      self.gui.set_loading_status(None)
-      if self.pending_playlist_action:
-         self.pending_playlist_action()
+         # If the background fill is already fetching it, the worker waits for
+         # that rather than fetching it again.
+         self.gui.set_loading_status("Loading playlist...")
+         pending = self.pending_playlist_action
+         if pending is not None and pending[0] == playlist_id:
+            # Already loading it, so just do the new action when it is done
+            self.pending_playlist_action = (playlist_id, action, pending[2])
+            return
+         # Only the last playlist clicked on is opened. The old action is
+         # cleared before its job is released, as a cancelled job reports
+         # that it is done straight away, on this thread. The job keeps
+         # running if the background fill shares it.
          self.pending_playlist_action = None
+         if pending is not None:
+            pending[2].release()
+         job = self.loader_worker.load_playlist(playlist_id)
+         self.pending_playlist_action = (playlist_id, action, job)
+
+   def handle_startup_stage_done(self, stage, succeeded):
+      log.debug("%s succeeded: %r", stage, succeeded)
+      if not succeeded:
+         self.gui.set_loading_status("Failed to load {}".format(stage))
+         return
+
+      if stage == 'cache' and self.library.songs is not None:
+         self.gui.set_loading_status("Syncing library...")
+         self.gui.set_playlist_list_content(self.library.playlist_meta)
+      elif stage == 'playlists':
+         self.gui.set_playlist_list_content(self.library.playlist_meta)
+      elif stage == 'songs':
+         self.gui.set_loading_status(None)
+      elif stage == 'playlist_contents' and self.pending_playlist_action is None:
+         self.gui.set_loading_status(None)
+
+   def handle_library_load_progress(self, n_songs):
+      # "All Songs" can be played from whatever has loaded so far.
+      self.gui.set_loading_status("Loading library... ({} songs)".format(n_songs))
+
+   def handle_playlists_load_progress(self, n_playlists):
+      if self.pending_playlist_action is None:
+         self.gui.set_loading_status("Loading playlists... ({})".format(n_playlists))
+
+   def handle_playlist_loaded(self, playlist_id, succeeded):
+      if self.pending_playlist_action and self.pending_playlist_action[0] == playlist_id:
+         _, action, _ = self.pending_playlist_action
+         self.pending_playlist_action = None
+         if succeeded:
+            self.gui.set_loading_status(None)
+            action()
+         else:
+            self.gui.set_loading_status("Failed to load playlist")
 
    def handle_playlist_item_click(self, qindex):
       data = self.gui.playlist_list_model.item(qindex.row()).data()
@@ -512,19 +682,108 @@ class QtController(QtCore.QObject):
          self.play_all_songs()
       elif data is not None:
          _id = data['id']
-         self.load_playlists_and_do(lambda: self.play_playlist(_id))
+         self.load_playlist_and_do(_id, lambda: self.play_playlist(_id))
 
    def handle_track_item_click(self, qindex):
+      if self.search_results is not None:
+         # Play the search results, starting from the one clicked.
+         self.player.set_tracks_to_play(list(self.search_results))
+         self.gui.search_box.clear()
       self.player.play_track_at_index(qindex.row())
 
+   def handle_track_list_context_menu(self, pos):
+      qindex = self.gui.track_list.indexAt(pos)
+      if not qindex.isValid():
+         return
+      row = qindex.row()
+      menu = QtWidgets.QMenu(self.gui.track_list)
+      play_next_action = menu.addAction("Play Next")
+      remove_action = None
+      if self.search_results is None:
+         remove_action = menu.addAction("Remove From Queue")
+
+      action = menu.exec_(self.gui.track_list.viewport().mapToGlobal(pos))
+      if action is None:
+         return
+      if self.search_results is not None:
+         if action is play_next_action:
+            self.player.queue_next([self.search_results[row]])
+      elif action is play_next_action:
+         self.player.move_to_next(row)
+      elif action is remove_action:
+         self.player.tracks_to_play.remove(row)
+
+   def handle_queue_changed(self, change):
+      # Whole queue changes are shown by whoever made them, and the search
+      # results are shown in place of the queue while searching.
+      if change.kind == RESET or self.search_results is not None:
+         return
+      self.gui.apply_queue_change(change)
+
+   def handle_search_text_changed(self, text):
+      if text.strip():
+         self.search_results = self.library.search(text, limit=200)
+         self.gui.set_track_list_content(self.search_results, self.library,
+                                         selected_index=None)
+      elif self.search_results is not None:
+         self.search_results = None
+         self.gui.set_track_list_content(self.player.tracks_to_play, self.library,
+                                         selected_index=self.player.current_track_index.value)
+
    def handle_track_progress_bar_change(self):
       pos = self.gui.progress_bar.value() / WindowContent.progress_bar_max
       log.debug(pos)
       self.player.set_position(pos)
+      self.update_progress()
+
+   def update_progress(self):
+      self.gui.update_progress(self.player.get_timing_info())
+
+   def update_progress_timer(self):
+      if self.playing and self.window_visible:
+         if not self.progress_timer.isActive():
+            self.update_progress()
+            self.progress_timer.start()
+      elif self.progress_timer.isActive():
+         self.progress_timer.stop()
+         # Leave it showing where it stopped
+         self.update_progress()
+
+   def handle_window_visibility_changed(self, visible):
+      self.window_visible = visible
+      self.update_progress_timer()
+
+   def handle_player_state_changed(self, key, value):
+      if key == STATE_TRACK_INDEX:
+         self.handle_song_changed(value)
+      elif key == STATE_SONG_INFO:
+         self.handle_song_info_changed(value)
+      elif key == STATE_PLAYING:
+         self.playing = value
+         self.update_progress_timer()
 
    def handle_song_changed(self, index):
-      if index is not None:
+      if index is not None and self.search_results is None:
          self.gui.set_selected_track_in_list(index)
+      self.update_now_playing_art(index)
+
+   def update_now_playing_art(self, index):
+      if self.artwork is None:
+         return
+      url = None
+      if index is not None:
+         try:
+            url = self.library.album_art_url(self.player.tracks_to_play[index])
+         except IndexError:
+            pass
+      self.now_playing_art_url = url
+      self.gui.set_album_art(self.artwork.get(url, NOW_PLAYING_ART_SIZE,
+                                              priority=PRIORITY_USER))
+
+   def handle_art_loaded(self, url, size):
+      self.gui.track_list_model.art_loaded(url, size)
+      if url == self.now_playing_art_url and size == NOW_PLAYING_ART_SIZE:
+         self.gui.set_album_art(self.artwork.get(url, size))
 
    def handle_song_info_changed(self, song_info):
       self.gui.set_song_info(song_info)
@@ -532,7 +791,7 @@ class QtController(QtCore.QObject):
 
    def set_theme(self, theme):
       if theme == "dark":
-         self.app.setStyleSheet(qdarkstyle.load_stylesheet_pyside2())
+         self.app.setStyleSheet(load_dark_stylesheet())
       else:
          self.app.setStyleSheet("")
 
@@ -548,13 +807,13 @@ class QtController(QtCore.QObject):
 
    def play_all_songs(self):
       log.debug("")
-      track_ids = list(self.library.songs.keys())
-
-      self.player.set_tracks_to_play(track_ids)
-      self.player.shuffle_tracks()
+      if not self.library.songs:
+         log.info("No songs loaded yet")
+         return
+      self.player.set_tracks_to_play(self.library.songs.ids, shuffle=True)
       self.player.play_next_track()
 
-      self.gui.set_track_list_content(track_ids, self.library)
+      self.gui.set_track_list_content(self.player.tracks_to_play, self.library)
 
    def play_playlist(self, playlist_id):
       log.debug(playlist_id)
@@ -563,11 +822,10 @@ class QtController(QtCore.QObject):
          log.error("Unable to find playlist %s", playlist_id)
          return
 
-      self.player.set_tracks_to_play(track_ids)
-      self.player.shuffle_tracks()
+      self.player.set_tracks_to_play(track_ids, shuffle=True)
       self.player.play_next_track()
 
-      self.gui.set_track_list_content(track_ids, self.library)
+      self.gui.set_track_list_content(self.player.tracks_to_play, self.library)
 
 def make_app():
    return QtWidgets.QApplication([])
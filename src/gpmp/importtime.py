@@ -0,0 +1,135 @@
+"""Measurement of the modules imported before the player starts
+
+The imports are timed in a fresh interpreter run with python -X importtime,
+so that nothing is already loaded, and reported in the same terms.
+"""
+
+from dataclasses import dataclass, field
+import os
+import subprocess
+import sys
+
+# Slow modules which are only imported in the background once started, or on
+# first use. They should not be imported before the UI is up.
+DEFERRED_MODULES = ('gmusicapi', 'vlc', 'system_hotkey', 'requests', 'psutil',
+                    'qdarkstyle')
+
+GUI_STARTUP_MODULES = ('main', 'gpmp.gui')
+CLI_STARTUP_MODULES = ('main', 'gpmp.cliui')
+# Not needed at all without the GUI
+GUI_MODULES = ('PySide2',)
+
+_START_MARKER = "gpmp-importtime: start"
+_DEFERRED_MARKER = "gpmp-importtime: deferred"
+_LOADED_PREFIX = "gpmp-importtime: loaded "
+
+_CHILD_CODE = """
+import sys
+sys.stderr.write({start!r} + "\\n"); sys.stderr.flush()
+for name in {modules!r}:
+   __import__(name)
+sys.stderr.write({loaded!r} + ",".join(
+   name for name in {watched!r} if name in sys.modules) + "\\n")
+sys.stderr.write({deferred!r} + "\\n"); sys.stderr.flush()
+for name in {deferred_modules!r}:
+   try:
+      __import__(name)
+   except Exception:
+      pass
+"""
+
+@dataclass
+class ImportTime:
+   name: str
+   self_us: int
+   cumulative_us: int
+   depth: int
+
+@dataclass
+class ImportReport:
+   startup: list = field(default_factory=list)
+   deferred: list = field(default_factory=list)
+   # Modules which should not have been imported at startup, but were
+   imported_early: list = field(default_factory=list)
+
+   @property
+   def startup_ms(self):
+      return sum(t.cumulative_us for t in self.startup if t.depth == 0) / 1000
+
+def _parse_line(line):
+   """Parses a "import time: self | cumulative | name" line"""
+   try:
+      self_us, cumulative_us, name = line[len("import time:"):].split('|')
+      stripped = name.lstrip(' ')
+      # One space after the bar, then two per level of nesting
+      depth = (len(name) - len(stripped) - 1) // 2
+      return ImportTime(stripped, int(self_us), int(cumulative_us), depth)
+   except ValueError:
+      # The header line
+      return None
+
+def measure_imports(modules, deferred=DEFERRED_MODULES, forbidden=DEFERRED_MODULES):
+   """Imports modules, and then deferred, in a new interpreter with the same
+   sys.path as this one. Any of forbidden imported by modules are listed in
+   the report's imported_early.
+   """
+   code = _CHILD_CODE.format(start=_START_MARKER, modules=tuple(modules),
+                             loaded=_LOADED_PREFIX, watched=tuple(forbidden),
+                             deferred=_DEFERRED_MARKER,
+                             deferred_modules=tuple(deferred))
+   env = dict(os.environ)
+   env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+   proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                         env=env, stderr=subprocess.PIPE, universal_newlines=True,
+                         check=True)
+
+   report = ImportReport()
+   phase = None
+   for line in proc.stderr.splitlines():
+      if line == _START_MARKER:
+         phase = report.startup
+      elif line == _DEFERRED_MARKER:
+         phase = report.deferred
+      elif line.startswith(_LOADED_PREFIX):
+         report.imported_early = [name for name in line[len(_LOADED_PREFIX):].split(',')
+                                  if name]
+      elif phase is not None and line.startswith("import time:"):
+         import_time = _parse_line(line)
+         if import_time is not None:
+            phase.append(import_time)
+   return report
+
+def format_report(report, top=15):
+   lines = ["Startup imports: {:.1f}ms".format(report.startup_ms),
+            "  cumulative      self  module"]
+   slowest = sorted(report.startup, key=lambda t: t.cumulative_us, reverse=True)
+   for t in slowest[:top]:
+      lines.append("  {:8.1f}ms {:7.1f}ms  {}".format(
+         t.cumulative_us / 1000, t.self_us / 1000, t.name))
+
+   lines.append("Deferred imports:")
+   for t in report.deferred:
+      if t.depth == 0:
+         lines.append("  {:8.1f}ms  {}".format(t.cumulative_us / 1000, t.name))
+   if report.imported_early:
+      lines.append("Imported at startup, but should not be: {}".format(
+         ', '.join(report.imported_early)))
+   return '\n'.join(lines)
+
+def check_startup_imports(gui=True, budget_ms=None):
+   """Prints a report of the imports made before the player starts in GUI or
+   CLI mode. Returns False if any deferred module was imported at startup,
+   or the imports took longer than budget_ms.
+   """
+   if gui:
+      report = measure_imports(GUI_STARTUP_MODULES)
+   else:
+      report = measure_imports(CLI_STARTUP_MODULES,
+                               forbidden=DEFERRED_MODULES + GUI_MODULES)
+   print(format_report(report))
+   ok = not report.imported_early
+   if budget_ms is not None:
+      within = report.startup_ms <= budget_ms
+      print("{} the budget of {:.0f}ms".format("Within" if within else "Over", budget_ms))
+      ok = ok and within
+   return ok
@@ -0,0 +1,260 @@
+"""Background loading jobs, run by priority on a bounded pool of threads"""
+
+from collections import deque
+from concurrent.futures import CancelledError, Future
+import heapq
+import itertools
+import threading
+import time
+
+from gpmp.log import get_logger
+
+log = get_logger()
+
+# Lower runs first
+PRIORITY_USER = 0
+PRIORITY_BACKGROUND = 10
+
+class JobCancelled(Exception):
+   pass
+
+class CancelToken:
+   def __init__(self):
+      self._event = threading.Event()
+
+   def cancel(self):
+      self._event.set()
+
+   @property
+   def cancelled(self):
+      return self._event.is_set()
+
+   def raise_if_cancelled(self):
+      """For long running jobs to call between steps"""
+      if self._event.is_set():
+         raise JobCancelled()
+
+class Job:
+   """A unit of work for a LoaderService. func is called with the job, so it
+   can check job.token and call job.report_progress().
+   """
+   # pylint: disable-msg=too-many-instance-attributes
+   def __init__(self, service, name, func, priority, key):
+      self.service = service
+      self.name = name
+      self.func = func
+      self.priority = priority
+      self.key = key
+      self.token = CancelToken()
+      self.future = Future()
+      # Submissions of the job (with the same key) not yet released
+      self.submissions = 1
+      self.items_done = 0
+      self.bytes_done = 0
+      self.queued_time = time.monotonic()
+      self.start_time = None
+
+   def report_progress(self, items=0, n_bytes=0):
+      """Adds to the items and bytes done, and tells the progress callbacks"""
+      self.items_done += items
+      self.bytes_done += n_bytes
+      for callback in self.service.progress_callbacks:
+         try:
+            callback(self)
+         except Exception as e: # pylint: disable-msg=broad-except
+            log.error("Progress callback for %s failed: %r", self.name, e)
+
+   def cancel(self):
+      """Cancels the job. If it is already running, it is up to func to
+      notice the token.
+      """
+      self.token.cancel()
+      if not self.future.done() and self.future.cancel():
+         self.service._count_cancelled() # pylint: disable-msg=protected-access
+
+   def release(self):
+      """Withdraws the submission which returned this job, cancelling the
+      job if no other submission of it still wants it
+      """
+      self.service.release(self)
+
+   def add_done_callback(self, callback):
+      """callback(job) is called from a pool thread when the job finishes,
+      or immediately if it already has.
+      """
+      self.future.add_done_callback(lambda _: callback(self))
+
+   def result(self, timeout=None):
+      return self.future.result(timeout=timeout)
+
+   def error(self):
+      """Returns the exception the job failed with, if it is done"""
+      if self.future.cancelled():
+         return JobCancelled()
+      return self.future.exception(timeout=0)
+
+def _percentile(values, fract):
+   if not values:
+      return 0.0
+   values = sorted(values)
+   return values[min(int(len(values) * fract), len(values) - 1)]
+
+class LoaderService:
+   """Runs jobs on max_workers threads, in priority order and first come
+   first served within a priority.
+
+   Jobs can be given a key, so that submitting a job which is already queued
+   or running returns the existing job, raising its priority if the new
+   submission's is higher. That way a playlist the user clicks on jumps
+   ahead of the background fill that was going to load it anyway.
+   """
+   # pylint: disable-msg=too-many-instance-attributes
+   def __init__(self, max_workers=4):
+      self.max_workers = max_workers
+      self._queue = []
+      self._seq = itertools.count()
+      self._jobs_by_key = {}
+      self._cond = threading.Condition()
+      self._threads = []
+      self._shutdown = False
+      self._running = 0
+      # Called with the job, from the thread running it
+      self.progress_callbacks = []
+
+      # Updated from the workers and by Job.cancel(), so only with _cond held
+      self.completed = 0
+      self.failed = 0
+      self.cancelled = 0
+      # Seconds from being submitted to starting, and from starting to done
+      self.wait_times = deque(maxlen=200)
+      self.run_times = deque(maxlen=200)
+
+   def submit(self, name, func, priority=PRIORITY_BACKGROUND, key=None):
+      with self._cond:
+         if self._shutdown:
+            raise RuntimeError("LoaderService has been shut down")
+         if key is not None:
+            job = self._jobs_by_key.get(key)
+            if job is not None and not job.future.done():
+               if priority < job.priority and job.start_time is None:
+                  job.priority = priority
+                  # The old entry is skipped when it comes up.
+                  heapq.heappush(self._queue, (priority, next(self._seq), job))
+                  self._cond.notify()
+               job.submissions += 1
+               return job
+
+         job = Job(self, name, func, priority, key)
+         if key is not None:
+            self._jobs_by_key[key] = job
+         heapq.heappush(self._queue, (priority, next(self._seq), job))
+         while len(self._threads) < self.max_workers:
+            thread = threading.Thread(target=self._worker, name="loader", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+         self._cond.notify()
+         return job
+
+   def _next_job(self):
+      with self._cond:
+         while True:
+            while self._queue:
+               _, _, job = heapq.heappop(self._queue)
+               if job.start_time is not None or job.future.done():
+                  # Already run from a higher priority entry, or cancelled
+                  continue
+               if not job.future.set_running_or_notify_cancel():
+                  continue
+               job.start_time = time.monotonic()
+               self.wait_times.append(job.start_time - job.queued_time)
+               self._running += 1
+               return job
+            if self._shutdown:
+               return None
+            self._cond.wait()
+
+   def _worker(self):
+      while True:
+         job = self._next_job()
+         if job is None:
+            return
+         try:
+            if job.token.cancelled:
+               raise JobCancelled()
+            result = job.func(job)
+         except JobCancelled as e:
+            log.debug("Job %s cancelled", job.name)
+            self._count_cancelled()
+            job.future.set_exception(e)
+         except Exception as e: # pylint: disable-msg=broad-except
+            log.error("Job %s failed: %r", job.name, e)
+            with self._cond:
+               self.failed += 1
+            job.future.set_exception(e)
+         else:
+            with self._cond:
+               self.completed += 1
+            job.future.set_result(result)
+         with self._cond:
+            self.run_times.append(time.monotonic() - job.start_time)
+            self._running -= 1
+            if job.key is not None and self._jobs_by_key.get(job.key) is job:
+               del self._jobs_by_key[job.key]
+
+   def _count_cancelled(self):
+      with self._cond:
+         self.cancelled += 1
+
+   def release(self, job):
+      """See Job.release"""
+      with self._cond:
+         job.submissions -= 1
+         if job.submissions > 0:
+            return
+      job.cancel()
+
+   def queue_depth(self):
+      with self._cond:
+         # A job whose priority was raised has two entries
+         return len({job for _, _, job in self._queue
+                     if job.start_time is None and not job.future.done()})
+
+   def stats(self):
+      with self._cond:
+         stats = {
+            'queue_depth': self.queue_depth(),
+            'running': self._running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'cancelled': self.cancelled,
+         }
+         wait_times = list(self.wait_times)
+         run_times = list(self.run_times)
+      stats.update(
+         wait_p50_ms=_percentile(wait_times, 0.5) * 1000,
+         wait_p95_ms=_percentile(wait_times, 0.95) * 1000,
+         run_p50_ms=_percentile(run_times, 0.5) * 1000,
+         run_p95_ms=_percentile(run_times, 0.95) * 1000)
+      return stats
+
+   def wait(self, jobs, token=None):
+      """Waits for jobs to finish. Failed and cancelled jobs are not raised."""
+      for job in jobs:
+         if token is not None:
+            token.raise_if_cancelled()
+         try:
+            job.future.exception()
+         except CancelledError:
+            pass
+
+   def shutdown(self):
+      """Cancels queued jobs and lets the workers exit once their current
+      job is done.
+      """
+      with self._cond:
+         self._shutdown = True
+         for _, _, job in self._queue:
+            job.cancel()
+         self._queue = []
+         self._cond.notify_all()
+      log.info("Loader: %r", self.stats())
@@ -0,0 +1,274 @@
+"""Counters, gauges and latency histograms, exported as JSON or in the
+Prometheus text format
+
+Metrics are created on a MetricsRegistry by name, and tagged with labels:
+   calls = REGISTRY.counter('api_calls_total', "API calls")
+   calls.labels(endpoint='get_stream_url', outcome='ok').inc()
+"""
+
+import json
+import math
+import threading
+
+from gpmp.log import get_logger
+
+log = get_logger()
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+class CounterValue:
+   def __init__(self):
+      self._value = 0
+      self._lock = threading.Lock()
+
+   def inc(self, amount=1):
+      with self._lock:
+         self._value += amount
+
+   def snapshot(self):
+      return self._value
+
+class GaugeValue:
+   """A value which is set, or read from a function when snapshotted"""
+   def __init__(self):
+      self._value = 0
+      self._func = None
+
+   def set(self, value):
+      self._value = value
+
+   def set_function(self, func):
+      self._func = func
+
+   def snapshot(self):
+      if self._func is not None:
+         try:
+            return self._func()
+         except Exception as e: # pylint: disable-msg=broad-except
+            log.error("Gauge function failed: %r", e)
+            return math.nan
+      return self._value
+
+class HistogramValue:
+   """Records values (seconds) in log-linear buckets, as HdrHistogram does.
+   Each power of two above sub_buckets units (microseconds) is split into
+   sub_buckets linear buckets, so any value is recorded to within
+   1 / sub_buckets of its true value, in a few hundred buckets at most.
+   """
+   # pylint: disable-msg=too-many-instance-attributes
+   def __init__(self, sub_bucket_bits=4, unit=1e-6):
+      self.sub_bucket_bits = sub_bucket_bits
+      self.sub_buckets = 1 << sub_bucket_bits
+      self.unit = unit
+      # bucket index -> count
+      self._counts = {}
+      self.count = 0
+      self.sum = 0.0
+      self.min = math.inf
+      self.max = -math.inf
+      self._lock = threading.Lock()
+
+   def _index(self, value):
+      units = max(int(value / self.unit), 0)
+      if units < self.sub_buckets:
+         return units
+      shift = units.bit_length() - self.sub_bucket_bits - 1
+      return (shift + 1) * self.sub_buckets + (units >> shift) - self.sub_buckets
+
+   def _bucket_value(self, index):
+      """Returns the middle of the bucket, in seconds"""
+      if index < self.sub_buckets:
+         return index * self.unit
+      shift = index // self.sub_buckets - 1
+      lowest = (index % self.sub_buckets + self.sub_buckets) << shift
+      return (lowest + ((1 << shift) - 1) / 2) * self.unit
+
+   def observe(self, value):
+      index = self._index(value)
+      with self._lock:
+         self._counts[index] = self._counts.get(index, 0) + 1
+         self.count += 1
+         self.sum += value
+         self.min = min(self.min, value)
+         self.max = max(self.max, value)
+
+   def percentiles(self, quantiles=QUANTILES):
+      """Returns a list of the value at each quantile (0.0 to 1.0)"""
+      with self._lock:
+         counts = sorted(self._counts.items())
+         total = self.count
+      values = []
+      for quantile in quantiles:
+         rank = max(1, math.ceil(quantile * total))
+         seen = 0
+         value = 0.0
+         for index, count in counts:
+            seen += count
+            if seen >= rank:
+               value = self._bucket_value(index)
+               break
+         values.append(value)
+      return values
+
+   def snapshot(self):
+      values = self.percentiles()
+      with self._lock:
+         snapshot = {'count': self.count, 'sum': self.sum,
+                     'min': self.min if self.count else 0.0,
+                     'max': self.max if self.count else 0.0}
+      for quantile, value in zip(QUANTILES, values):
+         snapshot['p{:g}'.format(quantile * 100)] = value
+      return snapshot
+
+class Metric:
+   """A named metric, with a value for each combination of labels"""
+   def __init__(self, name, description, kind, value_class):
+      self.name = name
+      self.description = description
+      self.kind = kind
+      self._value_class = value_class
+      # Sorted (label, value) tuples -> value object
+      self._values = {}
+      self._lock = threading.Lock()
+
+   def labels(self, **labels):
+      key = tuple(sorted(labels.items()))
+      value = self._values.get(key)
+      if value is None:
+         with self._lock:
+            value = self._values.setdefault(key, self._value_class())
+      return value
+
+   # Shortcuts for metrics without labels
+   def inc(self, amount=1):
+      self.labels().inc(amount)
+
+   def set(self, value):
+      self.labels().set(value)
+
+   def observe(self, value):
+      self.labels().observe(value)
+
+   def snapshot(self):
+      with self._lock:
+         values = list(self._values.items())
+      return {'type': self.kind, 'help': self.description,
+              'values': [{'labels': dict(key), 'value': value.snapshot()}
+                         for key, value in values]}
+
+class MetricsRegistry:
+   def __init__(self):
+      self._metrics = {}
+      self._lock = threading.Lock()
+
+   def _get(self, name, description, kind, value_class):
+      with self._lock:
+         metric = self._metrics.get(name)
+         if metric is None:
+            metric = Metric(name, description, kind, value_class)
+            self._metrics[name] = metric
+         elif metric.kind != kind:
+            raise ValueError("Metric {} is a {}, not a {}".format(name, metric.kind, kind))
+         return metric
+
+   def counter(self, name, description=""):
+      return self._get(name, description, 'counter', CounterValue)
+
+   def gauge(self, name, description=""):
+      return self._get(name, description, 'gauge', GaugeValue)
+
+   def histogram(self, name, description=""):
+      """Latencies, in seconds"""
+      return self._get(name, description, 'histogram', HistogramValue)
+
+   def snapshot(self):
+      with self._lock:
+         metrics = list(self._metrics.values())
+      return {metric.name: metric.snapshot() for metric in metrics}
+
+   def to_json(self):
+      return json.dumps(self.snapshot(), indent=1, sort_keys=True)
+
+   def to_prometheus(self):
+      """Returns the metrics in the Prometheus text format. Histograms are
+      written as summaries, with quantiles.
+      """
+      lines = []
+      for name, metric in sorted(self.snapshot().items()):
+         kind = 'summary' if metric['type'] == 'histogram' else metric['type']
+         lines.append("# HELP {} {}".format(name, _escape_help(metric['help'])))
+         lines.append("# TYPE {} {}".format(name, kind))
+         for entry in metric['values']:
+            labels, value = entry['labels'], entry['value']
+            if kind != 'summary':
+               lines.append("{}{} {}".format(name, _format_labels(labels), _number(value)))
+               continue
+            for quantile in QUANTILES:
+               key = 'p{:g}'.format(quantile * 100)
+               lines.append("{}{} {}".format(
+                  name, _format_labels(dict(labels, quantile='{:g}'.format(quantile))),
+                  _number(value[key])))
+            lines.append("{}_sum{} {}".format(name, _format_labels(labels),
+                                              _number(value['sum'])))
+            lines.append("{}_count{} {}".format(name, _format_labels(labels), value['count']))
+      return '\n'.join(lines) + '\n'
+
+def _escape_help(text):
+   return text.replace('\\', r'\\').replace('\n', r'\n')
+
+def _format_labels(labels):
+   if not labels:
+      return ''
+   return '{' + ','.join('{}="{}"'.format(
+      key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                         for key, value in sorted(labels.items())) + '}'
+
+def _number(value):
+   if value is None:
+      return 'NaN'
+   if isinstance(value, bool):
+      return '1' if value else '0'
+   if isinstance(value, float):
+      if math.isnan(value):
+         return 'NaN'
+      if math.isinf(value):
+         return '+Inf' if value > 0 else '-Inf'
+      return repr(value)
+   return str(value)
+
+REGISTRY = MetricsRegistry()
+
+def start_metrics_server(port, registry=REGISTRY, host='127.0.0.1'):
+   """Serves /metrics (Prometheus) and /metrics.json on a background thread.
+   Only listens on localhost unless given another host. Returns the server,
+   whose shutdown() stops it.
+   """
+   # Only imported when enabled, as it pulls in the email package
+   # pylint: disable-msg=import-outside-toplevel
+   from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+   class MetricsHandler(BaseHTTPRequestHandler):
+      def do_GET(self): # pylint: disable-msg=invalid-name
+         if self.path == '/metrics':
+            body = registry.to_prometheus().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+         elif self.path == '/metrics.json':
+            body = registry.to_json().encode()
+            content_type = 'application/json'
+         else:
+            self.send_error(404)
+            return
+         self.send_response(200)
+         self.send_header('Content-Type', content_type)
+         self.send_header('Content-Length', str(len(body)))
+         self.end_headers()
+         self.wfile.write(body)
+
+      def log_message(self, format, *args): # pylint: disable-msg=redefined-builtin
+         log.debug("Metrics server: " + format, *args)
+
+   server = ThreadingHTTPServer((host, port), MetricsHandler)
+   server.daemon_threads = True
+   threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+   log.info("Serving metrics on http://%s:%d/metrics", host, server.server_address[1])
+   return server
@@ -1,73 +1,371 @@
 """Classes for media player and library"""
 
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+import queue
 import random
-from time import sleep
+import sqlite3
+import time
 import threading
+from typing import TYPE_CHECKING
 
-from gmusicapi import Mobileclient
-from system_hotkey import SystemHotkey
-import vlc
-
+from gpmp.audiocache import AudioCache
+from gpmp.cache import LibraryCache
+from gpmp.loader import PRIORITY_BACKGROUND, LoaderService
 from gpmp.log import get_logger
+from gpmp.metrics import REGISTRY
+from gpmp.playqueue import RESET, PlayQueue, QueueChange
+from gpmp.prefetch import StreamUrlPrefetcher
+from gpmp.search import SearchIndex
+from gpmp.shuffle import RecentlyPlayed, ShuffledTracks
+from gpmp.songtable import SongTable, art_url_of
 from gpmp.threading import Atomic
+from gpmp.vlcevents import EventDispatcher
+
+if TYPE_CHECKING:
+   from gmusicapi import Mobileclient
+   from system_hotkey import SystemHotkey
 
 log = get_logger()
 
+def _microseconds_to_datetime(usecs):
+   return datetime.fromtimestamp(usecs / 1e6, tz=timezone.utc)
+
 class Library:
-   def __init__(self, api: Mobileclient):
+   # pylint: disable-msg=too-many-instance-attributes
+   def __init__(self, api: 'Mobileclient', cache: LibraryCache = None):
       self.api = api
+      self.cache = cache
       self.songs = None
+      self.search_index = None
       self.playlist_meta = None
-      self.playlist_contents = None
+      # playlist id -> list of track ids, for the playlists loaded so far
+      self.playlist_contents = {}
+      self._playlist_locks = {}
+      self._playlist_locks_lock = threading.Lock()
+      self._all_playlists_lock = threading.Lock()
+      self._all_playlists_loaded = False
+      # Seconds taken by each load stage, for startup reporting
+      self.load_timings = {}
+
+   def load_core(self, on_songs_page=None):
+      if self.songs is None:
+         self.load_cached()
+      self.sync(on_songs_page=on_songs_page)
+
+   def load_cached(self):
+      """Loads the songs and playlists stored in the cache, if any.
+      Returns True if the cache had a library in it.
+      """
+      if self.cache is None:
+         return False
+
+      start = time.monotonic()
+      try:
+         songs = self.cache.load_songs()
+         playlists = self.cache.load_playlists()
+      except sqlite3.Error as e:
+         log.error("Failed to read library cache: %s", e)
+         return False
 
-   def load_core(self):
-      self.songs = self._get_all_songs_dict()
-      self.playlist_meta = [p for p in self.api.get_all_playlists()
-                            if not p['deleted']]
-      self.playlist_meta = sorted(self.playlist_meta,
+      if not songs:
+         return False
+
+      self._reset_songs()
+      self.add_songs(songs)
+      self._set_playlist_meta(playlists)
+      self.load_timings['cache'] = time.monotonic() - start
+      self.load_timings.setdefault('first_playable', self.load_timings['cache'])
+      log.info("Loaded %d songs from cache in %.3fs",
+               len(self.songs), self.load_timings['cache'])
+      return True
+
+   def sync(self, on_songs_page=None):
+      """Fetches the library from the server. If the library was loaded from
+      the cache, only the changes since the cache was last updated are fetched.
+      """
+      self.sync_songs(on_songs_page=on_songs_page)
+      self.sync_playlists()
+
+   def sync_songs(self, on_songs_page=None):
+      """Songs are fetched a page at a time, and are available in self.songs as
+      soon as their page arrives. on_songs_page is called after each page
+      with the number of songs in the library so far.
+      """
+      start = time.monotonic()
+      songs_since = None
+      if self.songs is not None and self.cache is not None:
+         songs_since = self.cache.songs_last_modified()
+
+      if songs_since is None:
+         self._reset_songs()
+         song_pages = self.api.get_all_songs(incremental=True)
+      else:
+         song_pages = self.api.get_all_songs(
+            incremental=True, include_deleted=True,
+            updated_after=_microseconds_to_datetime(songs_since))
+      raw_songs = self.add_song_pages(song_pages, on_page=on_songs_page,
+                                      start_time=start)
+
+      if self.cache is not None:
+         try:
+            self.cache.update_songs(raw_songs, replace_all=songs_since is None)
+         except sqlite3.Error as e:
+            log.error("Failed to write songs to library cache: %s", e)
+
+      kind = 'cold' if songs_since is None else 'warm'
+      self.load_timings['sync'] = time.monotonic() - start
+      self.load_timings['sync_kind'] = kind
+      log.info("%s sync fetched %d songs in %.3fs", kind, len(raw_songs),
+               self.load_timings['sync'])
+
+   def sync_playlists(self):
+      start = time.monotonic()
+      playlists_since = None
+      if self.playlist_meta is not None and self.cache is not None:
+         playlists_since = self.cache.playlists_last_modified()
+
+      if playlists_since is None:
+         raw_playlists = self.api.get_all_playlists()
+         self._set_playlist_meta(raw_playlists)
+      else:
+         raw_playlists = self.api.get_all_playlists(
+            include_deleted=True,
+            updated_after=_microseconds_to_datetime(playlists_since))
+         playlists = {p['id']: p for p in self.playlist_meta}
+         for playlist in raw_playlists:
+            if playlist.get('deleted'):
+               playlists.pop(playlist['id'], None)
+            else:
+               playlists[playlist['id']] = playlist
+            # Changed, so any contents we have are stale
+            self.playlist_contents.pop(playlist['id'], None)
+            self._all_playlists_loaded = False
+         self._set_playlist_meta(playlists.values())
+
+      if self.cache is not None:
+         try:
+            self.cache.update_playlists(raw_playlists,
+                                        replace_all=playlists_since is None)
+         except sqlite3.Error as e:
+            log.error("Failed to write playlists to library cache: %s", e)
+
+      self.load_timings['sync_playlists'] = time.monotonic() - start
+      log.info("Fetched %d playlists in %.3fs", len(raw_playlists),
+               self.load_timings['sync_playlists'])
+
+   def add_songs(self, songs):
+      for song in songs:
+         song_id = song['id']
+         row = self.songs.row_of(song_id)
+         if song.get('deleted'):
+            if row is not None:
+               self.search_index.update_row(
+                  row, lambda song_id=song_id: self.songs.remove(song_id))
+         elif row is None:
+            # New rows are picked up by the search index on its next update
+            self.songs.add_song(song)
+         else:
+            self.search_index.update_row(
+               row, lambda song=song: self.songs.add_song(song))
+
+   def update_search_index(self):
+      if self.search_index is not None:
+         self.search_index.update()
+
+   def search(self, query, limit=50):
+      """Returns the ids of up to limit songs matching query, best first"""
+      if self.search_index is None:
+         return []
+      return self.search_index.search(query, limit=limit)
+
+   def add_song_pages(self, pages, on_page=None, start_time=None):
+      """Adds songs from an iterable of pages (lists of raw song dicts).
+      Returns all the raw songs added, so they can be cached.
+      """
+      all_songs = []
+      for page in pages:
+         self.add_songs(page)
+         all_songs.extend(page)
+         if (start_time is not None and len(self.songs) > 0 and
+             'first_playable' not in self.load_timings):
+            self.load_timings['first_playable'] = time.monotonic() - start_time
+            log.info("First playable tracks after %.3fs",
+                     self.load_timings['first_playable'])
+         if on_page:
+            on_page(len(self.songs))
+      return all_songs
+
+   def _set_playlist_meta(self, playlists):
+      self.playlist_meta = sorted((p for p in playlists if not p.get('deleted')),
                                   key=lambda p: p['name'])
 
+   def _playlist_lock(self, playlist_id):
+      with self._playlist_locks_lock:
+         lock = self._playlist_locks.get(playlist_id)
+         if lock is None:
+            lock = threading.Lock()
+            self._playlist_locks[playlist_id] = lock
+         return lock
+
+   def _get_playlist_meta(self, playlist_id):
+      for playlist in self.playlist_meta or []:
+         if playlist['id'] == playlist_id:
+            return playlist
+      return None
+
+   def load_playlist(self, playlist_id):
+      """Returns the track ids in a playlist, fetching them if they have not
+      been loaded yet. Concurrent calls for the same playlist share one fetch.
+      """
+      contents = self.playlist_contents.get(playlist_id)
+      if contents is not None:
+         return contents
+
+      with self._playlist_lock(playlist_id):
+         contents = self.playlist_contents.get(playlist_id)
+         if contents is None:
+            contents = self._fetch_playlist(playlist_id)
+      return contents
+
+   def _fetch_playlist(self, playlist_id):
+      meta = self._get_playlist_meta(playlist_id)
+      share_token = meta.get('shareToken') if meta else None
+      if share_token:
+         try:
+            entries = self.api.get_shared_playlist_contents(share_token)
+         except Exception as e: # pylint: disable-msg=broad-except
+            log.warning("Failed to fetch playlist %s by share token: %r",
+                        playlist_id, e)
+         else:
+            entries = sorted((e for e in entries if not e.get('deleted')),
+                             key=lambda e: int(e.get('absolutePosition', 0)))
+            contents = self._resolve_playlist_entries(entries)
+            self.playlist_contents[playlist_id] = contents
+            return contents
+
+      # No way to get just this one, so get all of them.
+      self.load_playlist_contents()
+      return self.playlist_contents.get(playlist_id)
+
+   def submit_playlist_load(self, loader: LoaderService, playlist_id,
+                            priority=PRIORITY_BACKGROUND):
+      """Loads a playlist on loader. If it is already queued there, the
+      existing job is returned, with its priority raised to priority.
+      """
+      def load(job):
+         contents = self.load_playlist(playlist_id)
+         job.report_progress(items=len(contents or ()))
+         return contents
+      return loader.submit("playlist " + playlist_id, load, priority=priority,
+                           key=('playlist', playlist_id))
+
+   def fill_playlist_contents(self, max_concurrent=4, loader: LoaderService = None,
+                              on_playlist_loaded=None):
+      """Loads the contents of every playlist not loaded yet, with at most
+      max_concurrent requests in flight, or as background jobs on loader.
+      on_playlist_loaded is called with the number loaded so far.
+      """
+      start = time.monotonic()
+      playlist_ids = [p['id'] for p in self.playlist_meta or []
+                      if p['id'] not in self.playlist_contents]
+      n_loaded = 0
+      n_loaded_lock = threading.Lock()
+
+      def loaded(_):
+         nonlocal n_loaded
+         with n_loaded_lock:
+            n_loaded += 1
+            n = n_loaded
+         if on_playlist_loaded is not None:
+            on_playlist_loaded(n)
+
+      if loader is not None:
+         jobs = [self.submit_playlist_load(loader, pid) for pid in playlist_ids]
+         for job in jobs:
+            job.add_done_callback(loaded)
+         loader.wait(jobs)
+      else:
+         def load(playlist_id):
+            try:
+               self.load_playlist(playlist_id)
+            except Exception as e: # pylint: disable-msg=broad-except
+               log.error("Failed to load playlist %s: %r", playlist_id, e)
+            loaded(playlist_id)
+
+         with ThreadPoolExecutor(max_workers=max_concurrent,
+                                 thread_name_prefix="playlists") as executor:
+            list(executor.map(load, playlist_ids))
+
+      self.load_timings['fill_playlists'] = time.monotonic() - start
+      log.info("Filled %d playlists in %.3fs", len(playlist_ids),
+               self.load_timings['fill_playlists'])
+
    def load_playlist_contents(self):
-      raw_playlist_contents = self.api.get_all_user_playlist_contents()
-      self.playlist_contents = {}
-      for pl in raw_playlist_contents:
-         trimmed_pl = []
-         for track in pl['tracks']:
-            track_id = track['trackId']
-            trimmed_pl.append(track_id)
-            if track_id not in self.songs:
-               if 'track' not in track:
-                  log.warning("Track %s has no 'track' dict", track_id)
-                  continue
-               track_info = track['track']
-               artist = track_info.get('artist')
-               title = track_info.get('title')
-               if artist is None or title is None:
-                  log.warning("Track %s did not have both title and artist. Found %r, %r",
-                              track_id, title, artist)
-                  continue
-               self.songs[track_id] = {
-                  'artist': artist,
-                  'title': title,
-               }
-
-         self.playlist_contents[pl['id']] = trimmed_pl
-
-   def _get_all_songs_dict(self):
-      songs = self.api.get_all_songs()
-      return {
-         song['id']: {
-            'artist': song.get('artist'),
-            'title': song.get('title'),
-            'song': song,
-         }
-         for song in songs
-      }
+      """Loads all user playlists in one request"""
+      with self._all_playlists_lock:
+         if self._all_playlists_loaded:
+            return
+         raw_playlist_contents = self.api.get_all_user_playlist_contents()
+         for pl in raw_playlist_contents:
+            self.playlist_contents[pl['id']] = self._resolve_playlist_entries(pl['tracks'])
+         self._all_playlists_loaded = True
+
+   def _resolve_playlist_entries(self, entries):
+      """Returns the track ids of playlist entries, adding any tracks missing
+      from the library using the entry's 'track' dict.
+      """
+      track_ids = []
+      for track in entries:
+         track_id = track['trackId']
+         track_ids.append(track_id)
+         if track_id not in self.songs:
+            if 'track' not in track:
+               log.warning("Track %s has no 'track' dict", track_id)
+               continue
+            track_info = track['track']
+            artist = track_info.get('artist')
+            title = track_info.get('title')
+            if artist is None or title is None:
+               log.warning("Track %s did not have both title and artist. Found %r, %r",
+                           track_id, title, artist)
+               continue
+            self.songs.add(track_id, title, artist,
+                           album=track_info.get('album'),
+                           art_url=art_url_of(track_info))
+      return track_ids
+
+   def artist_of(self, song_id):
+      row = self.songs.row_of(song_id)
+      return None if row is None else self.songs.artists[row]
+
+   def album_art_url(self, song_id):
+      row = self.songs.row_of(song_id)
+      return None if row is None else self.songs.art_urls[row]
+
+   def _reset_songs(self):
+      """The raw song dicts are not kept in memory. If there is a cache, they
+      are read back from it on demand.
+      """
+      songs = SongTable(raw_loader=self.cache.load_song if self.cache else None)
+      self.search_index = SearchIndex(songs)
+      self.songs = songs
 
 class MediaPlayer:
-   def __init__(self, url):
-      self.player = vlc.MediaPlayer(url)
+   def __init__(self, url=None):
+      # python-vlc loads libvlc when it is imported, so that is left until a
+      # player is first needed.
+      import vlc # pylint: disable-msg=import-outside-toplevel
+      self.player = vlc.MediaPlayer(url) if url else vlc.MediaPlayer()
+
+   def preroll(self, mrl):
+      """Opens mrl and buffers its start, leaving it paused, so that play()
+      starts it without waiting for the stream to open.
+      """
+      self.player.set_mrl(mrl, ':start-paused')
+      return self.player.play()
 
    def __del__(self):
       """NOTE: This MUST not be called from within an event callback from the
@@ -85,6 +383,45 @@ class MediaPlayer:
 class PlayerEvent:
    event_str: str
    track_index: int
+   time: float = 0.0 # time.monotonic() when the event was received
+
+# Keys of the state published to TrackPlayer.state_callbacks
+STATE_TRACK_INDEX = 'track_index'
+STATE_SONG_INFO = 'song_info'
+STATE_PLAYING = 'playing'
+
+_TRACK_SWITCH_SECONDS = REGISTRY.histogram(
+   'player_track_switch_seconds',
+   "Time from starting to switch tracks to the player playing, by where the "
+   "audio came from")
+_STREAM_URL_SECONDS = REGISTRY.histogram(
+   'player_stream_url_seconds',
+   "Part of the track switch time spent finding the track's audio")
+
+# Event strings for events posted by the player itself rather than VLC
+_WAKE_EVENT = 'wake'
+_END_REACHED_EVENT = 'end_reached'
+_STOP_EVENT = 'stop'
+
+# The stream urls of the upcoming tracks are fetched again this many seconds
+# before the current track ends, unless they will still be good by then.
+# Those fetched when it started expire after about 40s.
+URL_REFRESH_SECS = 10.0
+
+@dataclass
+class EventLoopStats:
+   """Counters for the player's event handler thread"""
+   wakeups: int = 0
+   events: int = 0
+   timeouts: int = 0
+   # Seconds from VLC reporting the end of a track to it being handled
+   end_reaction_times: deque = field(default_factory=lambda: deque(maxlen=100))
+
+@dataclass
+class _Preroll:
+   track_index: int
+   song_id: str
+   player: MediaPlayer
 
 @dataclass
 class TrackTimingInfo:
@@ -94,7 +431,10 @@ class TrackTimingInfo:
 class TrackPlayer:
    # pylint: disable-msg=too-many-instance-attributes
 
-   def __init__(self, api: Mobileclient, hotkey_mgr: SystemHotkey, library: Library):
+   def __init__(self, api: 'Mobileclient', hotkey_mgr: 'SystemHotkey', library: Library,
+                prefetch_depth=2, audio_cache: AudioCache = None,
+                gapless=True, preroll_secs=5.0, artist_spread=2, avoid_recent=100,
+                shuffle_seed=None):
       self.initialized_val = Atomic(False)
       self.api = api
       self.hotkey_mgr = hotkey_mgr
@@ -102,14 +442,64 @@ class TrackPlayer:
       if self.hotkey_mgr:
          self.setup_hotkeys()
 
-      # List of track ids
-      self.tracks_to_play = []
+      # The track at current_track_index is the one playing
+      self.tracks_to_play = PlayQueue()
+      self.tracks_to_play.change_callbacks.append(self._on_queue_changed)
+      # Shuffles avoid repeating the artist of any of the previous
+      # artist_spread tracks, and tracks played in the last avoid_recent.
+      self.artist_spread = artist_spread
+      self.recently_played = RecentlyPlayed(avoid_recent)
+      self._shuffle_rng = random.Random(shuffle_seed)
       self.current_track_index = Atomic(None)
       self.current_song_info = Atomic(None)
+      # Called with (STATE_* key, new value) whenever that part of the state
+      # changes, from whichever thread changed it.
+      self.state_callbacks = []
+      self._published_state = {}
+      self._state_lock = threading.Lock()
 
       self.player = None
-      self.pending_events = []
+      # With gapless playback the next track is opened in a second player
+      # preroll_secs before the current one ends, and swapped in when it does.
+      self.gapless = gapless
+      self.preroll_secs = preroll_secs
+      self._preroll = None
+      self._spare_player = None
+      # Held while swapping self.player, _preroll and _spare_player, which is
+      # done from the event handler thread and from GUI and hotkey actions
+      self._player_lock = threading.RLock()
+      # Seconds from a track ending to the next one starting
+      self.track_gaps = deque(maxlen=100)
+      self._track_end_time = None
+      # PlayerEvents for the event handler thread. It blocks on this, so it
+      # only wakes up for an event or when the next track needs prerolling.
+      self.pending_events = queue.SimpleQueue()
       self.event_handler_thread = None
+      self.event_loop_stats = EventLoopStats()
+      self.event_dispatcher = EventDispatcher({
+         'MediaPlayerEndReached': self._on_end_reached,
+         'MediaPlayerPlaying': self._on_playing,
+         'MediaPlayerPaused': self._on_stopped_or_paused,
+         'MediaPlayerStopped': self._on_stopped_or_paused,
+         'MediaPlayerEncounteredError': self._on_error,
+      })
+
+      # Number of upcoming tracks to resolve stream urls for. 0 disables it.
+      self.prefetch_depth = prefetch_depth
+      self.url_prefetcher = StreamUrlPrefetcher(api)
+      # The track index whose upcoming urls have been refreshed near its end
+      self._urls_refreshed_index = None
+      # Tracks are played from here when possible, and the current and next
+      # tracks are downloaded into it.
+      self.audio_cache = audio_cache
+      # Seconds from starting to switch tracks to the player playing, split by
+      # where the audio came from.
+      self.track_switch_times = {
+         'preroll': deque(maxlen=100),
+         'cached': deque(maxlen=100),
+         'prefetched': deque(maxlen=100),
+         'fetched': deque(maxlen=100),
+      }
 
       if api.is_authenticated():
          self.initialize()
@@ -118,12 +508,27 @@ class TrackPlayer:
    def initialized(self):
       return self.initialized_val.value
 
-   def initialize(self):
-      if self.library.songs is None:
-         self.library.load_core()
-      self.start_event_handler_thread()
+   def initialize(self, load_library=True, on_songs_page=None):
+      # Started first, so that tracks can be played from a partially loaded
+      # library.
+      if self.event_handler_thread is None:
+         self.start_event_handler_thread()
+      # Loads libvlc now, off the GUI thread, rather than when the first
+      # track is played.
+      import vlc # pylint: disable-msg=import-outside-toplevel,unused-import
+      if load_library and self.library.songs is None:
+         self.library.load_core(on_songs_page=on_songs_page)
       self.initialized_val.value = True
 
+   def enable_hotkeys(self):
+      """Creates a SystemHotkey and registers the player's hotkeys with it.
+      system_hotkey is slow to import and connects to the X server, so this
+      is normally run as a startup stage rather than before the window shows.
+      """
+      from system_hotkey import SystemHotkey # pylint: disable-msg=import-outside-toplevel
+      self.hotkey_mgr = SystemHotkey()
+      self.setup_hotkeys()
+
    def setup_hotkeys(self):
       self.hotkey_mgr.register(('control', 'up'),
                                callback=lambda _: self.toggle_play())
@@ -134,14 +539,82 @@ class TrackPlayer:
       self.hotkey_mgr.register(('control', 'shift', 'right'),
                                callback=lambda _: self.skip_to_end())
 
-   def set_tracks_to_play(self, track_ids):
-      self.tracks_to_play = track_ids
-      self.current_track_index.value = None
+   def set_tracks_to_play(self, track_ids, shuffle=False):
+      """track_ids is not copied. When shuffling, it may contain None for
+      removed songs, so that a SongTable's ids column can be used directly.
+      """
+      if shuffle:
+         track_ids = self._shuffled(track_ids)
+      self._set_current_track_index(None)
+      self.tracks_to_play.reset(track_ids)
+      self.url_prefetcher.reset()
+      self._discard_preroll()
       if self.player and self.player.is_playing():
          self.player.stop()
 
+   def _shuffled(self, track_ids):
+      return ShuffledTracks(
+         track_ids, seed=self._shuffle_rng.getrandbits(64),
+         artist_of=self.library.artist_of, artist_spread=self.artist_spread,
+         recent=self.recently_played if self.recently_played.maxlen > 0 else None)
+
    def shuffle_tracks(self):
-      random.shuffle(self.tracks_to_play)
+      track_ids = self.tracks_to_play.base()
+      if isinstance(track_ids, ShuffledTracks):
+         track_ids = track_ids.track_ids
+      elif track_ids is None:
+         track_ids = list(self.tracks_to_play)
+      self.tracks_to_play.reset(self._shuffled(track_ids))
+      self.url_prefetcher.reset()
+      self._discard_preroll()
+
+   def queue_next(self, track_ids):
+      """Inserts track_ids after the current track"""
+      index = self.current_track_index.value
+      self.tracks_to_play.insert(0 if index is None else index + 1, track_ids)
+
+   def move_to_next(self, index):
+      """Moves the track at index to play after the current track"""
+      current = self.current_track_index.value
+      if current is None:
+         dest = 0
+      elif index > current:
+         dest = current + 1
+      elif index < current:
+         # The current track moves up one when it is taken out
+         dest = current
+      else:
+         return
+      self.tracks_to_play.move(index, dest)
+
+   def _on_queue_changed(self, change: QueueChange):
+      if change.kind == RESET:
+         return
+      index = self.current_track_index.value
+      if index is not None:
+         new_index = change.adjust(index)
+         if new_index is None:
+            # The current track was removed. It keeps playing, and the one
+            # after it in the queue plays next.
+            new_index = change.index - 1 if change.index > 0 else None
+         self._set_current_track_index(new_index)
+         index = new_index
+
+      with self._player_lock:
+         preroll = self._preroll
+         if preroll is not None:
+            next_index = 0 if index is None else index + 1
+            upcoming = self.tracks_to_play[next_index:next_index + 1]
+            if preroll.track_index != next_index or upcoming != [preroll.song_id]:
+               self._discard_preroll()
+               # To preroll the new next track
+               self._post_event(_WAKE_EVENT)
+      self._prefetch_upcoming()
+
+   def upcoming_track_ids(self, count):
+      index = self.current_track_index.value
+      start = 0 if index is None else index + 1
+      return self.tracks_to_play[start:start + count]
 
    def get_position(self):
       if self.player:
@@ -154,43 +627,148 @@ class TrackPlayer:
                                 self.player.get_length() / 1000)
       return None
 
-   def handle_track_finished(self):
+   def is_playing(self):
+      return self.player is not None and bool(self.player.is_playing())
+
+   def handle_track_finished(self, end_time=None):
+      self._track_end_time = end_time
       self.play_next_track()
 
-   def handle_player_event(self, event):
-      log.debug(event)
-      if event.type == vlc.EventType.MediaPlayerEndReached:
-         self.pending_events.append(PlayerEvent(str(event.type),
-                                                self.current_track_index.value))
+   # VLC event handlers. These are called from VLC's thread, and must not
+   # call back into the player which sent the event.
+   def _on_end_reached(self, _event, player):
+      if player is self.player:
+         self._publish_state(STATE_PLAYING, False)
+         self._post_event(_END_REACHED_EVENT)
+
+   def _on_playing(self, _event, player):
+      if player is self.player:
+         self._publish_state(STATE_PLAYING, True)
+         # Time to the end of the track is known now
+         self._post_event(_WAKE_EVENT)
+
+   def _on_stopped_or_paused(self, _event, player):
+      if player is self.player:
+         self._publish_state(STATE_PLAYING, False)
+
+   def _on_error(self, _event, player):
+      if player is self.player:
+         log.error("Player error playing track %r", self.current_track_index.value)
+      else:
+         log.warning("Player error prerolling the next track")
+
+   def _publish_state(self, key, value):
+      """Calls the state callbacks if value is a change"""
+      with self._state_lock:
+         if key in self._published_state and self._published_state[key] == value:
+            return
+         self._published_state[key] = value
+      for callback in self.state_callbacks:
+         try:
+            callback(key, value)
+         except Exception as e: # pylint: disable-msg=broad-except
+            log.error("State callback for %s failed: %r", key, e)
+
+   def _set_current_track_index(self, index):
+      self.current_track_index.value = index
+      self._publish_state(STATE_TRACK_INDEX, index)
+
+   def _post_event(self, event_str):
+      self.pending_events.put(PlayerEvent(event_str, self.current_track_index.value,
+                                          time.monotonic()))
 
    def _get_player_for_url(self, url):
       if not self.player:
          self.player = MediaPlayer(url)
       else:
          self.player.set_mrl(url)
-      # https://www.olivieraubert.net/vlc/python-ctypes/doc/vlc.EventType-class.html
-      event_blacklist = set([vlc.EventType.MediaPlayerTimeChanged,
-                             vlc.EventType.MediaPlayerPositionChanged,
-                             vlc.EventType.MediaPlayerLengthChanged,
-                             vlc.EventType.MediaPlayerBuffering,
-                             vlc.EventType.MediaPlayerAudioVolume,
-                             vlc.EventType.MediaPlayerAudioDevice,
-                             vlc.EventType.MediaPlayerESSelected,
-                             vlc.EventType.MediaPlayerESAdded,
-                             vlc.EventType.MediaPlayerESDeleted,
-                             vlc.EventType.MediaPlayerScrambledChanged,
-                             vlc.EventType.MediaPlayerPausableChanged,
-                             vlc.EventType.MediaPlayerSeekableChanged,
-                             ])
-      for attr in dir(vlc.EventType):
-         if attr.startswith("Media") or attr.startswith("Vlm"):
-            event = getattr(vlc.EventType, attr)
-            if event not in event_blacklist:
-               self.player.event_manager().event_attach(event,
-                                                        self.handle_player_event)
-
+      self.event_dispatcher.attach(self.player)
       return self.player
 
+   def _get_mrl(self, song_id):
+      """Returns (mrl, source) for song_id, where source says where it came
+      from: 'cached', 'prefetched' or 'fetched'.
+      """
+      mrl = self.audio_cache.get_path(song_id) if self.audio_cache else None
+      if mrl is not None:
+         return mrl, 'cached'
+      mrl, prefetched = self.url_prefetcher.get(song_id)
+      return mrl, 'prefetched' if prefetched else 'fetched'
+
+   def _maybe_preroll_next_track(self):
+      """Opens the next track in the spare player once the current track is
+      within preroll_secs of its end.
+      """
+      player = self.player
+      index = self.current_track_index.value
+      if not self.gapless or player is None or index is None or not player.is_playing():
+         return
+      next_index = index + 1
+      preroll = self._preroll
+      if (next_index >= len(self.tracks_to_play)
+            or preroll is not None and preroll.track_index == next_index):
+         return
+      length = player.get_length()
+      if length <= 0 or length - player.get_time() > self.preroll_secs * 1000:
+         return
+
+      song_id = self.tracks_to_play[next_index]
+      try:
+         mrl, source = self._get_mrl(song_id)
+      except Exception as e: # pylint: disable-msg=broad-except
+         log.warning("Failed to get the next track for preroll: %r", e)
+         return
+      with self._player_lock:
+         # The track or queue may have changed while the url was fetched
+         if (self.current_track_index.value != index
+               or self.tracks_to_play[next_index:next_index + 1] != [song_id]):
+            return
+         self._discard_preroll()
+         spare = self._spare_player
+         self._spare_player = None
+         if spare is None:
+            spare = MediaPlayer()
+            self.event_dispatcher.attach(spare)
+         if spare.preroll(mrl) != 0:
+            log.error("Preroll of %s failed", song_id)
+            self._spare_player = spare
+            return
+         log.debug("Prerolling %s (%s)", song_id, source)
+         self._preroll = _Preroll(next_index, song_id, spare)
+
+   def _take_preroll(self, song_id):
+      """Returns the prerolled player if it has song_id at the current index"""
+      with self._player_lock:
+         preroll = self._preroll
+         self._preroll = None
+         if preroll is None:
+            return None
+         if (preroll.track_index == self.current_track_index.value
+               and preroll.song_id == song_id):
+            return preroll.player
+         preroll.player.stop()
+         self._spare_player = preroll.player
+         return None
+
+   def _discard_preroll(self):
+      self._take_preroll(None)
+
+   def _play_preroll(self, song_id):
+      """Swaps in and plays the prerolled player if it has song_id at the
+      current index. Returns the result of play(), or None if it doesn't.
+      """
+      with self._player_lock:
+         prerolled = self._take_preroll(song_id)
+         if prerolled is None:
+            return None
+         old_player = self.player
+         self.player = prerolled
+         code = self.player.play()
+         if old_player is not None:
+            old_player.stop()
+            self._spare_player = old_player
+         return code
+
    def play_current_track(self):
       song_id = self.tracks_to_play[self.current_track_index.value]
       song_info = self.library.songs.get(song_id)
@@ -201,16 +779,62 @@ class TrackPlayer:
          log.error("Could not find track info for %s", song_id)
 
       self.current_song_info.value = song_str
+      self._publish_state(STATE_SONG_INFO, song_str)
+      self.recently_played.add(song_id)
+      self._urls_refreshed_index = None
+
+      start = time.monotonic()
+      code = self._play_preroll(song_id)
+      if code is not None:
+         source = 'preroll'
+      else:
+         mrl, source = self._get_mrl(song_id)
+         _STREAM_URL_SECONDS.labels(source=source).observe(time.monotonic() - start)
+         with self._player_lock:
+            code = self._get_player_for_url(mrl).play()
+      now = time.monotonic()
+      switch_time = now - start
+      self.track_switch_times[source].append(switch_time)
+      _TRACK_SWITCH_SECONDS.labels(source=source).observe(switch_time)
+      if self._track_end_time is not None:
+         gap = now - self._track_end_time
+         self._track_end_time = None
+         self.track_gaps.append(gap)
+         log.info("Gap between tracks: %.1fms (%s)", gap * 1000, source)
+
+      self._prefetch_upcoming()
 
-      url = self.api.get_stream_url(song_id)
-      code = self._get_player_for_url(url).play()
       if code != 0:
          log.error("player.play returned error: %d", code)
          return False
 
-      log.info("Started player: OK")
+      log.info("Started player: OK (%.3fs, %s)", switch_time, source)
       return True
 
+   def _prefetch_upcoming(self, valid_for=0.0):
+      upcoming = self.upcoming_track_ids(self.prefetch_depth)
+      if self.audio_cache is not None:
+         # Not the current track, which the player is already streaming
+         self.audio_cache.prefetch(upcoming,
+                                   lambda sid: self.url_prefetcher.get(sid)[0])
+         upcoming = [sid for sid in upcoming if sid not in self.audio_cache]
+      self.url_prefetcher.prefetch(upcoming, valid_for=valid_for)
+
+   def _maybe_refresh_upcoming_urls(self):
+      """Fetches the upcoming tracks' stream urls again once the current track
+      is within URL_REFRESH_SECS of its end, if they would expire before then
+      """
+      player = self.player
+      index = self.current_track_index.value
+      if (player is None or index is None or self._urls_refreshed_index == index
+            or not player.is_playing()):
+         return
+      length = player.get_length()
+      if length <= 0 or length - player.get_time() > URL_REFRESH_SECS * 1000:
+         return
+      self._urls_refreshed_index = index
+      self._prefetch_upcoming(valid_for=URL_REFRESH_SECS)
+
    def handle_previous_track_action(self):
       if self.player is not None and self.player.get_position() > 0.1:
          # Song is 10% done. Restart the track rather than going back.
@@ -222,13 +846,13 @@ class TrackPlayer:
          current_track_index = 0
       else:
          current_track_index -= 1
-      self.current_track_index.value = current_track_index
+      self._set_current_track_index(current_track_index)
 
       self.play_current_track()
 
    def play_track_at_index(self, index):
       log.info(index)
-      self.current_track_index.value = index
+      self._set_current_track_index(index)
       return self.play_current_track()
 
    def play_next_track(self):
@@ -251,6 +875,7 @@ class TrackPlayer:
       """
       if self.player is not None:
          self.player.set_position(pos)
+         self._post_event(_WAKE_EVENT)
 
    def skip_to_end(self):
       self.set_position(0.97)
@@ -265,33 +890,75 @@ class TrackPlayer:
          if code != 0:
             log.error("player.play returned error: %d", code)
 
-   def do_thread_loop(self):
-      if self.pending_events:
-         log.debug("n pending_events: %d", len(self.pending_events))
-      while self.pending_events:
-         event = self.pending_events.pop(0)
-         log.debug("event %r", event)
-         if event.track_index != self.current_track_index.value:
-            log.debug("ignoring event for other track")
-            continue
+   def _event_wait_timeout(self):
+      """Returns how long the event handler thread can wait for an event
+      before it needs to refresh the upcoming urls or preroll the next track,
+      or None to wait indefinitely.
+      """
+      player = self.player
+      index = self.current_track_index.value
+      if (player is None or index is None
+            or index + 1 >= len(self.tracks_to_play) or not player.is_playing()):
+         return None
+      # Seconds before the end of the track that each is due
+      leads = []
+      if self._urls_refreshed_index != index:
+         leads.append(URL_REFRESH_SECS)
+      preroll = self._preroll
+      if self.gapless and (preroll is None or preroll.track_index != index + 1):
+         leads.append(self.preroll_secs)
+      if not leads:
+         return None
+      length = player.get_length()
+      if length <= 0:
+         # Not known yet
+         return 1.0
+      until_due = (length - player.get_time()) / 1000 - max(leads)
+      # Not too often, in case prerolling fails
+      return max(until_due, 0.5)
+
+   def handle_event(self, event):
+      log.debug("event %r", event)
+      if event.track_index != self.current_track_index.value:
+         log.debug("ignoring event for other track")
+         return
 
-         if event.event_str == str(vlc.EventType.MediaPlayerEndReached):
-            log.debug("track finished")
-            self.handle_track_finished()
+      if event.event_str == _END_REACHED_EVENT:
+         log.debug("track finished")
+         self.event_loop_stats.end_reaction_times.append(time.monotonic() - event.time)
+         self.handle_track_finished(event.time)
 
    def start_event_handler_thread(self):
       def player_thread():
-         t = threading.currentThread()
-         while getattr(t, "do_run", True):
-            sleep(0.1)
-            self.do_thread_loop()
+         stats = self.event_loop_stats
+         while True:
+            try:
+               event = self.pending_events.get(timeout=self._event_wait_timeout())
+            except queue.Empty:
+               event = None
+               stats.timeouts += 1
+            stats.wakeups += 1
+            if event is not None:
+               if event.event_str == _STOP_EVENT:
+                  break
+               stats.events += 1
+               self.handle_event(event)
+            self._maybe_refresh_upcoming_urls()
+            self._maybe_preroll_next_track()
 
          log.info("MediaPlayer event handler thread exited")
 
-      self.event_handler_thread = threading.Thread(target=player_thread)
+      self.event_handler_thread = threading.Thread(target=player_thread,
+                                                   name="player-events")
       self.event_handler_thread.start()
 
    def stop_event_handler_thread(self):
       if self.event_handler_thread is not None:
-         self.event_handler_thread.do_run = False
+         self._post_event(_STOP_EVENT)
          self.event_handler_thread.join()
+         log.info("Event handler thread: %r", self.event_loop_stats)
+         log.info("VLC callbacks: %r", dict(self.event_dispatcher.counts))
+      self.url_prefetcher.shutdown()
+      if self.audio_cache is not None:
+         log.info("Audio cache: %r", self.audio_cache.stats())
+         self.audio_cache.shutdown()
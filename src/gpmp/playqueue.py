@@ -0,0 +1,220 @@
+"""The queue of tracks to play"""
+
+from collections.abc import Sequence
+from dataclasses import dataclass
+import random
+import threading
+
+from gpmp.log import get_logger
+
+log = get_logger()
+
+INSERT = 'insert'
+REMOVE = 'remove'
+MOVE = 'move'
+RESET = 'reset'
+
+@dataclass
+class QueueChange:
+   """A change to a PlayQueue: count tracks inserted or removed at index, a
+   track moved from index to dest, or the whole queue replaced.
+   """
+   kind: str
+   index: int = 0
+   count: int = 0
+   dest: int = None
+
+   def adjust(self, i):
+      """Returns the position after this change of the track which was at
+      position i before it, or None if it was removed.
+      """
+      if i is None or self.kind == RESET:
+         return None
+      if self.kind == INSERT:
+         return i + self.count if i >= self.index else i
+      if self.kind == REMOVE:
+         if i < self.index:
+            return i
+         if i >= self.index + self.count:
+            return i - self.count
+         return None
+      # MOVE
+      if i == self.index:
+         return self.dest
+      if self.index < i <= self.dest:
+         return i - 1
+      if self.dest <= i < self.index:
+         return i + 1
+      return i
+
+class _Node:
+   """A run of length items of seq from start, in a treap ordered by queue
+   position and heap-ordered by a random priority.
+   """
+   # pylint: disable-msg=too-few-public-methods
+   __slots__ = ('seq', 'start', 'length', 'size', 'priority', 'left', 'right')
+
+   def __init__(self, seq, start, length):
+      self.seq = seq
+      self.start = start
+      self.length = length
+      self.size = length
+      self.priority = random.random()
+      self.left = None
+      self.right = None
+
+def _size(node):
+   return node.size if node is not None else 0
+
+def _update(node):
+   node.size = _size(node.left) + node.length + _size(node.right)
+   return node
+
+def _merge(a, b):
+   if a is None:
+      return b
+   if b is None:
+      return a
+   if a.priority > b.priority:
+      a.right = _merge(a.right, b)
+      return _update(a)
+   b.left = _merge(a, b.left)
+   return _update(b)
+
+def _split(node, k):
+   """Splits node into the first k items and the rest"""
+   if node is None:
+      return None, None
+   left_size = _size(node.left)
+   if k <= left_size:
+      left, node.left = _split(node.left, k)
+      return left, _update(node)
+   if k >= left_size + node.length:
+      node.right, right = _split(node.right, k - left_size - node.length)
+      return _update(node), right
+   # k falls inside this node's run, so the run is split in two.
+   offset = k - left_size
+   head = _Node(node.seq, node.start, offset)
+   tail = _Node(node.seq, node.start + offset, node.length - offset)
+   return _merge(node.left, head), _merge(tail, node.right)
+
+class PlayQueue(Sequence):
+   """Sequence of track ids to play, which can be edited in place.
+
+   Stored as a rope: a balanced tree (treap) of runs of the sequences the
+   queue was made from. The sequences themselves are not copied, so a queue
+   of a lazily shuffled 500k track library is created instantly. Lookups
+   by position, inserts, removes and moves are all O(log n) in the number
+   of edits made.
+
+   change_callbacks are called with a QueueChange after each edit, without
+   the queue's lock held.
+   """
+   def __init__(self, track_ids=()):
+      self._lock = threading.RLock()
+      self._root = None
+      self.change_callbacks = []
+      self._set(track_ids)
+
+   def _set(self, track_ids):
+      self._root = _Node(track_ids, 0, len(track_ids)) if track_ids else None
+
+   def _notify(self, change):
+      for callback in self.change_callbacks:
+         try:
+            callback(change)
+         except Exception as e: # pylint: disable-msg=broad-except
+            log.error("Queue change callback failed: %r", e)
+
+   def __len__(self):
+      return _size(self._root)
+
+   def __getitem__(self, i):
+      if isinstance(i, slice):
+         with self._lock:
+            return [self[j] for j in range(*i.indices(len(self)))]
+      with self._lock:
+         n = len(self)
+         if i < 0:
+            i += n
+         if not 0 <= i < n:
+            raise IndexError(i)
+         node = self._root
+         while True:
+            left_size = _size(node.left)
+            if i < left_size:
+               node = node.left
+            elif i < left_size + node.length:
+               return node.seq[node.start + i - left_size]
+            else:
+               i -= left_size + node.length
+               node = node.right
+
+   def __iter__(self):
+      with self._lock:
+         runs = []
+         stack = []
+         node = self._root
+         while stack or node is not None:
+            while node is not None:
+               stack.append(node)
+               node = node.left
+            node = stack.pop()
+            runs.append((node.seq, node.start, node.length))
+            node = node.right
+      for seq, start, length in runs:
+         for i in range(start, start + length):
+            yield seq[i]
+
+   def reset(self, track_ids):
+      """Replaces the contents of the queue"""
+      with self._lock:
+         self._set(track_ids)
+      self._notify(QueueChange(RESET, count=len(track_ids)))
+
+   def insert(self, index, track_ids):
+      """Inserts track_ids before position index"""
+      track_ids = tuple(track_ids)
+      if not track_ids:
+         return
+      with self._lock:
+         index = max(0, min(index, len(self)))
+         left, right = _split(self._root, index)
+         self._root = _merge(_merge(left, _Node(track_ids, 0, len(track_ids))), right)
+      self._notify(QueueChange(INSERT, index, len(track_ids)))
+
+   def remove(self, index, count=1):
+      """Removes count tracks from position index"""
+      with self._lock:
+         if not 0 <= index < len(self) or count <= 0:
+            raise IndexError(index)
+         count = min(count, len(self) - index)
+         left, rest = _split(self._root, index)
+         _, right = _split(rest, count)
+         self._root = _merge(left, right)
+      self._notify(QueueChange(REMOVE, index, count))
+
+   def move(self, index, dest):
+      """Moves the track at position index so that it is at position dest"""
+      with self._lock:
+         n = len(self)
+         if not 0 <= index < n or not 0 <= dest < n:
+            raise IndexError(index if not 0 <= index < n else dest)
+         if index == dest:
+            return
+         left, rest = _split(self._root, index)
+         moved, right = _split(rest, 1)
+         left, right = _split(_merge(left, right), dest)
+         self._root = _merge(_merge(left, moved), right)
+      self._notify(QueueChange(MOVE, index, 1, dest))
+
+   def base(self):
+      """Returns the sequence the queue was made from if it has not been
+      edited since, else None.
+      """
+      with self._lock:
+         root = self._root
+         if (root is not None and root.left is None and root.right is None
+               and root.start == 0 and root.length == len(root.seq)):
+            return root.seq
+         return None
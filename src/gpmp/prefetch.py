@@ -0,0 +1,148 @@
+"""Background prefetching of stream URLs for upcoming tracks"""
+
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from gpmp.log import get_logger
+
+log = get_logger()
+
+# Used when a URL does not say when it expires
+DEFAULT_URL_TTL = 60.0 # seconds
+# URLs are not handed out this close to their expiry
+EXPIRY_MARGIN = 20.0 # seconds
+
+def url_expiry(url):
+   """Returns the time.monotonic() time at which a signed stream URL should
+   no longer be used, based on its 'expire' (unix time) query parameter.
+   """
+   mono_now = time.monotonic()
+   expire = parse_qs(urlparse(url).query).get('expire')
+   if expire:
+      try:
+         return mono_now + float(expire[0]) - time.time() - EXPIRY_MARGIN
+      except ValueError:
+         pass
+   return mono_now + DEFAULT_URL_TTL
+
+class StreamUrlCache:
+   """Stream URLs by song id, which are dropped once they expire"""
+   def __init__(self):
+      self._urls = {}
+      self._lock = threading.Lock()
+
+   def get(self, song_id, valid_for=0.0):
+      """Returns the url for song_id, if it is good for another valid_for
+      seconds
+      """
+      with self._lock:
+         entry = self._urls.get(song_id)
+         if entry is None:
+            return None
+         url, expires_at = entry
+         now = time.monotonic()
+         if now >= expires_at:
+            del self._urls[song_id]
+            return None
+         if now + valid_for >= expires_at:
+            return None
+         return url
+
+   def put(self, song_id, url):
+      with self._lock:
+         self._urls[song_id] = (url, url_expiry(url))
+
+   def retain(self, song_ids):
+      """Drops all urls except those for song_ids"""
+      with self._lock:
+         for song_id in list(self._urls):
+            if song_id not in song_ids:
+               del self._urls[song_id]
+
+   def clear(self):
+      with self._lock:
+         self._urls.clear()
+
+   def __len__(self):
+      return len(self._urls)
+
+class StreamUrlPrefetcher:
+   """Resolves the stream URLs of upcoming tracks in the background.
+
+   Call prefetch() with the ids of the next tracks whenever the position in
+   the queue changes, and again with valid_for near the end of a track, as
+   urls fetched when it started may expire before it ends. Prefetches for
+   tracks which are no longer upcoming are cancelled (if they have not
+   started yet) and their results dropped.
+   """
+   def __init__(self, api, max_workers=2):
+      self.api = api
+      self.cache = StreamUrlCache()
+      self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                          thread_name_prefix="url-prefetch")
+      self._lock = threading.Lock()
+      self._in_flight = {}
+      self._wanted = set()
+      self.hits = 0
+      self.misses = 0
+
+   def prefetch(self, song_ids, valid_for=0.0):
+      """Fetches the urls of song_ids, except those already fetched which
+      are good for another valid_for seconds
+      """
+      with self._lock:
+         self._wanted = set(song_ids)
+         for song_id in list(self._in_flight):
+            if song_id not in self._wanted and self._in_flight[song_id].cancel():
+               del self._in_flight[song_id]
+
+         for song_id in song_ids:
+            if (song_id not in self._in_flight and
+                  self.cache.get(song_id, valid_for=valid_for) is None):
+               self._in_flight[song_id] = self._executor.submit(self._fetch, song_id)
+      self.cache.retain(self._wanted)
+
+   def _fetch(self, song_id):
+      try:
+         url = self.api.get_stream_url(song_id)
+      except Exception as e: # pylint: disable-msg=broad-except
+         log.warning("Failed to prefetch stream url for %s: %r", song_id, e)
+         url = None
+
+      with self._lock:
+         self._in_flight.pop(song_id, None)
+         if url is not None and song_id in self._wanted:
+            self.cache.put(song_id, url)
+      return url
+
+   def get(self, song_id):
+      """Returns the stream URL for song_id, using a prefetched one if there
+      is a valid one, or waiting on its prefetch if it is in flight.
+      Returns (url, was_prefetched).
+      """
+      url = self.cache.get(song_id)
+      if url is None:
+         with self._lock:
+            future = self._in_flight.get(song_id)
+         if future is not None:
+            try:
+               url = future.result()
+            except CancelledError:
+               pass
+
+      if url is not None:
+         self.hits += 1
+         return url, True
+
+      self.misses += 1
+      return self.api.get_stream_url(song_id), False
+
+   def reset(self):
+      """Drops all prefetches, eg. when the queue is replaced or reshuffled"""
+      self.prefetch([])
+
+   def shutdown(self):
+      self.reset()
+      self._executor.shutdown(wait=False)
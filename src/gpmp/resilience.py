@@ -0,0 +1,195 @@
+"""Retries with backoff, and circuit breakers, for API calls"""
+
+from dataclasses import asdict, dataclass
+import random
+import threading
+import time
+
+from gpmp.log import get_logger
+
+log = get_logger()
+
+# What to do after a failed attempt at a call
+FAIL = 'fail'
+# Fail, without counting against the endpoint's breaker, as the error is down
+# to the call rather than the endpoint (e.g. a track which is not available)
+INVALID = 'invalid'
+RETRY = 'retry'
+# Reauthenticate, then retry straight away
+REAUTH = 'reauth'
+
+@dataclass
+class CallPolicy:
+   """How calls to an endpoint are retried, and when its breaker opens"""
+   max_attempts: int = 3
+   # The delay before retry n (from 1) is a random time of up to
+   # min(max_delay, base_delay * 2 ** (n - 1)) seconds, so that clients which
+   # failed together don't retry together.
+   base_delay: float = 0.5
+   max_delay: float = 8.0
+   # Consecutive failed calls (after their retries) which open the breaker
+   breaker_threshold: int = 5
+   # Seconds the breaker stays open before a trial call is let through
+   breaker_reset_secs: float = 30.0
+
+   def backoff(self, retry, rng=random):
+      return rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** (retry - 1)))
+
+class CircuitOpenError(Exception):
+   """Raised instead of calling an endpoint whose breaker is open"""
+
+class CircuitBreaker:
+   """Opens after threshold consecutive failures, and then fails calls
+   straight away for reset_secs. After that it is half open: one trial call
+   is let through, which closes it if it succeeds or opens it again if not.
+   """
+   CLOSED = 'closed'
+   OPEN = 'open'
+   HALF_OPEN = 'half_open'
+
+   def __init__(self, threshold, reset_secs, clock=time.monotonic):
+      self.threshold = threshold
+      self.reset_secs = reset_secs
+      self.clock = clock
+      self.state = self.CLOSED
+      self.failures = 0
+      self.opened_at = None
+      self._lock = threading.Lock()
+
+   def allow(self):
+      with self._lock:
+         if self.state == self.CLOSED:
+            return True
+         if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_secs:
+            self.state = self.HALF_OPEN
+            return True
+         # Open, or half open with the trial call in flight
+         return False
+
+   def seconds_until_trial(self):
+      with self._lock:
+         if self.state != self.OPEN:
+            return 0.0
+         return max(0.0, self.opened_at + self.reset_secs - self.clock())
+
+   def record_success(self):
+      with self._lock:
+         self.state = self.CLOSED
+         self.failures = 0
+
+   def record_failure(self):
+      """Returns True if this failure opened the breaker"""
+      with self._lock:
+         self.failures += 1
+         if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                                             self.failures >= self.threshold):
+            self.state = self.OPEN
+            self.opened_at = self.clock()
+            return True
+         return False
+
+@dataclass
+class EndpointStats:
+   calls: int = 0
+   successes: int = 0
+   failures: int = 0
+   retries: int = 0
+   # Calls failed straight away because the breaker was open
+   rejected: int = 0
+   breaker_trips: int = 0
+
+class ResilientCaller:
+   """Makes calls to endpoints, retrying them according to the endpoint's
+   CallPolicy, from policies or default_policy. Calls which fail count
+   towards opening the endpoint's breaker, unless the error is INVALID.
+
+   classify(error) returns FAIL, INVALID, RETRY or REAUTH for an error raised
+   by an attempt. For REAUTH, reauthenticate(generation) is called with the value
+   generation() returned before the failed attempt, so that the callers
+   which failed on the same login can share one reauthentication. It returns
+   False if it did not reauthenticate, in which case the retry is backed off
+   as for RETRY.
+   """
+   # pylint: disable-msg=too-many-arguments
+   def __init__(self, classify, reauthenticate=None, generation=lambda: None,
+                policies=None, default_policy=None, sleep=time.sleep, rng=None):
+      self.classify = classify
+      self.reauthenticate = reauthenticate
+      self.generation = generation
+      self.policies = dict(policies or {})
+      self.default_policy = default_policy or CallPolicy()
+      self.sleep = sleep
+      self.rng = rng or random.Random()
+      self._lock = threading.Lock()
+      self._breakers = {}
+      self._stats = {}
+
+   def policy_of(self, endpoint):
+      return self.policies.get(endpoint, self.default_policy)
+
+   def breaker(self, endpoint):
+      with self._lock:
+         breaker = self._breakers.get(endpoint)
+         if breaker is None:
+            policy = self.policy_of(endpoint)
+            breaker = CircuitBreaker(policy.breaker_threshold, policy.breaker_reset_secs)
+            self._breakers[endpoint] = breaker
+            self._stats[endpoint] = EndpointStats()
+         return breaker
+
+   def _count(self, endpoint, name):
+      with self._lock:
+         stats = self._stats[endpoint]
+         setattr(stats, name, getattr(stats, name) + 1)
+
+   def call(self, endpoint, func):
+      """Returns func(), retrying it if it fails. Raises the error of the
+      last attempt, or CircuitOpenError if the breaker is open.
+      """
+      breaker = self.breaker(endpoint)
+      self._count(endpoint, 'calls')
+      if not breaker.allow():
+         self._count(endpoint, 'rejected')
+         raise CircuitOpenError("{} is failing. Not calling it again for {:.0f}s".format(
+            endpoint, breaker.seconds_until_trial()))
+
+      try:
+         result = self._call_with_retries(endpoint, func)
+      except Exception as e:
+         self._count(endpoint, 'failures')
+         if self.classify(e) == INVALID:
+            # The endpoint answered, so it is not failing.
+            breaker.record_success()
+            raise
+         if breaker.record_failure():
+            self._count(endpoint, 'breaker_trips')
+            log.warning("Opened the circuit breaker for %s", endpoint)
+         raise
+      breaker.record_success()
+      self._count(endpoint, 'successes')
+      return result
+
+   def _call_with_retries(self, endpoint, func):
+      policy = self.policy_of(endpoint)
+      attempt = 1
+      while True:
+         generation = self.generation()
+         try:
+            return func()
+         except Exception as e: # pylint: disable-msg=broad-except
+            action = self.classify(e)
+            if action in (FAIL, INVALID) or attempt >= policy.max_attempts:
+               raise
+            log.warning("Attempt %d of %d at %s failed: %r", attempt, policy.max_attempts,
+                        endpoint, e)
+
+         self._count(endpoint, 'retries')
+         if (action != REAUTH or self.reauthenticate is None
+               or not self.reauthenticate(generation)):
+            self.sleep(policy.backoff(attempt, self.rng))
+         attempt += 1
+
+   def stats(self):
+      with self._lock:
+         return {endpoint: dict(asdict(stats), breaker=self._breakers[endpoint].state)
+                 for endpoint, stats in self._stats.items()}
@@ -0,0 +1,215 @@
+"""JSON-RPC over a Unix socket, for controlling a player daemon
+
+Messages are JSON-RPC 2.0 requests and responses, or batches of them, one
+per line.
+"""
+
+from concurrent.futures import Future
+import itertools
+import json
+import os
+import socket
+import tempfile
+import threading
+
+from gpmp.log import get_logger
+
+log = get_logger()
+
+DEFAULT_SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(),
+                                   "gplaymusicplayer.sock")
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+class RpcError(Exception):
+   def __init__(self, code, message, data=None):
+      super().__init__(message)
+      self.code = code
+      self.message = message
+      self.data = data
+
+   def to_json(self):
+      error = {'code': self.code, 'message': self.message}
+      if self.data is not None:
+         error['data'] = self.data
+      return error
+
+   @classmethod
+   def from_json(cls, error):
+      return cls(error.get('code', INTERNAL_ERROR), error.get('message', ""),
+                 error.get('data'))
+
+def encode(message):
+   return json.dumps(message, separators=(',', ':')).encode() + b'\n'
+
+def _result(response):
+   if 'error' in response:
+      return RpcError.from_json(response['error'])
+   return response.get('result')
+
+class PlayerClient:
+   """A connection to a player daemon. Calls can be made from any thread.
+
+   Notifications sent by the daemon (see subscribe()) are passed to
+   notification_callbacks as (method, params), from the client's reader
+   thread.
+   """
+   def __init__(self, path=DEFAULT_SOCKET_PATH, timeout=30.0):
+      self.timeout = timeout
+      self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self._sock.connect(path)
+      self._send_lock = threading.Lock()
+      self._ids = itertools.count(1)
+      # Request id (the lowest id of a batch) -> Future
+      self._pending = {}
+      self._pending_lock = threading.Lock()
+      self.notification_callbacks = []
+      self._reader = threading.Thread(target=self._read_responses,
+                                      name="rpc-client", daemon=True)
+      self._reader.start()
+
+   def _read_responses(self):
+      with self._sock.makefile('rb') as rfile:
+         for line in rfile:
+            try:
+               message = json.loads(line)
+            except ValueError as e:
+               log.error("Bad message from daemon: %r", e)
+               continue
+            self._handle_message(message)
+
+      with self._pending_lock:
+         pending = list(self._pending.values())
+         self._pending.clear()
+      for future in pending:
+         future.set_exception(ConnectionError("Connection to daemon closed"))
+
+   def _handle_message(self, message):
+      if isinstance(message, list):
+         ids = [response.get('id') for response in message
+                if isinstance(response.get('id'), int)]
+         key = min(ids) if ids else None
+      elif 'method' in message:
+         for callback in self.notification_callbacks:
+            try:
+               callback(message['method'], message.get('params'))
+            except Exception as e: # pylint: disable-msg=broad-except
+               log.error("Notification callback failed: %r", e)
+         return
+      else:
+         key = message.get('id')
+
+      with self._pending_lock:
+         future = self._pending.pop(key, None)
+      if future is None:
+         log.error("Unexpected message from daemon: %r", message)
+      else:
+         future.set_result(message)
+
+   def _send(self, key, message):
+      future = Future()
+      with self._pending_lock:
+         self._pending[key] = future
+      try:
+         with self._send_lock:
+            self._sock.sendall(encode(message))
+         return future.result(timeout=self.timeout)
+      finally:
+         with self._pending_lock:
+            self._pending.pop(key, None)
+
+   def call(self, method, *args, **kwargs):
+      """Calls method with either positional or keyword params, and returns
+      its result. Raises RpcError if it failed.
+      """
+      request_id = next(self._ids)
+      request = {'jsonrpc': '2.0', 'method': method, 'id': request_id}
+      if args or kwargs:
+         request['params'] = kwargs if kwargs else list(args)
+      result = _result(self._send(request_id, request))
+      if isinstance(result, RpcError):
+         raise result
+      return result
+
+   def batch(self, calls):
+      """Makes a list of (method, params) calls in one round trip, where
+      params is a list, dict or None. They are run in order. Returns a list
+      of their results, with an RpcError in place of any which failed.
+      """
+      if not calls:
+         return []
+      requests = []
+      for method, params in calls:
+         request = {'jsonrpc': '2.0', 'method': method, 'id': next(self._ids)}
+         if params is not None:
+            request['params'] = params
+         requests.append(request)
+      responses = self._send(requests[0]['id'], requests)
+      by_id = {response.get('id'): response for response in responses}
+      missing = {'error': {'code': INTERNAL_ERROR, 'message': "No response"}}
+      return [_result(by_id.get(request['id'], missing)) for request in requests]
+
+   def subscribe(self, callback=None):
+      """Asks the daemon to send 'state' and 'queue' notifications, and
+      returns its current status.
+      """
+      if callback is not None:
+         self.notification_callbacks.append(callback)
+      return self.call('subscribe')
+
+   def wait_closed(self):
+      """Waits for the daemon to close the connection"""
+      self._reader.join()
+
+   def close(self):
+      try:
+         self._sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+         pass
+      self._sock.close()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *exc_info):
+      self.close()
+
+def _parse_param(arg):
+   try:
+      return json.loads(arg)
+   except ValueError:
+      return arg
+
+def run_command(argv, path=DEFAULT_SOCKET_PATH):
+   """Runs a command given on the command line, as a method name followed by
+   its params, and prints the result. 'watch' prints notifications until
+   interrupted. Returns an exit status.
+   """
+   method, params = argv[0], [_parse_param(arg) for arg in argv[1:]]
+   try:
+      client = PlayerClient(path)
+   except OSError as e:
+      print("Could not connect to the daemon at {}: {}".format(path, e))
+      return 1
+
+   with client:
+      try:
+         if method == 'watch':
+            def on_notification(method, params):
+               print(json.dumps({method: params}), flush=True)
+            print(json.dumps(client.subscribe(on_notification), indent=1), flush=True)
+            try:
+               client.wait_closed()
+            except KeyboardInterrupt:
+               pass
+         else:
+            print(json.dumps(client.call(method, *params), indent=1))
+      except RpcError as e:
+         print("Error {}: {}".format(e.code, e.message))
+         return 1
+   return 0
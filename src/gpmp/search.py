@@ -0,0 +1,337 @@
+"""In-memory search index over the songs in the library
+
+The index is built incrementally from the rows added to the library's
+SongTable since it was last updated, and supports ranked exact, prefix, substring and typo-tolerant
+(edit distance) matching on song titles, artists and albums.
+
+Target latency is under 5ms p99 per query on a 100k track library, with a
+Zipf-distributed vocabulary (roughly how words are distributed in real song
+metadata). Queries on very common short prefixes are bounded by only
+scoring the best _MAX_TERM_ROWS rows for the first term.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+import heapq
+from operator import itemgetter
+import re
+import sys
+import threading
+import unicodedata
+
+from gpmp.log import get_logger
+
+log = get_logger()
+
+TITLE = 0
+ARTIST = 1
+ALBUM = 2
+_FIELD_WEIGHTS = (1.0, 0.8, 0.6)
+_FIELD_BITS = 2
+
+_EXACT_SCORE = 1.0
+_PREFIX_SCORE = 0.8
+_SUBSTRING_SCORE = 0.5
+_FUZZY_SCORE = 0.4
+
+# Limits on how far a single query term can expand, to keep latency bounded
+# for very short or very common terms.
+_MAX_PREFIX_TOKENS = 500
+_MAX_SUBSTRING_TOKENS = 300
+_MAX_FUZZY_CANDIDATES = 50
+# Rows gathered for one term before lower scoring tokens are ignored
+_MAX_TERM_ROWS = 4000
+# Once this few rows are left, the remaining terms are checked directly
+# against the song text rather than through the index.
+_DIRECT_CHECK_ROWS = 100
+
+_WORD_RE = re.compile(r'\w+')
+
+def normalize(text):
+   """Case-folds and strips accents from text"""
+   if text.isascii():
+      return text.lower()
+   text = unicodedata.normalize('NFKD', text.casefold())
+   return ''.join(c for c in text if not unicodedata.combining(c))
+
+def tokenize(text):
+   if not text:
+      return []
+   return _WORD_RE.findall(normalize(text))
+
+def _trigrams(token, pad=False):
+   if pad:
+      token = '$' + token + '$'
+   return {token[i:i+3] for i in range(len(token) - 2)}
+
+def _edit_distance_within(a, b, max_dist):
+   """Returns the Levenshtein distance between a and b, or None if it is
+   greater than max_dist. Only the diagonal band of width max_dist is
+   computed.
+   """
+   len_a = len(a)
+   len_b = len(b)
+   if abs(len_a - len_b) > max_dist:
+      return None
+   over = max_dist + 1
+   prev = [j if j <= max_dist else over for j in range(len_b + 1)]
+   for i in range(1, len_a + 1):
+      ca = a[i - 1]
+      lo = max(1, i - max_dist)
+      hi = min(len_b, i + max_dist)
+      cur = [over] * (len_b + 1)
+      cur[0] = i if i <= max_dist else over
+      row_min = cur[0]
+      for j in range(lo, hi + 1):
+         val = prev[j - 1] if ca == b[j - 1] else prev[j - 1] + 1
+         if prev[j] + 1 < val:
+            val = prev[j] + 1
+         if cur[j - 1] + 1 < val:
+            val = cur[j - 1] + 1
+         cur[j] = val
+         if val < row_min:
+            row_min = val
+      if row_min > max_dist:
+         return None
+      prev = cur
+   return prev[len_b] if prev[len_b] <= max_dist else None
+
+class SearchIndex:
+   """Inverted index from normalized word tokens to song table rows, plus a
+   trigram index over the token vocabulary for substring and fuzzy matches.
+
+   Postings are kept in a separate array per field, so scoring a token's
+   rows is a C-level dict.fromkeys() rather than a Python loop per row.
+   """
+   def __init__(self, songs):
+      self.songs = songs
+      # One {token: array of rows} per field
+      self._postings = ({}, {}, {})
+      # trigram -> set of tokens (vocabulary only, so this stays small)
+      self._trigram_tokens = defaultdict(set)
+      self._vocab = set()
+      self._sorted_tokens = []
+      self._sorted_dirty = False
+      # Rows below this have been indexed
+      self._indexed_rows = 0
+      self._lock = threading.Lock()
+
+   def __len__(self):
+      return len(self._vocab)
+
+   def _row_fields(self, row):
+      return ((TITLE, self.songs.titles[row]),
+              (ARTIST, self.songs.artists[row]),
+              (ALBUM, self.songs.albums[row]))
+
+   def _add_row(self, row):
+      for field, text in self._row_fields(row):
+         postings = self._postings[field]
+         for token in set(tokenize(text)):
+            if token not in self._vocab:
+               token = sys.intern(token)
+               self._vocab.add(token)
+               for trigram in _trigrams(token, pad=True):
+                  self._trigram_tokens[trigram].add(token)
+               self._sorted_dirty = True
+            rows = postings.get(token)
+            if rows is None:
+               rows = array('l')
+               postings[token] = rows
+            rows.append(row)
+
+   def _remove_row(self, row):
+      for field, text in self._row_fields(row):
+         postings = self._postings[field]
+         for token in set(tokenize(text)):
+            rows = postings.get(token)
+            if rows is not None:
+               try:
+                  rows.remove(row)
+               except ValueError:
+                  pass
+
+   def update(self):
+      """Indexes any rows added to the song table since the last update.
+      This is done before each search, but can be called ahead of time to
+      avoid the first search having to index the whole library.
+      """
+      n_rows = len(self.songs.ids)
+      while self._indexed_rows < n_rows:
+         with self._lock:
+            end = min(self._indexed_rows + 1000, n_rows)
+            for row in range(self._indexed_rows, end):
+               self._add_row(row)
+            self._indexed_rows = end
+      self._tokens_sorted()
+
+   def update_row(self, row, change_row):
+      """Calls change_row(), which changes the contents of an existing row in
+      the song table, and reindexes the row if it was already indexed.
+      """
+      with self._lock:
+         indexed = row < self._indexed_rows
+         if indexed:
+            self._remove_row(row)
+         change_row()
+         if indexed:
+            self._add_row(row)
+
+   def _tokens_sorted(self):
+      if self._sorted_dirty:
+         with self._lock:
+            self._sorted_tokens = sorted(self._vocab)
+            self._sorted_dirty = False
+      return self._sorted_tokens
+
+   def _prefix_tokens(self, term):
+      tokens = self._tokens_sorted()
+      i = bisect_left(tokens, term)
+      found = []
+      while i < len(tokens) and tokens[i].startswith(term):
+         found.append(tokens[i])
+         if len(found) >= _MAX_PREFIX_TOKENS:
+            break
+         i += 1
+      return found
+
+   def _substring_tokens(self, term):
+      candidates = None
+      for trigram in sorted(_trigrams(term),
+                            key=lambda t: len(self._trigram_tokens.get(t, ()))):
+         toks = self._trigram_tokens.get(trigram)
+         if not toks:
+            return []
+         candidates = set(toks) if candidates is None else candidates & toks
+         if not candidates:
+            return []
+      found = [t for t in candidates if term in t]
+      if len(found) > _MAX_SUBSTRING_TOKENS:
+         # The shortest are the closest matches
+         found = heapq.nsmallest(_MAX_SUBSTRING_TOKENS, found, key=len)
+      return found
+
+   def _fuzzy_tokens(self, term):
+      max_dist = 1 if len(term) <= 5 else 2
+      counts = defaultdict(int)
+      for trigram in _trigrams(term, pad=True):
+         for token in self._trigram_tokens.get(trigram, ()):
+            counts[token] += 1
+      # Each edit can change at most 3 of the padded trigrams
+      min_shared = max(len(term) - 3 * max_dist, 1)
+      candidates = [t for t, c in counts.items()
+                    if c >= min_shared and abs(len(t) - len(term)) <= max_dist]
+      if len(candidates) > _MAX_FUZZY_CANDIDATES:
+         candidates = heapq.nlargest(_MAX_FUZZY_CANDIDATES, candidates,
+                                     key=counts.__getitem__)
+      found = []
+      for token in candidates:
+         dist = _edit_distance_within(term, token, max_dist)
+         if dist:
+            found.append((token, dist))
+      return found
+
+   def _weighted_postings(self, token_scores):
+      """Returns (score, rows) for each field of each token, best first"""
+      weighted = []
+      for token, token_score in token_scores.items():
+         for field, postings in enumerate(self._postings):
+            rows = postings.get(token)
+            if rows:
+               weighted.append((token_score * _FIELD_WEIGHTS[field], rows))
+      weighted.sort(key=itemgetter(0), reverse=True)
+      return weighted
+
+   def _rows_for_tokens(self, token_scores, restrict_to=None):
+      """Returns {row: best score} for the rows containing any of the tokens.
+      Without restrict_to, only about _MAX_TERM_ROWS of the best scoring rows
+      are gathered.
+      """
+      weighted = self._weighted_postings(token_scores)
+      if restrict_to is None:
+         budget = _MAX_TERM_ROWS
+         for i, (score, rows) in enumerate(weighted):
+            if len(rows) >= budget:
+               weighted[i] = (score, rows[:budget])
+               del weighted[i + 1:]
+               break
+            budget -= len(rows)
+      else:
+         weighted = [(score, restrict_to.intersection(rows))
+                     for score, rows in weighted]
+
+      # Applying the best scores last leaves each row with its best score.
+      row_scores = {}
+      for score, rows in reversed(weighted):
+         row_scores.update(dict.fromkeys(rows, score))
+      return row_scores
+
+   def _n_postings(self, token_scores):
+      return sum(len(postings.get(token, ()))
+                 for token in token_scores for postings in self._postings)
+
+   def _term_token_scores(self, term, limit):
+      """Returns {token: score} for the tokens matching a query term"""
+      token_scores = {}
+      if term in self._vocab:
+         token_scores[term] = _EXACT_SCORE
+      for token in self._prefix_tokens(term):
+         token_scores.setdefault(token, _PREFIX_SCORE)
+      if len(term) >= 3:
+         for token in self._substring_tokens(term):
+            token_scores.setdefault(token, _SUBSTRING_SCORE)
+
+      # Typo tolerance is only a fallback, when the term matches too little.
+      if len(term) >= 4 and self._n_postings(token_scores) < limit:
+         for token, dist in self._fuzzy_tokens(term):
+            token_scores.setdefault(token, _FUZZY_SCORE / dist)
+      return token_scores
+
+   def _score_row_directly(self, row, token_scores):
+      """Returns the score the index would give row for a term's
+      token_scores, from the row's text
+      """
+      best = 0.0
+      for field, text in self._row_fields(row):
+         for token in tokenize(text):
+            score = token_scores.get(token)
+            if score is not None:
+               best = max(best, score * _FIELD_WEIGHTS[field])
+      return best
+
+   def search_rows(self, query, limit=50):
+      """Returns up to limit (row, score) pairs, best first.
+      Rows must match every word in the query.
+      """
+      self.update()
+      terms = [(term, self._term_token_scores(term, limit))
+               for term in set(tokenize(query))]
+      if not terms:
+         return []
+      # Start from the term matching the fewest rows, and narrow down from there.
+      terms.sort(key=lambda tt: self._n_postings(tt[1]))
+
+      scores = self._rows_for_tokens(terms[0][1])
+      for _, token_scores in terms[1:]:
+         if not scores:
+            break
+         if len(scores) <= _DIRECT_CHECK_ROWS:
+            for row in list(scores):
+               score = self._score_row_directly(row, token_scores)
+               if score:
+                  scores[row] += score
+               else:
+                  del scores[row]
+         else:
+            term_scores = self._rows_for_tokens(token_scores, restrict_to=set(scores))
+            scores = {row: scores[row] + score for row, score in term_scores.items()}
+
+      ids = self.songs.ids
+      top = heapq.nlargest(limit, scores, key=scores.__getitem__)
+      return [(row, scores[row]) for row in top if ids[row] is not None]
+
+   def search(self, query, limit=50):
+      """Returns up to limit song ids matching query, best first"""
+      ids = self.songs.ids
+      return [ids[row] for row, _ in self.search_rows(query, limit=limit)]
@@ -0,0 +1,189 @@
+"""Lazy shuffling of track lists
+
+Shuffling doesn't copy or reorder the track list. A ShuffledTracks is a view
+over it in the order of a seeded pseudo-random permutation, which is worked
+out as tracks are played, so starting to play a shuffled 500k track library
+takes no longer than a 10 track playlist.
+"""
+
+from array import array
+from collections import Counter, deque
+from collections.abc import Sequence
+from itertools import compress
+import random
+
+_GOLDEN = 0x9e3779b97f4a7c15
+# Positions which the shuffle constraints are applied to together
+_BLOCK_SIZE = 256
+# Tracks held back at once by the shuffle constraints, before they are
+# given up on and played anyway.
+_MAX_DEFERRED = 32
+
+class FeistelPermutation:
+   """A pseudo-random permutation of range(n), computed one index at a time.
+
+   Indices are passed through a balanced Feistel network over the smallest
+   power of 4 that is at least n, and values beyond n are fed back through it
+   (cycle walking) until they land in range. Memory use is constant and
+   lookups are O(1) on average.
+   """
+   _ROUNDS = 4
+
+   def __init__(self, n, seed=None):
+      self.n = n
+      self._half_bits = (max((n - 1).bit_length(), 2) + 1) // 2
+      self._half_mask = (1 << self._half_bits) - 1
+      rng = random.Random(seed)
+      self._keys = tuple(rng.getrandbits(64) for _ in range(self._ROUNDS))
+
+   def _encrypt(self, value):
+      half_bits = self._half_bits
+      mask = self._half_mask
+      left = value >> half_bits
+      right = value & mask
+      for key in self._keys:
+         # Multiplicative hash of the right half as the round function
+         left, right = right, left ^ (((right ^ key) * _GOLDEN) >> 32) & mask
+      return (left << half_bits) | right
+
+   def __len__(self):
+      return self.n
+
+   def __getitem__(self, i):
+      if not 0 <= i < self.n:
+         raise IndexError(i)
+      value = self._encrypt(i)
+      while value >= self.n:
+         value = self._encrypt(value)
+      return value
+
+class RecentlyPlayed:
+   """Ring buffer of the last maxlen track ids played, with O(1) lookups"""
+   def __init__(self, maxlen=100):
+      self.maxlen = maxlen
+      self._ring = deque()
+      self._counts = Counter()
+
+   def add(self, song_id):
+      if self.maxlen <= 0:
+         return
+      if len(self._ring) >= self.maxlen:
+         old = self._ring.popleft()
+         self._counts[old] -= 1
+         if not self._counts[old]:
+            del self._counts[old]
+      self._ring.append(song_id)
+      self._counts[song_id] += 1
+
+   def __contains__(self, song_id):
+      return song_id in self._counts
+
+   def __len__(self):
+      return len(self._ring)
+
+   def __iter__(self):
+      return iter(self._counts)
+
+class ShuffledTracks(Sequence):
+   """A shuffled view of a sequence of track ids. None entries (removed
+   songs in a SongTable's ids column) are skipped, and tracks removed after
+   the shuffle was made are replaced by the next one still there.
+
+   Optionally, tracks by the same artist as any of the previous artist_spread
+   tracks, or which were in recent (eg. a RecentlyPlayed) when the shuffle was
+   made, are held back until a later position. This is done separately for
+   each block of _BLOCK_SIZE positions, so any position can be looked up
+   without working out all the ones before it. It is best effort: if too many
+   tracks are held back at once, or the end of the block is reached, the
+   longest held is played anyway.
+   """
+   # pylint: disable-msg=too-many-instance-attributes
+   def __init__(self, track_ids, seed=None, artist_of=None, artist_spread=0,
+                recent=None):
+      self.track_ids = track_ids
+      self.seed = seed
+      if None in track_ids:
+         # Indices of the tracks to shuffle
+         self._indices = array('l', compress(
+            range(len(track_ids)), (song_id is not None for song_id in track_ids)))
+      else:
+         self._indices = range(len(track_ids))
+      self._len = len(self._indices)
+      self._perm = FeistelPermutation(self._len, seed)
+      self._artist_of = artist_of if artist_spread > 0 else None
+      self._artist_spread = artist_spread
+      self._recent = frozenset(recent) if recent else frozenset()
+      # Without anything to hold back, position i is just perm[i].
+      self._direct = self._artist_of is None and not self._recent
+      # Indices into track_ids in play order, of the blocks worked out so far
+      self._blocks = {}
+
+   def __len__(self):
+      return self._len
+
+   def __getitem__(self, i):
+      if isinstance(i, slice):
+         return [self[j] for j in range(*i.indices(self._len))]
+      if i < 0:
+         i += self._len
+      if not 0 <= i < self._len:
+         raise IndexError(i)
+      for j in range(self._len):
+         song_id = self.track_ids[self._index_at((i + j) % self._len)]
+         if song_id is not None:
+            return song_id
+      raise IndexError(i)
+
+   def _index_at(self, i):
+      if self._direct:
+         return self._indices[self._perm[i]]
+      block_num, offset = divmod(i, _BLOCK_SIZE)
+      block = self._blocks.get(block_num)
+      if block is None:
+         block = self._blocks[block_num] = self._order_block(block_num)
+      return block[offset]
+
+   def _fits(self, song_id, last_artists):
+      if song_id in self._recent:
+         return False
+      if self._artist_of is not None:
+         artist = self._artist_of(song_id)
+         if artist is not None and artist in last_artists:
+            return False
+      return True
+
+   def _order_block(self, block_num):
+      """Returns the indices into track_ids of a block's positions in order"""
+      start = block_num * _BLOCK_SIZE
+      stop = min(start + _BLOCK_SIZE, self._len)
+      candidates = deque(self._indices[self._perm[i]] for i in range(start, stop))
+      last_artists = deque(maxlen=max(self._artist_spread, 1))
+      if self._artist_of is not None:
+         # Spread from the artists ending the previous block, in shuffled
+         # rather than held back order, so that it needn't be worked out
+         for i in range(max(start - self._artist_spread, 0), start):
+            last_artists.append(self._artist_of(self.track_ids[self._indices[self._perm[i]]]))
+
+      order = array('l')
+      deferred = deque()
+      def emit(index):
+         order.append(index)
+         if self._artist_of is not None:
+            last_artists.append(self._artist_of(self.track_ids[index]))
+
+      while candidates or deferred:
+         for k, index in enumerate(deferred):
+            if self._fits(self.track_ids[index], last_artists):
+               del deferred[k]
+               emit(index)
+               break
+         else:
+            while candidates and len(deferred) < _MAX_DEFERRED:
+               index = candidates.popleft()
+               if self._fits(self.track_ids[index], last_artists):
+                  emit(index)
+                  break
+               deferred.append(index)
+            else:
+               emit(deferred.popleft())
+      return order
@@ -0,0 +1,227 @@
+"""Latency distributions, scripted fault timelines and bandwidth throttling,
+for simulating a slow or failing server
+
+Latencies are given in specs of milliseconds:
+   fixed:200
+   uniform:50,400
+   lognormal:120,2000   (p50 and p99)
+
+A fault timeline has one event per line, of seconds from its start to its
+end, a regex of the endpoints it applies to, and the fault:
+   # start end endpoint fault
+   10 20 get_stream_url timeout
+   30 60 . lognormal:500,4000
+   repeat 90
+Faults are timeout, connection or error, or a latency spec, which delays
+calls instead. 'repeat SECS' restarts the timeline every SECS seconds.
+"""
+
+from dataclasses import dataclass
+import math
+import re
+import threading
+import time
+
+from gpmp.log import get_logger
+
+log = get_logger()
+
+FAULTS = ('timeout', 'connection', 'error')
+
+# The standard normal quantile of 0.99
+_Z_99 = 2.3263478740408408
+
+class FixedLatency:
+   def __init__(self, secs):
+      self.secs = secs
+
+   def sample(self, rng): # pylint: disable-msg=unused-argument
+      return self.secs
+
+   def __repr__(self):
+      return 'fixed:{:g}'.format(self.secs * 1000)
+
+class UniformLatency:
+   def __init__(self, low, high):
+      self.low = low
+      self.high = high
+
+   def sample(self, rng):
+      return rng.uniform(self.low, self.high)
+
+   def __repr__(self):
+      return 'uniform:{:g},{:g}'.format(self.low * 1000, self.high * 1000)
+
+class LognormalLatency:
+   """Latencies with a long tail, given by their median and 99th percentile,
+   as measured from a real server
+   """
+   def __init__(self, p50, p99):
+      if not 0 < p50 <= p99:
+         raise ValueError("Need 0 < p50 <= p99, not {}, {}".format(p50, p99))
+      self.p50 = p50
+      self.p99 = p99
+      self.mu = math.log(p50)
+      self.sigma = (math.log(p99) - self.mu) / _Z_99
+
+   def sample(self, rng):
+      return rng.lognormvariate(self.mu, self.sigma)
+
+   def __repr__(self):
+      return 'lognormal:{:g},{:g}'.format(self.p50 * 1000, self.p99 * 1000)
+
+_DISTRIBUTIONS = {
+   'fixed': (FixedLatency, 1),
+   'uniform': (UniformLatency, 2),
+   'lognormal': (LognormalLatency, 2),
+}
+
+def parse_latency(spec):
+   """Returns the distribution of a latency spec, such as 'lognormal:120,2000'.
+   Raises ValueError if it is not valid.
+   """
+   kind, _, params = spec.partition(':')
+   if kind not in _DISTRIBUTIONS:
+      raise ValueError("Unknown latency distribution {!r} (expected one of {})".format(
+         kind, ', '.join(_DISTRIBUTIONS)))
+   cls, num_params = _DISTRIBUTIONS[kind]
+   try:
+      values = [float(param) / 1000 for param in params.split(',')]
+   except ValueError:
+      raise ValueError("Latency spec {!r} has non-numeric values".format(spec)) from None
+   if len(values) != num_params:
+      raise ValueError("{} latency takes {} value(s) in ms, not {!r}".format(
+         kind, num_params, params))
+   return cls(*values)
+
+def parse_endpoint_latency(spec):
+   """Parses 'ENDPOINT_RE=LATENCY_SPEC' into (compiled regex, distribution)"""
+   pattern, sep, latency = spec.rpartition('=')
+   if not sep:
+      pattern, latency = '.', spec
+   return re.compile(pattern), parse_latency(latency)
+
+class _CallFailure(Exception):
+   def __init__(self, message, callname):
+      super().__init__(message)
+      self.callname = callname
+
+class _NotLoggedIn(Exception):
+   pass
+
+def api_errors():
+   """Returns gmusicapi's (CallFailure, NotLoggedIn) exceptions, or stand-ins
+   for them if gmusicapi is not installed, as the fake backend doesn't need it
+   """
+   try:
+      from gmusicapi import exceptions # pylint: disable-msg=import-outside-toplevel
+   except ImportError:
+      return _CallFailure, _NotLoggedIn
+   return exceptions.CallFailure, exceptions.NotLoggedIn
+
+def raise_fault(fault, endpoint):
+   """Raises the error a call to endpoint fails with for fault"""
+   # Only imported when failing, as the client will have imported it
+   import requests # pylint: disable-msg=import-outside-toplevel
+   if fault == 'timeout':
+      raise requests.exceptions.ReadTimeout("Simulated timeout for " + endpoint)
+   if fault == 'connection':
+      raise requests.exceptions.ConnectionError("Simulated connection error for " + endpoint)
+   call_failure, _ = api_errors()
+   raise call_failure("Simulated server error", endpoint)
+
+@dataclass
+class FaultEvent:
+   start: float
+   end: float
+   endpoint_re: re.Pattern
+   # One of FAULTS, or None if it is latency
+   fault: str = None
+   latency: object = None
+
+class FaultTimeline:
+   """Faults which apply to calls made between each event's start and end,
+   in seconds since start() was called
+   """
+   def __init__(self, events, repeat_secs=None, clock=time.monotonic):
+      self.events = list(events)
+      self.repeat_secs = repeat_secs
+      self.clock = clock
+      self._started_at = None
+
+   @classmethod
+   def parse(cls, text):
+      events = []
+      repeat_secs = None
+      for line_num, line in enumerate(text.splitlines(), 1):
+         fields = line.split('#', 1)[0].split()
+         if not fields:
+            continue
+         try:
+            if fields[0] == 'repeat' and len(fields) == 2:
+               repeat_secs = float(fields[1])
+               continue
+            if len(fields) != 4:
+               raise ValueError("expected 'START END ENDPOINT_RE FAULT'")
+            start, end, pattern, fault = fields
+            event = FaultEvent(float(start), float(end), re.compile(pattern))
+            if fault in FAULTS:
+               event.fault = fault
+            else:
+               event.latency = parse_latency(fault)
+         except (ValueError, re.error) as e:
+            raise ValueError("Fault timeline line {}: {}".format(line_num, e)) from None
+         events.append(event)
+      return cls(events, repeat_secs=repeat_secs)
+
+   @classmethod
+   def load(cls, path):
+      with open(path) as f:
+         return cls.parse(f.read())
+
+   def start(self):
+      self._started_at = self.clock()
+      log.info("Started a fault timeline of %d events", len(self.events))
+
+   def stop(self):
+      self._started_at = None
+
+   @property
+   def running(self):
+      return self._started_at is not None
+
+   def events_for(self, endpoint):
+      """Returns the events which apply to a call to endpoint now"""
+      started_at = self._started_at
+      if started_at is None:
+         return []
+      elapsed = self.clock() - started_at
+      if self.repeat_secs:
+         elapsed %= self.repeat_secs
+      return [event for event in self.events
+              if event.start <= elapsed < event.end and event.endpoint_re.search(endpoint)]
+
+class Throttle:
+   """Limits the bytes per second passed through consume(), across all the
+   threads sharing it, with a token bucket of up to a tenth of a second's
+   worth of bytes. A rate of 0 is unlimited.
+   """
+   def __init__(self, rate=0):
+      self.rate = rate
+      self._tokens = 0.0
+      self._last = time.monotonic()
+      self._lock = threading.Lock()
+
+   def consume(self, num_bytes):
+      """Waits until num_bytes can pass"""
+      rate = self.rate
+      if rate <= 0:
+         return
+      with self._lock:
+         now = time.monotonic()
+         self._tokens = min(rate / 10, self._tokens + (now - self._last) * rate)
+         self._last = now
+         self._tokens -= num_bytes
+         wait = -self._tokens / rate
+      if wait > 0:
+         time.sleep(wait)
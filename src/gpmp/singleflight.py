@@ -0,0 +1,157 @@
+"""Sharing of identical API calls made at the same time"""
+
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+import time
+
+# Returned by SingleFlight._lookup when there is no memoized result, as None
+# may be one
+_MISSING = object()
+
+def _chain(source):
+   """Returns a new Future which completes with source"""
+   future = Future()
+   def copy(source):
+      if source.cancelled():
+         future.cancel()
+      elif source.exception() is not None:
+         future.set_exception(source.exception())
+      else:
+         future.set_result(source.result())
+   source.add_done_callback(copy)
+   return future
+
+def call_key(args, kwargs):
+   """Returns a key identifying a call's arguments, or None if they are not
+   hashable.
+   """
+   key = (args, tuple(sorted(kwargs.items())))
+   try:
+      hash(key)
+   except TypeError:
+      return None
+   return key
+
+class SingleFlight:
+   """Calls to one of the endpoints in ttls, with the same arguments as a call
+   already in flight, wait for and share its result or error rather than
+   making their own. Results are also remembered for the endpoint's ttl in
+   seconds (0 to only share in-flight calls), up to max_memo results.
+
+   Shared results are the same object for every caller, so must not be
+   modified.
+   """
+   # pylint: disable-msg=too-many-instance-attributes
+   def __init__(self, ttls, max_memo=256, clock=time.monotonic):
+      self.ttls = dict(ttls)
+      self.max_memo = max_memo
+      self.clock = clock
+      self._lock = threading.Lock()
+      # (endpoint, key) -> Future of the call in flight
+      self._in_flight = {}
+      # (endpoint, key) -> (expiry time, result), oldest first
+      self._memo = OrderedDict()
+
+      # Calls to shared endpoints, and how they were answered
+      self.calls = 0
+      self.executed = 0
+      self.joined = 0
+      self.memo_hits = 0
+
+   def _lookup(self, endpoint, key):
+      """Must be called with the lock held. Returns (memoized result, Future in
+      flight). Without a memoized result, the first is _MISSING, and without a
+      call in flight the second is None.
+      """
+      self.calls += 1
+      entry = self._memo.get((endpoint, key))
+      if entry is not None:
+         expires_at, result = entry
+         if self.clock() < expires_at:
+            self.memo_hits += 1
+            return result, None
+         del self._memo[(endpoint, key)]
+      future = self._in_flight.get((endpoint, key))
+      if future is not None:
+         self.joined += 1
+      return _MISSING, future
+
+   def _finish(self, endpoint, key, future):
+      with self._lock:
+         if self._in_flight.get((endpoint, key)) is future:
+            del self._in_flight[(endpoint, key)]
+         ttl = self.ttls[endpoint]
+         if ttl > 0 and not future.cancelled() and future.exception() is None:
+            self._memo.pop((endpoint, key), None)
+            self._memo[(endpoint, key)] = (self.clock() + ttl, future.result())
+            while len(self._memo) > self.max_memo:
+               self._memo.popitem(last=False)
+
+   def call(self, endpoint, args, kwargs, func):
+      """Returns func(), or the result of the identical call in flight"""
+      key = call_key(args, kwargs) if endpoint in self.ttls else None
+      if key is None:
+         return func()
+
+      with self._lock:
+         result, future = self._lookup(endpoint, key)
+         if future is None and result is _MISSING:
+            self.executed += 1
+            leader = Future()
+            self._in_flight[(endpoint, key)] = leader
+      if future is not None:
+         return future.result()
+      if result is not _MISSING:
+         return result
+
+      try:
+         result = func()
+      except Exception as e:
+         leader.set_exception(e)
+         raise
+      else:
+         leader.set_result(result)
+         return result
+      finally:
+         self._finish(endpoint, key, leader)
+
+   def submit(self, endpoint, args, kwargs, submit):
+      """Returns the Future from submit(), or one for the identical call in
+      flight. Cancelling the Future of the call which was submitted cancels
+      it for the calls sharing it too.
+      """
+      key = call_key(args, kwargs) if endpoint in self.ttls else None
+      if key is None:
+         return submit()
+
+      with self._lock:
+         result, future = self._lookup(endpoint, key)
+         if future is not None:
+            return _chain(future)
+         if result is not _MISSING:
+            future = Future()
+            future.set_result(result)
+            return future
+         self.executed += 1
+         future = submit()
+         self._in_flight[(endpoint, key)] = future
+      future.add_done_callback(lambda future: self._finish(endpoint, key, future))
+      return future
+
+   def clear(self):
+      with self._lock:
+         self._memo.clear()
+
+   def stats(self):
+      with self._lock:
+         shared = self.joined + self.memo_hits
+         return {
+            'calls': self.calls,
+            'executed': self.executed,
+            'joined': self.joined,
+            'memo_hits': self.memo_hits,
+            'memo_size': len(self._memo),
+            # Fraction of calls answered without a request of their own
+            'dedup_ratio': shared / self.calls if self.calls else 0.0,
+         }
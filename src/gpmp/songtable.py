@@ -0,0 +1,164 @@
+"""Compact column storage for the songs in the library"""
+
+from array import array
+import sys
+import threading
+
+def _intern(val):
+   if val is None:
+      return None
+   return sys.intern(val)
+
+def art_url_of(song):
+   """Returns the url of the first album art image of a raw song dict"""
+   refs = song.get('albumArtRef')
+   if not refs:
+      return None
+   return refs[0].get('url')
+
+class SongView:
+   """A read-only, dict-like view of one row of a SongTable.
+   The raw gmusicapi song dict is available under 'song' if the table
+   was given a raw_loader, and is fetched on each access.
+   """
+   __slots__ = ('_table', '_row')
+   KEYS = ('id', 'title', 'artist', 'album', 'durationMillis', 'song')
+
+   def __init__(self, table, row):
+      self._table = table
+      self._row = row
+
+   def __getitem__(self, key):
+      table = self._table
+      row = self._row
+      if key == 'title':
+         return table.titles[row]
+      if key == 'artist':
+         return table.artists[row]
+      if key == 'album':
+         return table.albums[row]
+      if key == 'id':
+         return table.ids[row]
+      if key == 'durationMillis':
+         return table.durations[row]
+      if key == 'song':
+         return table.load_raw(table.ids[row])
+      raise KeyError(key)
+
+   def get(self, key, default=None):
+      try:
+         return self[key]
+      except KeyError:
+         return default
+
+   def keys(self):
+      return self.KEYS
+
+   def __repr__(self):
+      return "SongView({!r}: {!r} - {!r})".format(self['id'], self['title'],
+                                                   self['artist'])
+
+class SongTable:
+   """Stores song fields in parallel columns indexed by an integer row,
+   rather than keeping a dict per song. Repeated strings (artists, albums)
+   are interned so they are only stored once.
+
+   Supports the subset of the dict interface the player used on the old
+   {song_id: song_info} dict: get(), [], in, len(), keys() and iteration
+   over ids.
+
+   Rows of removed songs are left in place with no id, so row numbers stay
+   stable while other threads are reading. Rows below len(ids) are complete
+   in every column, so they can be read without the lock.
+   """
+   def __init__(self, raw_loader=None):
+      self.raw_loader = raw_loader
+      self._rows = {}
+      self.ids = []
+      self.titles = []
+      self.artists = []
+      self.albums = []
+      self.durations = array('l')
+      # Shared by the songs of an album, so interned like artists
+      self.art_urls = []
+      self._write_lock = threading.Lock()
+
+   def load_raw(self, song_id):
+      if self.raw_loader is None:
+         return None
+      return self.raw_loader(song_id)
+
+   def add(self, song_id, title, artist, album=None, duration_ms=0, art_url=None):
+      """Adds or replaces a song. Returns its row."""
+      with self._write_lock:
+         row = self._rows.get(song_id)
+         if row is None:
+            row = len(self.ids)
+            self.titles.append(title)
+            self.artists.append(_intern(artist))
+            self.albums.append(_intern(album))
+            self.durations.append(duration_ms)
+            self.art_urls.append(_intern(art_url))
+            # Last, as readers take len(ids) as the number of rows, without
+            # the lock
+            self.ids.append(song_id)
+            self._rows[song_id] = row
+         else:
+            self.titles[row] = title
+            self.artists[row] = _intern(artist)
+            self.albums[row] = _intern(album)
+            self.durations[row] = duration_ms
+            self.art_urls[row] = _intern(art_url)
+         return row
+
+   def add_song(self, song):
+      """Adds a raw gmusicapi song dict"""
+      return self.add(song['id'], song.get('title'), song.get('artist'),
+                      album=song.get('album'),
+                      duration_ms=int(song.get('durationMillis', 0)),
+                      art_url=art_url_of(song))
+
+   def remove(self, song_id):
+      with self._write_lock:
+         row = self._rows.pop(song_id, None)
+         if row is not None:
+            self.ids[row] = None
+            self.titles[row] = None
+            self.artists[row] = None
+            self.albums[row] = None
+            self.durations[row] = 0
+            self.art_urls[row] = None
+
+   def row_of(self, song_id):
+      return self._rows.get(song_id)
+
+   def view(self, row):
+      return SongView(self, row)
+
+   def get(self, song_id, default=None):
+      row = self._rows.get(song_id)
+      if row is None:
+         return default
+      return SongView(self, row)
+
+   def __getitem__(self, song_id):
+      return SongView(self, self._rows[song_id])
+
+   def __setitem__(self, song_id, song_info):
+      self.add(song_id, song_info.get('title'), song_info.get('artist'),
+               album=song_info.get('album'),
+               duration_ms=int(song_info.get('durationMillis', 0)),
+               art_url=art_url_of(song_info))
+
+   def __contains__(self, song_id):
+      return song_id in self._rows
+
+   def __len__(self):
+      return len(self._rows)
+
+   def __iter__(self):
+      return iter(self.keys())
+
+   def keys(self):
+      # Snapshot, since the table may be added to while iterating.
+      return list(self._rows)
@@ -0,0 +1,182 @@
+"""Concurrent startup of the API client, library and player"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+import threading
+import time
+
+from gpmp.log import get_logger
+
+log = get_logger()
+
+class StageSkipped(Exception):
+   """Set as the error of a stage which did not run, because one of its
+   dependencies failed.
+   """
+
+@dataclass
+class StageTiming:
+   start: float # seconds since the scheduler was started
+   duration: float
+   error: Exception = None
+
+class _Stage:
+   # pylint: disable-msg=too-few-public-methods
+   def __init__(self, name, func, deps):
+      self.name = name
+      self.func = func
+      self.deps = tuple(deps)
+      self.submitted = False
+      self.future = Future()
+
+class StartupScheduler:
+   """Runs named stages on a bounded thread pool. Each stage is started as
+   soon as all the stages it depends on have finished successfully.
+   """
+   def __init__(self, max_workers=4):
+      self.max_workers = max_workers
+      self._executor = None
+      self._stages = {}
+      self._lock = threading.Lock()
+      self._start_time = None
+      self.timings = {}
+      # Called with (stage name, error or None) from the pool threads.
+      self.stage_done_callbacks = []
+      # Called with (stage name, items done so far) from the pool threads.
+      self.progress_callbacks = []
+
+   def add_stage(self, name, func, deps=()):
+      for dep in deps:
+         if dep not in self._stages:
+            raise ValueError("Stage {} depends on unknown stage {}".format(name, dep))
+      self._stages[name] = _Stage(name, func, deps)
+
+   def has_stage(self, name):
+      return name in self._stages
+
+   def start(self):
+      self._start_time = time.monotonic()
+      self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                          thread_name_prefix="startup")
+      self._schedule_ready_stages()
+
+   def _schedule_ready_stages(self):
+      skipped = []
+      with self._lock:
+         for stage in self._stages.values():
+            if stage.submitted:
+               continue
+            dep_futures = [self._stages[d].future for d in stage.deps]
+            if not all(f.done() for f in dep_futures):
+               continue
+
+            stage.submitted = True
+            failed = [d for d, f in zip(stage.deps, dep_futures) if f.exception()]
+            if failed:
+               skipped.append((stage, failed))
+            else:
+               self._executor.submit(self._run_stage, stage)
+
+      for stage, failed in skipped:
+         self._finish_stage(stage, time.monotonic(), None,
+                            StageSkipped("{} failed".format(', '.join(failed))))
+
+   def _run_stage(self, stage):
+      start = time.monotonic()
+      result = None
+      error = None
+      try:
+         result = stage.func()
+      except Exception as e: # pylint: disable-msg=broad-except
+         log.error("Startup stage %s failed: %r", stage.name, e)
+         error = e
+      self._finish_stage(stage, start, result, error)
+
+   def _finish_stage(self, stage, start, result, error):
+      self.timings[stage.name] = StageTiming(start - self._start_time,
+                                             time.monotonic() - start, error)
+      if error is None:
+         stage.future.set_result(result)
+      else:
+         stage.future.set_exception(error)
+
+      for callback in self.stage_done_callbacks:
+         try:
+            callback(stage.name, error)
+         except Exception as e: # pylint: disable-msg=broad-except
+            log.error("Stage done callback for %s failed: %r", stage.name, e)
+
+      self._schedule_ready_stages()
+      if len(self.timings) == len(self._stages):
+         log.info("Startup finished:\n%s", self.timing_report())
+
+   def report_progress(self, name, n_done):
+      for callback in self.progress_callbacks:
+         callback(name, n_done)
+
+   def is_done(self, name):
+      return self._stages[name].future.done()
+
+   def succeeded(self, name):
+      future = self._stages[name].future
+      return future.done() and future.exception() is None
+
+   def wait(self, name=None, timeout=None):
+      """Waits for one stage, or all stages if name is None.
+      Returns the stage's result, or raises its exception.
+      """
+      if name is None:
+         for stage in self._stages.values():
+            stage.future.exception(timeout=timeout)
+         return None
+      return self._stages[name].future.result(timeout=timeout)
+
+   def shutdown(self):
+      if self._executor is not None:
+         self._executor.shutdown(wait=False)
+
+   def timing_report(self):
+      lines = []
+      for name, timing in sorted(self.timings.items(), key=lambda t: t[1].start):
+         line = "{:<20} +{:7.3f}s {:7.3f}s".format(name, timing.start, timing.duration)
+         if timing.error is not None:
+            line += "  ({!r})".format(timing.error)
+         lines.append(line)
+      return '\n'.join(lines)
+
+def make_startup_scheduler(api, library, player, authenticate=True, max_workers=4,
+                           loader=None, hotkeys=False):
+   """Creates the startup pipeline:
+      auth ----------+---> songs -------+---> playlist_contents
+      cache ---------+---> playlists ---+
+                           songs -----------> search_index
+      player
+      hotkeys (if enabled)
+   Playlist contents are filled in the background ahead of time, so opening a
+   playlist usually does not need to wait on the network. With a loader, they
+   are loaded as background priority jobs on it.
+   """
+   scheduler = StartupScheduler(max_workers=max_workers)
+   fetch_deps = ['cache']
+   if authenticate:
+      scheduler.add_stage('auth', api.authenticate)
+      fetch_deps.append('auth')
+
+   scheduler.add_stage('cache', library.load_cached)
+   scheduler.add_stage('player', lambda: player.initialize(load_library=False))
+   if hotkeys:
+      scheduler.add_stage('hotkeys', player.enable_hotkeys)
+   scheduler.add_stage(
+      'songs',
+      lambda: library.sync_songs(
+         on_songs_page=lambda n: scheduler.report_progress('songs', n)),
+      deps=fetch_deps)
+   scheduler.add_stage('playlists', library.sync_playlists, deps=fetch_deps)
+   scheduler.add_stage(
+      'playlist_contents',
+      lambda: library.fill_playlist_contents(
+         loader=loader,
+         on_playlist_loaded=lambda n: scheduler.report_progress('playlist_contents', n)),
+      deps=['songs', 'playlists'])
+   scheduler.add_stage('search_index', library.update_search_index, deps=['songs'])
+   return scheduler
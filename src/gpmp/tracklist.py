@@ -0,0 +1,132 @@
+"""Qt model for the track list"""
+
+from PySide2 import QtCore, QtGui
+
+from gpmp.log import get_logger
+from gpmp.playqueue import INSERT, MOVE, REMOVE, QueueChange
+
+log = get_logger()
+
+UNKNOWN_SONG_STR = "Unknown - Unknown"
+# Rows waiting on album art to be loaded, above which they are forgotten
+_MAX_ART_WAITING_ROWS = 1000
+
+class TrackListModel(QtCore.QAbstractListModel):
+   """A list model over a sequence of song ids, eg. the player's PlayQueue.
+
+   Nothing is stored per row. Each row's text is read from the library when
+   the view asks for it, which it only does for the rows on screen, so
+   showing a 500k track queue costs no more than a 10 track one.
+
+   The row count is kept separately from the sequence, and only changes on
+   set_tracks() and apply_queue_change(), so that the view always sees a
+   count consistent with the changes it has been told about.
+
+   If given an ArtworkCache, rows are decorated with album art thumbnails of
+   art_size pixels. Until a thumbnail has loaded, a blank one is shown so
+   the text doesn't move when it arrives.
+   """
+   def __init__(self, parent=None, artwork=None, art_size=24):
+      super().__init__(parent)
+      self._song_ids = ()
+      self._library = None
+      self._row_count = 0
+      self.artwork = artwork
+      self.art_size = art_size
+      self._blank_art = None
+      if artwork is not None:
+         self._blank_art = QtGui.QImage(art_size, art_size,
+                                        QtGui.QImage.Format_ARGB32_Premultiplied)
+         self._blank_art.fill(QtCore.Qt.transparent)
+      # art url -> rows shown without their art
+      self._art_waiting = {}
+      self._n_art_waiting = 0
+
+   def set_tracks(self, song_ids, library):
+      self.beginResetModel()
+      self._song_ids = song_ids
+      self._library = library
+      self._row_count = len(song_ids)
+      self._art_waiting.clear()
+      self._n_art_waiting = 0
+      self.endResetModel()
+
+   def song_id(self, row):
+      if not 0 <= row < self._row_count:
+         return None
+      try:
+         return self._song_ids[row]
+      except IndexError:
+         return None
+
+   def song_str(self, song_id):
+      songs = self._library.songs if self._library is not None else None
+      row = songs.row_of(song_id) if songs is not None else None
+      if row is None:
+         log.debug("Could not find track info for %s", song_id)
+         return UNKNOWN_SONG_STR
+      return "{0} - {1}".format(songs.titles[row], songs.artists[row])
+
+   def art_url(self, song_id):
+      songs = self._library.songs if self._library is not None else None
+      row = songs.row_of(song_id) if songs is not None else None
+      return None if row is None else songs.art_urls[row]
+
+   def _art(self, row):
+      url = self.art_url(self.song_id(row))
+      image = self.artwork.get(url, self.art_size)
+      if image is not None:
+         return image
+      if url is not None:
+         if self._n_art_waiting >= _MAX_ART_WAITING_ROWS:
+            # Scrolled a long way without it loading. Those rows are off
+            # screen by now.
+            self._art_waiting.clear()
+            self._n_art_waiting = 0
+         self._art_waiting.setdefault(url, []).append(row)
+         self._n_art_waiting += 1
+      return self._blank_art
+
+   def art_loaded(self, url, size):
+      """Repaints the rows which were shown without the art at url"""
+      if size != self.art_size:
+         return
+      rows = self._art_waiting.pop(url, None)
+      if not rows:
+         return
+      self._n_art_waiting -= len(rows)
+      # Rows may have moved since, which at worst repaints the wrong ones.
+      first = self.index(max(min(rows), 0))
+      last = self.index(min(max(rows), self._row_count - 1))
+      if first.isValid() and last.isValid():
+         self.dataChanged.emit(first, last, [QtCore.Qt.DecorationRole])
+
+   # Overrides
+   def rowCount(self, parent=QtCore.QModelIndex()): # pylint: disable-msg=invalid-name
+      return 0 if parent.isValid() else self._row_count
+
+   def data(self, index, role=QtCore.Qt.DisplayRole):
+      if not index.isValid():
+         return None
+      if role == QtCore.Qt.DisplayRole:
+         return self.song_str(self.song_id(index.row()))
+      if role == QtCore.Qt.DecorationRole and self.artwork is not None:
+         return self._art(index.row())
+      return None
+
+   def apply_queue_change(self, change: QueueChange):
+      """Tells views about a change which has been made to the sequence"""
+      root = QtCore.QModelIndex()
+      if change.kind == INSERT:
+         self.beginInsertRows(root, change.index, change.index + change.count - 1)
+         self._row_count += change.count
+         self.endInsertRows()
+      elif change.kind == REMOVE:
+         self.beginRemoveRows(root, change.index, change.index + change.count - 1)
+         self._row_count -= change.count
+         self.endRemoveRows()
+      elif change.kind == MOVE:
+         # Qt wants the row it goes before, in the positions before the move
+         dest = change.dest + 1 if change.dest > change.index else change.dest
+         self.beginMoveRows(root, change.index, change.index, root, dest)
+         self.endMoveRows()
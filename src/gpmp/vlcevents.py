@@ -0,0 +1,53 @@
+"""Routing of VLC media player events to handlers"""
+
+from collections import Counter
+import threading
+import weakref
+
+from gpmp.log import get_logger
+
+log = get_logger()
+
+class EventDispatcher:
+   """Dispatches VLC events to handlers by event type.
+
+   handlers maps the names of vlc.EventType members to a handler(event,
+   player), so that vlc need not be imported until a player is attached. Only
+   those event types are subscribed to, and each player is subscribed once
+   however many times it is attached, so callbacks don't pile up as a player
+   is reused for track after track.
+   """
+   def __init__(self, handlers):
+      self.handlers = dict(handlers)
+      # vlc.EventType -> handler, once a player has been attached
+      self._handlers_by_type = None
+      self._attached = weakref.WeakSet()
+      self._lock = threading.Lock()
+      # str(event type) -> callbacks fired
+      self.counts = Counter()
+
+   def attach(self, player):
+      """Subscribes to player's events, if not already subscribed"""
+      with self._lock:
+         if player in self._attached:
+            return
+         self._attached.add(player)
+         if self._handlers_by_type is None:
+            import vlc # pylint: disable-msg=import-outside-toplevel
+            self._handlers_by_type = {getattr(vlc.EventType, name): handler
+                                      for name, handler in self.handlers.items()}
+      event_manager = player.event_manager()
+      for event_type in self._handlers_by_type:
+         event_manager.event_attach(event_type, self._dispatch, player)
+
+   def _dispatch(self, event, player):
+      with self._lock:
+         self.counts[str(event.type)] += 1
+      handler = self._handlers_by_type.get(event.type)
+      if handler is None:
+         return
+      try:
+         handler(event, player)
+      except Exception as e: # pylint: disable-msg=broad-except
+         # Exceptions must not propagate into VLC's thread
+         log.error("Handler for %s failed: %r", event.type, e)
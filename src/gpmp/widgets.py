@@ -54,3 +54,27 @@ class MediaSlider(QtWidgets.QSlider):
                                             slider_max - slider_min, # span (int)
                                             opt.upsideDown # upside down (bool)
                                             )
+
+class TrackListView(QtWidgets.QTableView):
+   """A single column table view, used as a list view for very long lists.
+
+   QListView asks the model for an index for every row whenever it lays out
+   its items, which is a Python call per row with a Python model. A table
+   view with fixed height rows only asks about the rows on screen.
+   """
+   def __init__(self, parent=None):
+      super().__init__(parent)
+      self.horizontalHeader().hide()
+      self.horizontalHeader().setStretchLastSection(True)
+      self.verticalHeader().hide()
+      self.verticalHeader().setSectionResizeMode(QtWidgets.QHeaderView.Fixed)
+      self.verticalHeader().setDefaultSectionSize(self.fontMetrics().height() + 4)
+      self.setShowGrid(False)
+      self.setWordWrap(False)
+      self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+
+   def set_icon_size(self, size):
+      """Sets the size of the rows' decorations, making rows tall enough for them"""
+      self.setIconSize(QtCore.QSize(size, size))
+      self.verticalHeader().setDefaultSectionSize(
+         max(self.fontMetrics().height(), size) + 4)
@@ -4,22 +4,31 @@
 import argparse
 import os
 import signal
+import sys
 
 from setproctitle import setproctitle
-from system_hotkey import SystemHotkey
 
 from gpmp.api import Client
+from gpmp.audiocache import AUDIO_CACHE_DIR, AudioCache
+from gpmp.cache import LIBRARY_CACHE_FILE, LibraryCache, user_cache_dir
+from gpmp.loader import LoaderService
 from gpmp.log import get_logger
+from gpmp.metrics import REGISTRY, start_metrics_server
 from gpmp.player import Library, TrackPlayer
-from gpmp.util import pdb # pylint: disable-msg=unused-import
+from gpmp.rpc import DEFAULT_SOCKET_PATH
+from gpmp.simulation import FaultTimeline, parse_endpoint_latency
+from gpmp.startup import make_startup_scheduler
+from gpmp.util import pdb, wait_for_interrupt # pylint: disable-msg=unused-import
 
 log = get_logger()
 
 def main():
+   rand_seed = None
    if "RANDSEED" in os.environ:
       # pylint: disable-msg=import-outside-toplevel
       import random
-      random.seed(int(os.environ["RANDSEED"]))
+      rand_seed = int(os.environ["RANDSEED"])
+      random.seed(rand_seed)
 
    setproctitle("gplaymusicplayer")
 
@@ -27,10 +36,79 @@ def main():
    parser.add_argument('--all-songs', action='store_true',
                        help="Play all songs in the library, rather than selecting a "
                             "playlist (CLI mode only)")
+   parser.add_argument('--search', type=str, default=None,
+                       help="Play the songs matching a search query, rather than "
+                            "selecting a playlist (CLI mode only)")
    parser.add_argument('--no-gui', action='store_true', default=False,
                        help="Run in CLI mode")
+   parser.add_argument('--daemon', action='store_true',
+                       help="Run headless, controlled over a Unix socket (see --remote)")
+   parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET_PATH,
+                       help="Path of the daemon's control socket")
+   parser.add_argument('--remote', nargs='+', metavar=('METHOD', 'PARAMS'),
+                       help="Call a method of a running daemon and print the result, "
+                            "e.g. --remote status, --remote seek 0.5, or --remote watch "
+                            "to print its notifications")
    parser.add_argument('--gui-only-test', action='store_true',
                        help="Don't load the player (for testing)")
+   parser.add_argument('--no-library-cache', action='store_true',
+                       help="Don't read or write the on-disk library cache")
+   parser.add_argument('--prefetch-depth', type=int, default=2,
+                       help="Number of upcoming tracks to fetch stream urls for in "
+                            "advance (0 to disable)")
+   parser.add_argument('--audio-cache-mb', type=int, default=1024,
+                       help="Size of the on-disk cache of played tracks, in MiB "
+                            "(0 to disable)")
+   parser.add_argument('--no-gapless', action='store_true',
+                       help="Don't open the next track in a second player before "
+                            "the current one ends")
+   parser.add_argument('--artist-spread', type=int, default=2,
+                       help="When shuffling, avoid playing an artist again within "
+                            "this many tracks (0 to disable)")
+   parser.add_argument('--avoid-recent', type=int, default=100,
+                       help="When shuffling, hold back tracks played within the last "
+                            "this many tracks (0 to disable)")
+   parser.add_argument('--progress-interval-ms', type=int, default=500,
+                       help="How often the progress bar is updated while a track is "
+                            "playing and the window is visible")
+   parser.add_argument('--loader-workers', type=int, default=4,
+                       help="Number of threads loading playlists in the background")
+   parser.add_argument('--api-workers', type=int, default=4,
+                       help="Number of threads for API calls run in the background")
+   parser.add_argument('--no-album-art', action='store_true',
+                       help="Don't show album art (GUI mode only)")
+   parser.add_argument('--art-memory-mb', type=int, default=16,
+                       help="Memory for decoded album art thumbnails, in MiB")
+   parser.add_argument('--art-cache-mb', type=int, default=64,
+                       help="Size of the on-disk cache of album art thumbnails, in MiB")
+   parser.add_argument('--metrics-port', type=int, default=0,
+                       help="Serve metrics for Prometheus at http://localhost:PORT/metrics "
+                            "(and as JSON at /metrics.json)")
+   parser.add_argument('--metrics-json', type=str, default=None,
+                       help="Write a JSON snapshot of the metrics to this file on exit")
+   parser.add_argument('--import-report', action='store_true',
+                       help="Print the time taken by the imports made at startup in "
+                            "GUI (or with --no-gui, CLI) mode, and exit")
+   parser.add_argument('--import-budget-ms', type=float, default=None,
+                       help="With --import-report, exit with an error if the startup "
+                            "imports take longer than this")
+   parser.add_argument('--fake-songs', type=int, default=0,
+                       help="Debug flag - use a local fake backend with a synthetic library "
+                            "of this many songs, rather than Google's servers")
+   parser.add_argument('--fake-playlists', type=int, default=20,
+                       help="Debug flag - number of playlists in the fake library")
+   parser.add_argument('--fake-playlist-size', type=int, default=50,
+                       help="Debug flag - number of tracks in each fake playlist")
+   parser.add_argument('--fake-page-size', type=int, default=1000,
+                       help="Debug flag - items per page of the fake backend's paged calls")
+   parser.add_argument('--fake-latency-ms', type=float, default=0,
+                       help="Debug flag - time taken by each fake backend request")
+   parser.add_argument('--fake-jitter-ms', type=float, default=0,
+                       help="Debug flag - random extra time of up to this for each fake "
+                            "backend request")
+   parser.add_argument('--fake-failure-rate', type=float, default=0,
+                       help="Debug flag - rate (0.0 - 1.0) at which fake backend requests "
+                            "fail with a connection error")
    parser.add_argument('--error-sim-rate', type=float, default=1.0,
                        help="Debug flag - rate (0.0 - 1.0) at which simulated errors occur")
    parser.add_argument('--error-sim-attr-re', type=str, default=None,
@@ -40,9 +118,51 @@ def main():
                        help="Debug flag - enable API error simulations")
    parser.add_argument('--error-sim-timeout', type=int, default=0,
                        help="Debug flag - timeout in seconds for API error simulations")
+   parser.add_argument('--error-sim-latency', action='append', default=[],
+                       metavar='[ENDPOINT_RE=]SPEC',
+                       help="Debug flag - delay api calls matching ENDPOINT_RE (all if "
+                            "not given) by a latency from SPEC, in ms: fixed:MS, "
+                            "uniform:LOW,HIGH or lognormal:P50,P99. May be repeated; the "
+                            "first match applies")
+   parser.add_argument('--error-sim-bandwidth-kbps', type=float, default=0,
+                       help="Debug flag - limit stream downloads to this many KiB/s")
+   parser.add_argument('--error-sim-timeline', type=str, default=None,
+                       help="Debug flag - file of scripted faults to run from startup "
+                            "(see gpmp/simulation.py)")
    args = parser.parse_args()
 
-   api = Client()
+   if args.import_report:
+      from gpmp.importtime import check_startup_imports # pylint: disable-msg=import-outside-toplevel
+      sys.exit(0 if check_startup_imports(gui=not args.no_gui,
+                                          budget_ms=args.import_budget_ms) else 1)
+   if args.remote:
+      from gpmp.rpc import run_command # pylint: disable-msg=import-outside-toplevel
+      sys.exit(run_command(args.remote, path=args.socket))
+
+   metrics_server = None
+   if args.metrics_port:
+      metrics_server = start_metrics_server(args.metrics_port)
+
+   fake_backend = None
+   library_cache_path = LIBRARY_CACHE_FILE
+   audio_cache_dir = AUDIO_CACHE_DIR
+   if args.fake_songs > 0:
+      from gpmp.fakeapi import FakeBackend, FakeConfig # pylint: disable-msg=import-outside-toplevel
+      fake_backend = FakeBackend(FakeConfig(
+         songs=args.fake_songs, playlists=args.fake_playlists,
+         playlist_size=args.fake_playlist_size, page_size=args.fake_page_size,
+         latency=args.fake_latency_ms / 1000, jitter=args.fake_jitter_ms / 1000,
+         failure_rate=args.fake_failure_rate))
+      # Kept apart from the real library's caches
+      fake_cache_dir = os.path.join(user_cache_dir(), "fake")
+      library_cache_path = os.path.join(fake_cache_dir, "library.sqlite3")
+      audio_cache_dir = os.path.join(fake_cache_dir, "audio")
+      api = Client(max_workers=args.api_workers, mobileclient_factory=fake_backend)
+      # Simulated slow downloads are applied by its audio server, so that they
+      # slow the player's streams too, rather than by the audio cache
+      fake_backend.throttle = api.download_throttle
+   else:
+      api = Client(max_workers=args.api_workers)
    # Set up error simulation settings
    api.set_simulated_error_rate(args.error_sim_rate)
    if args.error_sim_attr_re:
@@ -53,20 +173,62 @@ def main():
          api.simulate_timeouts = True
       else:
          api.simulate_immediate_error = True
+   try:
+      for spec in args.error_sim_latency:
+         api.add_simulated_latency(*parse_endpoint_latency(spec))
+      if args.error_sim_timeline:
+         api.fault_timeline = FaultTimeline.load(args.error_sim_timeline)
+   except (OSError, ValueError) as e:
+      parser.error(str(e))
+   api.simulate_latency = bool(args.error_sim_latency)
+   if args.error_sim_bandwidth_kbps > 0:
+      api.simulated_bandwidth = int(args.error_sim_bandwidth_kbps * 1024)
+      api.set_simulated_bandwidth(True)
+   if api.fault_timeline is not None:
+      api.fault_timeline.start()
 
-   hotkey_mgr = SystemHotkey()
-   library = Library(api)
-   player = TrackPlayer(api, hotkey_mgr, library)
+   library = Library(api, cache=None if args.no_library_cache else LibraryCache(library_cache_path))
+   audio_cache = None
+   if args.audio_cache_mb > 0:
+      audio_cache = AudioCache(directory=audio_cache_dir,
+                               max_bytes=args.audio_cache_mb * 1024 * 1024,
+                               throttle=None if fake_backend else api.download_throttle)
+   # Hotkeys are set up by a startup stage
+   player = TrackPlayer(api, None, library, prefetch_depth=args.prefetch_depth,
+                        audio_cache=audio_cache, gapless=not args.no_gapless,
+                        artist_spread=args.artist_spread, avoid_recent=args.avoid_recent,
+                        shuffle_seed=rand_seed)
 
+   # Authentication and the library load run concurrently, in the background.
+   loader = LoaderService(max_workers=args.loader_workers)
+   startup = None
    if not args.gui_only_test:
-      api.authenticate()
+      startup = make_startup_scheduler(api, library, player, loader=loader, hotkeys=True)
+   else:
+      player.enable_hotkeys()
 
-   if not args.no_gui:
+   if args.daemon:
+      from gpmp.daemon import PlayerDaemon # pylint: disable-msg=import-outside-toplevel
+      if startup is not None:
+         startup.start()
+      daemon = PlayerDaemon(player, library, path=args.socket)
+      daemon.start()
+      # Exits cleanly, removing the socket, when stopped with SIGTERM too
+      signal.signal(signal.SIGTERM, signal.default_int_handler)
+      wait_for_interrupt()
+      daemon.shutdown()
+   elif not args.no_gui:
       # pylint: disable-msg=import-outside-toplevel
       from gpmp import gui
+      from gpmp.artwork import ArtworkCache
       app = gui.make_app()
-      _controller = gui.QtController(app, api, player,
-                                     init_player=not args.gui_only_test)
+      artwork = None
+      if not args.no_album_art:
+         artwork = ArtworkCache(max_memory_bytes=args.art_memory_mb * 1024 * 1024,
+                                max_disk_bytes=args.art_cache_mb * 1024 * 1024)
+      _controller = gui.QtController(app, api, player, startup=startup,
+                                     progress_interval_ms=args.progress_interval_ms,
+                                     loader=loader, artwork=artwork)
 
       def sighandler(signum, _frame):
          if signum == signal.SIGINT:
@@ -76,12 +238,32 @@ def main():
       signal.signal(signal.SIGINT, sighandler)
       app.exec_()
       signal.signal(signal.SIGINT, signal.SIG_DFL)
+      if artwork is not None:
+         artwork.shutdown()
    else:
       from gpmp import cliui # pylint: disable-msg=import-outside-toplevel
-      ui = cliui.CliUI(player, api, play_all_songs=args.all_songs)
+      if startup is not None:
+         startup.start()
+         # The rest (e.g. playlist contents) can finish in the background.
+         for stage in ('player', 'songs', 'playlists'):
+            startup.wait(stage)
+      ui = cliui.CliUI(player, api, play_all_songs=args.all_songs,
+                       search_query=args.search)
       ui.exec_()
 
+   if startup is not None:
+      startup.shutdown()
+   loader.shutdown()
    player.stop_event_handler_thread()
+   api.shutdown()
+   if fake_backend is not None:
+      log.info("Fake backend: %r", fake_backend.stats())
+      fake_backend.shutdown()
+   if metrics_server is not None:
+      metrics_server.shutdown()
+   if args.metrics_json:
+      with open(args.metrics_json, 'w') as f:
+         f.write(REGISTRY.to_json())
 
 if __name__ == '__main__':
    main()
@@ -0,0 +1,20 @@
+"""gpmp is imported from src, as gplaymusicplayer runs it"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'src'))
+
+def pytest_configure(config):
+   config.addinivalue_line('markers',
+                           "slow: long soak and memory runs (deselect with -m 'not slow')")
+
+@pytest.fixture
+def fake_vlc(monkeypatch):
+   """Makes gpmp import the simulated vlc in tests/fakevlc.py"""
+   import fakevlc # pylint: disable-msg=import-outside-toplevel
+   monkeypatch.setitem(sys.modules, 'vlc', fakevlc)
+   return fakevlc
@@ -0,0 +1,171 @@
+"""A simulated python-vlc, for running TrackPlayer without libvlc
+
+Only the parts of the MediaPlayer API which gpmp uses are there. Media
+plays in real time: opening it takes OPEN_SECS, and MediaPlayerEndReached
+is sent from a timer thread once its length has passed. Local WAV files
+are as long as their audio, and anything else is DEFAULT_LENGTH_SECS long.
+"""
+
+import threading
+import time
+import wave
+
+OPEN_SECS = 0.05
+DEFAULT_LENGTH_SECS = 60.0
+
+class EventType:
+   MediaPlayerEndReached = 'MediaPlayerEndReached'
+   MediaPlayerEncounteredError = 'MediaPlayerEncounteredError'
+   MediaPlayerLengthChanged = 'MediaPlayerLengthChanged'
+   MediaPlayerPaused = 'MediaPlayerPaused'
+   MediaPlayerPlaying = 'MediaPlayerPlaying'
+   MediaPlayerPositionChanged = 'MediaPlayerPositionChanged'
+   MediaPlayerStopped = 'MediaPlayerStopped'
+   MediaPlayerTimeChanged = 'MediaPlayerTimeChanged'
+
+class Event:
+   def __init__(self, event_type):
+      self.type = event_type
+
+class EventManager:
+   def __init__(self):
+      # event type -> [(callback, args)]
+      self.callbacks = {}
+
+   def event_attach(self, event_type, callback, *args):
+      self.callbacks.setdefault(event_type, []).append((callback, args))
+      return 0
+
+   @property
+   def attached(self):
+      """The number of callbacks attached"""
+      return sum(len(callbacks) for callbacks in self.callbacks.values())
+
+   def send(self, event_type):
+      event = Event(event_type)
+      for callback, args in list(self.callbacks.get(event_type, ())):
+         callback(event, *args)
+
+def _length_secs(mrl):
+   if mrl.endswith('.wav'):
+      try:
+         with wave.open(mrl) as wav:
+            return wav.getnframes() / wav.getframerate()
+      except FileNotFoundError:
+         pass
+   return DEFAULT_LENGTH_SECS
+
+class MediaPlayer:
+   # pylint: disable-msg=too-many-instance-attributes
+   def __init__(self, mrl=None):
+      self._events = EventManager()
+      self._lock = threading.RLock()
+      self._mrl = None
+      self._options = ()
+      self._length = None
+      # Seconds played before _started_at, or all of them if not playing
+      self._played = 0.0
+      self._started_at = None
+      self._timer = None
+      if mrl is not None:
+         self.set_mrl(mrl)
+
+   def event_manager(self):
+      return self._events
+
+   def set_mrl(self, mrl, *options):
+      self.stop()
+      self._mrl = mrl
+      self._options = options
+      self._length = None
+      self._played = 0.0
+      return 0
+
+   def _open(self):
+      if self._length is None:
+         time.sleep(OPEN_SECS)
+         self._length = _length_secs(self._mrl)
+
+   def play(self):
+      with self._lock:
+         if self._mrl is None:
+            return -1
+         if self._started_at is not None:
+            return 0
+         opening = self._length is None
+         self._open()
+         if opening and ':start-paused' in self._options:
+            return 0
+         self._started_at = time.monotonic()
+         self._start_timer()
+      self._events.send(EventType.MediaPlayerPlaying)
+      return 0
+
+   def _start_timer(self):
+      self._timer = threading.Timer(max(self._length - self._played, 0), self._end)
+      self._timer.daemon = True
+      self._timer.start()
+
+   def _stop_timer(self):
+      if self._timer is not None:
+         self._timer.cancel()
+         self._timer = None
+
+   def _end(self):
+      with self._lock:
+         if self._started_at is None:
+            return
+         self._started_at = None
+         self._played = self._length
+         self._timer = None
+      self._events.send(EventType.MediaPlayerEndReached)
+
+   def pause(self):
+      with self._lock:
+         if self._started_at is None:
+            return
+         self._played = self._elapsed()
+         self._started_at = None
+         self._stop_timer()
+      self._events.send(EventType.MediaPlayerPaused)
+
+   def stop(self):
+      with self._lock:
+         was_open = self._length is not None
+         self._stop_timer()
+         self._started_at = None
+         self._played = 0.0
+      if was_open:
+         self._events.send(EventType.MediaPlayerStopped)
+
+   def release(self):
+      self.stop()
+
+   def _elapsed(self):
+      if self._started_at is None:
+         return self._played
+      return min(self._played + time.monotonic() - self._started_at, self._length)
+
+   def is_playing(self):
+      return int(self._started_at is not None)
+
+   def get_length(self):
+      """In ms, or 0 until the media has been opened"""
+      return int((self._length or 0) * 1000)
+
+   def get_time(self):
+      return int(self._elapsed() * 1000)
+
+   def get_position(self):
+      return self._elapsed() / self._length if self._length else 0.0
+
+   def set_position(self, pos):
+      with self._lock:
+         if not self._length:
+            return
+         playing = self._started_at is not None
+         self._stop_timer()
+         self._played = pos * self._length
+         if playing:
+            self._started_at = time.monotonic()
+            self._start_timer()
@@ -0,0 +1,55 @@
+"""A TrackPlayer which plays local WAV files, for use with fakevlc"""
+
+import wave
+
+from gpmp.player import Library, TrackPlayer
+from gpmp.songtable import SongTable
+
+def write_wav(path, secs, rate=8000):
+   """Writes secs of silence as 8-bit mono audio"""
+   with wave.open(str(path), 'wb') as wav:
+      wav.setnchannels(1)
+      wav.setsampwidth(1)
+      wav.setframerate(rate)
+      wav.writeframes(b'\x80' * int(secs * rate))
+
+class LocalFilesApi:
+   """Answers get_stream_url with the path of a local file"""
+   def __init__(self, paths):
+      self.paths = paths
+      self.stream_url_calls = 0
+
+   def is_authenticated(self):
+      return True
+
+   def get_stream_url(self, song_id):
+      self.stream_url_calls += 1
+      return self.paths[song_id]
+
+def local_player(tmp_path, count, track_secs, files=None, **kwargs):
+   """Returns a started TrackPlayer with count tracks queued, and their ids.
+   The tracks share the first files (all of them by default) WAV files of
+   track_secs each.
+   """
+   files = count if files is None else files
+   paths = []
+   for i in range(files):
+      path = tmp_path / 'track{}.wav'.format(i)
+      write_wav(path, track_secs)
+      paths.append(str(path))
+
+   song_ids = ['local-{}'.format(i) for i in range(count)]
+   api = LocalFilesApi({song_id: paths[i % files] for i, song_id in enumerate(song_ids)})
+   library = Library(api)
+   library.songs = SongTable()
+   for i, song_id in enumerate(song_ids):
+      library.songs.add(song_id, 'Track {}'.format(i), 'Artist {}'.format(i))
+   kwargs.setdefault('prefetch_depth', 0)
+   player = TrackPlayer(api, None, library, **kwargs)
+   player.set_tracks_to_play(song_ids)
+   return player, song_ids
+
+def stop_player(player):
+   if player.player is not None:
+      player.player.stop()
+   player.stop_event_handler_thread()
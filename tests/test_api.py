@@ -0,0 +1,234 @@
+"""Client's HTTP session and call executor, against a local mock of the
+Mobileclient's endpoints
+"""
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('requests')
+
+# pylint: disable-msg=wrong-import-position
+from gpmp.api import Client
+from gpmp.fakeapi import FakeBackend, FakeConfig, FakeMobileclient
+from gpmp.metrics import MetricsRegistry
+from gpmp.simulation import raise_fault
+
+class MockServer:
+   """Answers POST /<endpoint> with a JSON body, after the endpoint's
+   latency. Counts the connections made to it, and the most requests to
+   each endpoint in flight at once.
+   """
+   # pylint: disable-msg=too-many-instance-attributes
+   def __init__(self, latency=0.0):
+      self.latency = latency
+      # endpoint -> latency, overriding the default
+      self.latencies = {}
+      self.connections = 0
+      self.peak_in_flight = Counter()
+      self._in_flight = Counter()
+      self._lock = threading.Lock()
+      server = self
+
+      class Handler(BaseHTTPRequestHandler):
+         protocol_version = 'HTTP/1.1'
+
+         def setup(self):
+            super().setup()
+            with server._lock: # pylint: disable-msg=protected-access
+               server.connections += 1
+
+         def do_POST(self): # pylint: disable-msg=invalid-name
+            endpoint = self.path.strip('/')
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            server.enter(endpoint)
+            try:
+               time.sleep(server.latencies.get(endpoint, server.latency))
+            finally:
+               server.leave(endpoint)
+            body = json.dumps({'endpoint': endpoint, 'args': request}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+         def log_message(self, format, *args): # pylint: disable-msg=redefined-builtin
+            pass
+
+      self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+      self.httpd.daemon_threads = True
+      self.url = 'http://127.0.0.1:{}/'.format(self.httpd.server_address[1])
+      threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+   def enter(self, endpoint):
+      with self._lock:
+         self._in_flight[endpoint] += 1
+         self.peak_in_flight[endpoint] = max(self.peak_in_flight[endpoint],
+                                             self._in_flight[endpoint])
+
+   def leave(self, endpoint):
+      with self._lock:
+         self._in_flight[endpoint] -= 1
+
+   def shutdown(self):
+      self.httpd.shutdown()
+      self.httpd.server_close()
+
+class HttpMobileclient:
+   """The Mobileclient methods Client uses, each a request to a MockServer
+   sent on the http_session given by Client
+   """
+   OAUTH_FILEPATH = os.devnull
+   FROM_MAC_ADDRESS = object()
+
+   def __init__(self, http_session, url):
+      self.session = http_session
+      self.url = url
+      self._authenticated = False
+
+   def _make_call(self, endpoint, *args):
+      resp = self.session.post(self.url + endpoint, json=list(args), timeout=10)
+      resp.raise_for_status()
+      return resp.json()
+
+   def is_authenticated(self):
+      return self._authenticated
+
+   def perform_oauth(self, storage_filepath=None): # pylint: disable-msg=unused-argument
+      return None
+
+   def oauth_login(self, device_id, oauth_credentials=None): # pylint: disable-msg=unused-argument
+      self._make_call('oauth_login')
+      self._authenticated = True
+      return True
+
+   def get_stream_url(self, song_id):
+      return self._make_call('get_stream_url', song_id)
+
+   def get_all_playlists(self):
+      return self._make_call('get_all_playlists')
+
+@pytest.fixture
+def server():
+   mock = MockServer()
+   yield mock
+   mock.shutdown()
+
+def _client(server, **kwargs):
+   """An authenticated Client of the mock server. Identical calls are not
+   shared, so that each is a request.
+   """
+   client = Client(mobileclient_factory=lambda session: HttpMobileclient(session, server.url),
+                   shared_endpoints={}, metrics=MetricsRegistry(), **kwargs)
+   client.authenticate()
+   return client
+
+def test_reauthentication_keeps_the_connection(server):
+   client = _client(server)
+   try:
+      for n in range(10):
+         client.authenticate()
+         assert client.get_stream_url('song-{}'.format(n))['args'] == ['song-{}'.format(n)]
+   finally:
+      client.shutdown()
+   assert client.reauths == 10
+   assert server.connections == 1
+
+def test_submitted_calls_are_limited_per_endpoint(server):
+   server.latency = 0.02
+   client = _client(server, max_workers=4, endpoint_limits={'get_stream_url': 2})
+   try:
+      start = time.monotonic()
+      futures = [client.submit('get_stream_url', 'song-{}'.format(n)) for n in range(20)]
+      results = [future.result(timeout=10) for future in futures]
+      elapsed = time.monotonic() - start
+   finally:
+      client.shutdown()
+   assert [r['args'] for r in results] == [['song-{}'.format(n)] for n in range(20)]
+   assert server.peak_in_flight['get_stream_url'] == 2
+   # 10 rounds of two calls at a time
+   assert elapsed >= 10 * 0.02
+   assert server.connections <= 2
+
+def test_direct_calls_count_against_the_limit(server):
+   server.latency = 0.02
+   client = _client(server, max_workers=4, endpoint_limits={'get_stream_url': 2})
+   try:
+      futures = [client.submit('get_stream_url', 'submitted-{}'.format(n)) for n in range(8)]
+      threads = [threading.Thread(target=client.get_stream_url, args=('direct-{}'.format(n),))
+                 for n in range(8)]
+      for thread in threads:
+         thread.start()
+      for thread in threads:
+         thread.join()
+      for future in futures:
+         future.result(timeout=10)
+   finally:
+      client.shutdown()
+   assert server.peak_in_flight['get_stream_url'] == 2
+   assert client.stats()['direct_calls'] == 8
+
+def test_a_saturated_endpoint_does_not_hold_up_others(server):
+   server.latencies['get_stream_url'] = 0.3
+   client = _client(server, max_workers=4, endpoint_limits={'get_stream_url': 2})
+   try:
+      futures = [client.submit('get_stream_url', 'song-{}'.format(n)) for n in range(8)]
+      time.sleep(0.05)
+      start = time.monotonic()
+      client.submit('get_all_playlists').result(timeout=10)
+      elapsed = time.monotonic() - start
+      # Not started yet, so it can be cancelled
+      assert futures[-1].cancel()
+      for future in futures[:-1]:
+         future.result(timeout=10)
+   finally:
+      client.shutdown()
+   assert elapsed < 0.2
+
+class TimeoutOnceBackend(FakeBackend):
+   """Times out the nth request to an endpoint, once"""
+   def __init__(self, config, endpoint, nth):
+      super().__init__(config)
+      self.timeout_endpoint = endpoint
+      self.timeout_countdown = nth
+
+   def request(self, endpoint):
+      if endpoint == self.timeout_endpoint:
+         self.timeout_countdown -= 1
+         if self.timeout_countdown == 0:
+            raise_fault('timeout', endpoint)
+      super().request(endpoint)
+
+class CheckingMobileclient(FakeMobileclient):
+   """Makes a request of its own while logging in, as gmusicapi's does to
+   check the device id and subscription
+   """
+   def oauth_login(self, device_id, oauth_credentials=None, locale='en_US'):
+      super().oauth_login(device_id, oauth_credentials=oauth_credentials, locale=locale)
+      self._make_call('is_subscribed')
+      return True
+
+def test_reauthentication_while_paging():
+   backend = TimeoutOnceBackend(FakeConfig(songs=5000, playlists=0), 'get_all_songs', 3)
+   client = Client(mobileclient_factory=lambda session: CheckingMobileclient(backend),
+                   min_reauth_secs=0, metrics=MetricsRegistry())
+   client.authenticate()
+   songs = []
+   def sync():
+      for page in client.get_all_songs(incremental=True):
+         songs.extend(page)
+   thread = threading.Thread(target=sync, daemon=True)
+   try:
+      thread.start()
+      thread.join(timeout=10)
+      assert not thread.is_alive(), "Deadlocked reauthenticating mid-paging"
+   finally:
+      client.shutdown()
+   assert client.reauths == 1
+   assert len(songs) == 5000
@@ -0,0 +1,172 @@
+"""ArtworkCache, against album art served by a local HTTP server"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import time
+
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+QtCore = pytest.importorskip('PySide2.QtCore')
+QtGui = pytest.importorskip('PySide2.QtGui')
+pytest.importorskip('requests')
+
+from gpmp.artwork import ArtworkCache # pylint: disable-msg=wrong-import-position
+
+IMAGE_SIZE = 600
+THUMB_SIZE = 24
+
+def _png(color):
+   image = QtGui.QImage(IMAGE_SIZE, IMAGE_SIZE, QtGui.QImage.Format_RGB32)
+   image.fill(QtGui.QColor(color))
+   buf = QtCore.QBuffer()
+   buf.open(QtCore.QIODevice.WriteOnly)
+   image.save(buf, "PNG")
+   return bytes(buf.data())
+
+class ArtServer:
+   """Serves /art/<n>.png, after latency seconds. Other paths are 404s."""
+   def __init__(self, latency=0.0):
+      self.latency = latency
+      self.requests = 0
+      self._lock = threading.Lock()
+      self._png = _png('#3060c0')
+      server = self
+
+      class Handler(BaseHTTPRequestHandler):
+         def do_GET(self): # pylint: disable-msg=invalid-name
+            with server._lock: # pylint: disable-msg=protected-access
+               server.requests += 1
+            time.sleep(server.latency)
+            if not self.path.startswith('/art/'):
+               self.send_error(404)
+               return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(server._png))) # pylint: disable-msg=protected-access
+            self.end_headers()
+            self.wfile.write(server._png) # pylint: disable-msg=protected-access
+
+         def log_message(self, format, *args): # pylint: disable-msg=redefined-builtin
+            pass
+
+      self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+      self.httpd.daemon_threads = True
+      threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+   def url(self, n):
+      return 'http://127.0.0.1:{}/art/{}.png'.format(self.httpd.server_address[1], n)
+
+   def shutdown(self):
+      self.httpd.shutdown()
+      self.httpd.server_close()
+
+@pytest.fixture
+def art_server():
+   server = ArtServer()
+   yield server
+   server.shutdown()
+
+class Loaded:
+   """Records the (url, size) of each image loaded by a cache"""
+   def __init__(self, cache):
+      self.keys = []
+      self._cond = threading.Condition()
+      cache.loaded_callbacks.append(self._loaded)
+
+   def _loaded(self, url, size):
+      with self._cond:
+         self.keys.append((url, size))
+         self._cond.notify_all()
+
+   def wait_for(self, urls, timeout=10):
+      with self._cond:
+         assert self._cond.wait_for(
+            lambda: set(urls) <= {url for url, _ in self.keys}, timeout=timeout)
+
+def _cache(tmp_path, **kwargs):
+   return ArtworkCache(directory=str(tmp_path / 'art'), **kwargs)
+
+def test_loads_off_thread_then_hits_memory(tmp_path, art_server):
+   cache = _cache(tmp_path)
+   loaded = Loaded(cache)
+   url = art_server.url(1)
+   try:
+      assert cache.get(url, THUMB_SIZE) is None
+      loaded.wait_for([url])
+      image = cache.get(url, THUMB_SIZE)
+   finally:
+      cache.shutdown()
+   assert (image.width(), image.height()) == (THUMB_SIZE, THUMB_SIZE)
+   stats = cache.stats()
+   assert (stats['hits'], stats['misses'], stats['downloads']) == (1, 1, 1)
+   assert stats['hit_rate'] == 0.5
+
+def test_thumbnails_are_read_back_from_disk(tmp_path, art_server):
+   urls = [art_server.url(n) for n in range(5)]
+   for _ in range(2):
+      cache = _cache(tmp_path)
+      loaded = Loaded(cache)
+      try:
+         for url in urls:
+            cache.get(url, THUMB_SIZE)
+         loaded.wait_for(urls)
+      finally:
+         cache.shutdown()
+   stats = cache.stats()
+   assert stats['disk_hits'] == 5
+   assert stats['downloads'] == 0
+   assert art_server.requests == 5
+
+def test_memory_and_disk_stay_within_limits(tmp_path, art_server):
+   max_memory_bytes = 64 * 1024
+   max_disk_bytes = 2000
+   cache = _cache(tmp_path, max_memory_bytes=max_memory_bytes,
+                  max_disk_bytes=max_disk_bytes, max_pending=100)
+   loaded = Loaded(cache)
+   urls = [art_server.url(n) for n in range(100)]
+   try:
+      for url in urls:
+         cache.get(url, THUMB_SIZE)
+      loaded.wait_for(urls)
+   finally:
+      cache.shutdown()
+   stats = cache.stats()
+   print(stats)
+   assert stats['memory_bytes'] <= max_memory_bytes
+   assert stats['memory_evictions'] > 0
+   assert stats['disk_bytes'] <= max_disk_bytes
+   assert stats['disk_evictions'] > 0
+   on_disk = sum(entry.stat().st_size for entry in os.scandir(cache.directory))
+   assert on_disk == stats['disk_bytes']
+
+def test_scrolling_past_rows_cancels_their_requests(tmp_path, art_server):
+   art_server.latency = 0.03
+   cache = _cache(tmp_path, max_pending=8)
+   loaded = Loaded(cache)
+   urls = [art_server.url(n) for n in range(100)]
+   try:
+      for url in urls:
+         cache.get(url, THUMB_SIZE)
+      loaded.wait_for(urls[-8:])
+   finally:
+      cache.shutdown()
+   stats = cache.stats()
+   print(stats)
+   assert stats['cancelled'] == 100 - 8
+   assert stats['downloads'] < 20
+
+def test_failed_images_are_not_retried(tmp_path, art_server):
+   cache = _cache(tmp_path)
+   url = art_server.url(1).replace('/art/', '/missing/')
+   try:
+      cache.get(url, THUMB_SIZE)
+      deadline = time.monotonic() + 10
+      while cache.stats()['failures'] == 0 and time.monotonic() < deadline:
+         time.sleep(0.01)
+      assert cache.get(url, THUMB_SIZE) is None
+   finally:
+      cache.shutdown()
+   assert cache.stats()['failures'] == 1
+   assert art_server.requests == 1
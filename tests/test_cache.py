@@ -0,0 +1,99 @@
+"""The SQLite library cache, and syncing the library through it"""
+
+import time
+
+from gpmp.cache import LibraryCache
+from gpmp.fakeapi import FakeBackend, FakeConfig
+from gpmp.player import Library
+
+def _song(song_id, modified, **fields):
+   return dict({'id': song_id, 'title': 'Title ' + song_id, 'artist': 'Artist',
+                'lastModifiedTimestamp': str(modified), 'deleted': False}, **fields)
+
+def test_round_trip(tmp_path):
+   path = str(tmp_path / 'cache' / 'library.sqlite3')
+   cache = LibraryCache(path)
+   assert cache.load_songs() == []
+   assert cache.songs_last_modified() is None
+   songs = [_song('a', 10, albumArtRef=[{'url': 'http://art/a'}]), _song('b', 30),
+            _song('c', 20)]
+   cache.update_songs(songs)
+   cache.update_playlists([{'id': 'p', 'name': 'P', 'lastModifiedTimestamp': '5'}])
+   cache.close()
+
+   cache = LibraryCache(path)
+   assert sorted(cache.load_songs(), key=lambda song: song['id']) == songs
+   assert cache.load_song('a') == songs[0]
+   assert cache.load_song('z') is None
+   assert cache.songs_last_modified() == 30
+   assert cache.playlists_last_modified() == 5
+
+   cache.update_songs([_song('a', 40, title='New'), _song('b', 50, deleted=True)])
+   assert {song['id']: song['title'] for song in cache.load_songs()} == {'a': 'New',
+                                                                        'c': 'Title c'}
+   assert cache.songs_last_modified() == 40
+   cache.update_songs([_song('d', 1)], replace_all=True)
+   assert [song['id'] for song in cache.load_songs()] == ['d']
+   cache.clear()
+   assert cache.load_songs() == [] and cache.load_playlists() == []
+   cache.close()
+
+def test_schema_change_recreates_the_tables(tmp_path, monkeypatch):
+   path = str(tmp_path / 'library.sqlite3')
+   cache = LibraryCache(path)
+   cache.update_songs([_song('a', 1)])
+   cache.close()
+   monkeypatch.setattr(LibraryCache, 'SCHEMA_VERSION', LibraryCache.SCHEMA_VERSION + 1)
+   cache = LibraryCache(path)
+   assert cache.load_songs() == []
+   cache.close()
+
+class CountingClient:
+   """Passes calls through to a FakeMobileclient, recording the songs synced"""
+   def __init__(self, backend):
+      self.client = backend()
+      self.client.oauth_login(None)
+      self.synced = []
+      self.updated_after = []
+
+   def __getattr__(self, name):
+      return getattr(self.client, name)
+
+   def get_all_songs(self, **kwargs):
+      self.updated_after.append(kwargs.get('updated_after'))
+      for page in self.client.get_all_songs(**kwargs):
+         self.synced.extend(song['id'] for song in page)
+         yield page
+
+def test_incremental_sync(tmp_path):
+   path = str(tmp_path / 'library.sqlite3')
+   backend = FakeBackend(FakeConfig(songs=200, playlists=2, page_size=50))
+   api = CountingClient(backend)
+   library = Library(api, LibraryCache(path))
+   library.load_core()
+   assert library.load_timings['sync_kind'] == 'cold'
+   assert len(api.synced) == len(library.songs) == 200
+   library.cache.close()
+
+   synced = {song['id']: song['lastModifiedTimestamp'] for song in backend.songs}
+   time.sleep(0.01)
+   backend.touch_songs(3)
+   removed = backend.songs[-1]
+   removed['deleted'] = True
+   removed['lastModifiedTimestamp'] = str(int(removed['lastModifiedTimestamp']) + 10**6)
+   changed = {song['id'] for song in backend.songs
+              if song['lastModifiedTimestamp'] != synced[song['id']]}
+   assert len(changed) in (3, 4)
+
+   api = CountingClient(backend)
+   library = Library(api, LibraryCache(path))
+   assert library.load_cached()
+   assert len(library.songs) == 200
+   library.load_core()
+   assert library.load_timings['sync_kind'] == 'warm'
+   assert api.updated_after[-1] is not None
+   assert sorted(api.synced) == sorted(changed)
+   assert len(library.songs) == 199
+   assert removed['id'] not in library.songs
+   assert len(library.cache.load_songs()) == 199
+   library.cache.close()
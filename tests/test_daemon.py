@@ -0,0 +1,43 @@
+"""The player daemon, over its Unix socket"""
+
+import pytest
+
+from localplayer import local_player, stop_player
+
+from gpmp.daemon import PlayerDaemon
+from gpmp.rpc import INVALID_PARAMS, PlayerClient, RpcError
+
+TRACKS = 3
+
+@pytest.fixture(name='client')
+def client_fixture(tmp_path, fake_vlc): # pylint: disable-msg=unused-argument
+   player, _ = local_player(tmp_path, TRACKS, 60, gapless=False)
+   daemon = PlayerDaemon(player, player.library, path=str(tmp_path / 'daemon.sock'))
+   daemon.start()
+   try:
+      with PlayerClient(daemon.path, timeout=5) as client:
+         yield client
+   finally:
+      daemon.shutdown()
+      stop_player(player)
+
+def test_play_index(client):
+   client.call('play_index', 2)
+   assert client.call('status')['track_index'] == 2
+
+@pytest.mark.parametrize('index', [TRACKS, -1, '1', 1.0, True, None, [1]])
+def test_play_index_rejects_invalid_indices(client, index):
+   with pytest.raises(RpcError) as error:
+      client.call('play_index', index)
+   assert error.value.code == INVALID_PARAMS
+   assert client.call('status')['track_index'] is None
+
+def test_queue_edits_reject_invalid_positions(client):
+   for method, params in (('queue_move', [0, TRACKS]), ('queue_move', ['0', 1]),
+                          ('queue_remove', [TRACKS]), ('queue_remove', [0, 0])):
+      with pytest.raises(RpcError) as error:
+         client.call(method, *params)
+      assert error.value.code == INVALID_PARAMS
+   assert client.call('status')['queue_length'] == TRACKS
+   client.call('queue_move', 0, 2)
+   assert [song['id'] for song in client.call('queue')] == ['local-1', 'local-2', 'local-0']
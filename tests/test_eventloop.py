@@ -0,0 +1,41 @@
+"""The player's event handler thread"""
+
+import time
+
+import pytest
+
+from localplayer import local_player, stop_player
+
+from gpmp.player import EventLoopStats
+
+def test_stats_are_not_shared():
+   stats = EventLoopStats()
+   assert stats.end_reaction_times is not EventLoopStats().end_reaction_times
+   assert stats.end_reaction_times.maxlen == 100
+
+@pytest.mark.usefixtures('fake_vlc')
+def test_the_thread_only_wakes_for_events(tmp_path):
+   player, _ = local_player(tmp_path, 1, 60, gapless=False)
+   try:
+      player.play_next_track()
+      time.sleep(0.5)
+   finally:
+      stop_player(player)
+   stats = player.event_loop_stats
+   # Nothing to preroll or refresh after the only track, so no timeouts
+   assert stats.timeouts == 0
+   # Woken once per event, and once more by stop_player
+   assert stats.wakeups == stats.events + 1
+
+@pytest.mark.usefixtures('fake_vlc')
+def test_track_ends_are_handled(tmp_path):
+   player, _ = local_player(tmp_path, 2, 0.5, gapless=False)
+   try:
+      player.play_next_track()
+      deadline = time.monotonic() + 5
+      while player.current_track_index.value != 1 and time.monotonic() < deadline:
+         time.sleep(0.05)
+   finally:
+      stop_player(player)
+   assert player.current_track_index.value == 1
+   assert len(player.event_loop_stats.end_reaction_times) == 1
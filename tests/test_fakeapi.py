@@ -0,0 +1,82 @@
+"""The fake Mobileclient backend used for offline benchmarks"""
+
+import urllib.error
+import urllib.request
+import wave
+
+import pytest
+
+from gpmp.fakeapi import FakeBackend, FakeConfig
+from gpmp.simulation import api_errors
+
+def _client(config):
+   backend = FakeBackend(config)
+   client = backend()
+   client.oauth_login(None)
+   return backend, client
+
+def test_library_is_generated_from_the_seed():
+   config = FakeConfig(songs=100, playlists=5, playlist_size=10, seed=3)
+   def songs(backend):
+      # Modified when the library was generated
+      return [dict(song, lastModifiedTimestamp=None) for song in backend.songs]
+   assert songs(FakeBackend(config)) == songs(FakeBackend(config))
+   assert FakeBackend(config).entries == FakeBackend(config).entries
+   backend = FakeBackend(config)
+   assert len(backend.songs) == 100 and len(backend.playlists) == 5
+   assert all(len(entries) == 10 for entries in backend.entries.values())
+
+def test_songs_are_paged_one_request_per_page():
+   backend, client = _client(FakeConfig(songs=250, playlists=0, page_size=100))
+   requests = backend.requests
+   pages = list(client.get_all_songs(incremental=True))
+   assert [len(page) for page in pages] == [100, 100, 50]
+   assert backend.requests - requests == 3
+   assert len(client.get_all_songs()) == 250
+
+def test_calls_need_a_login():
+   backend = FakeBackend(FakeConfig(songs=10, playlists=0))
+   _, not_logged_in = api_errors()
+   with pytest.raises(not_logged_in):
+      backend().get_all_songs()
+
+def test_shared_playlists_include_store_tracks():
+   backend, client = _client(FakeConfig(songs=50, playlists=5, playlist_size=8,
+                                        shared_every=5))
+   shared = [p for p in backend.playlists if p['type'] == 'SHARED']
+   assert len(shared) == 1
+   entries = client.get_shared_playlist_contents(shared[0]['shareToken'])
+   assert sum('track' in entry for entry in entries) == 2
+   user_playlists = client.get_all_user_playlist_contents()
+   assert len(user_playlists) == 4
+   call_failure, _ = api_errors()
+   with pytest.raises(call_failure, match='404'):
+      client.get_shared_playlist_contents('missing')
+
+def test_failures_are_injected_for_matching_endpoints():
+   pytest.importorskip('requests')
+   backend, client = _client(FakeConfig(songs=10, playlists=0, failure_rate=1.0,
+                                        failure_re='get_stream_url', failure='error'))
+   assert len(client.get_all_songs()) == 10
+   call_failure, _ = api_errors()
+   with pytest.raises(call_failure):
+      client.get_stream_url(backend.songs[0]['id'])
+   assert backend.stats() == {'requests': 3, 'failures': 1}
+
+def test_stream_urls_serve_audio_until_they_expire():
+   backend, client = _client(FakeConfig(songs=2, playlists=0, track_secs=1,
+                                        stream_url_ttl=60))
+   try:
+      url = client.get_stream_url(backend.songs[0]['id'])
+      with urllib.request.urlopen(url, timeout=5) as response:
+         with wave.open(response) as wav:
+            assert wav.getnframes() / wav.getframerate() == 1.0
+      with pytest.raises(urllib.error.HTTPError) as error:
+         with urllib.request.urlopen(url.split('?')[0] + '?expire=1', timeout=5):
+            pass
+      assert error.value.code == 403
+      call_failure, _ = api_errors()
+      with pytest.raises(call_failure, match='404'):
+         client.get_stream_url('missing')
+   finally:
+      backend.shutdown()
@@ -0,0 +1,37 @@
+"""Switching between tracks, with and without prerolling the next track"""
+
+from collections import Counter
+import time
+
+import pytest
+
+from localplayer import local_player, stop_player
+
+TRACKS = 3
+TRACK_SECS = 1.5
+
+def _play_through(tmp_path, gapless):
+   """Plays TRACKS local files to the end. Returns how many tracks were
+   played from each source.
+   """
+   player, _ = local_player(tmp_path, TRACKS, TRACK_SECS, gapless=gapless,
+                            preroll_secs=1.0)
+   try:
+      player.play_next_track()
+      deadline = time.monotonic() + TRACKS * TRACK_SECS + 5
+      while len(player.track_gaps) < TRACKS - 1 and time.monotonic() < deadline:
+         time.sleep(0.05)
+   finally:
+      stop_player(player)
+   assert len(player.track_gaps) == TRACKS - 1
+   return Counter({source: len(times) for source, times in player.track_switch_times.items()
+                   if times})
+
+@pytest.mark.usefixtures('fake_vlc')
+def test_tracks_are_opened_when_they_start_without_preroll(tmp_path):
+   assert _play_through(tmp_path, gapless=False) == {'fetched': TRACKS}
+
+@pytest.mark.usefixtures('fake_vlc')
+def test_prerolled_tracks_start_without_opening(tmp_path):
+   # Only the first track is opened when it starts
+   assert _play_through(tmp_path, gapless=True) == {'fetched': 1, 'preroll': TRACKS - 1}
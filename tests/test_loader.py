@@ -0,0 +1,102 @@
+"""Prioritized, deduplicated and cancellable loading jobs"""
+
+import threading
+
+import pytest
+
+from gpmp.loader import (PRIORITY_BACKGROUND, PRIORITY_USER, JobCancelled,
+                         LoaderService)
+
+@pytest.fixture(name='loader')
+def loader_fixture():
+   loader = LoaderService(max_workers=1)
+   yield loader
+   loader.shutdown()
+
+def _block(loader):
+   """Occupies loader's only worker until the returned event is set"""
+   release = threading.Event()
+   started = threading.Event()
+   def func(_):
+      started.set()
+      release.wait(5)
+   loader.submit('block', func, priority=PRIORITY_USER)
+   assert started.wait(5)
+   return release
+
+def test_jobs_run_by_priority_then_in_order(loader):
+   release = _block(loader)
+   order = []
+   jobs = [loader.submit(name, lambda _, name=name: order.append(name), priority=priority)
+           for name, priority in (('bg1', PRIORITY_BACKGROUND), ('user1', PRIORITY_USER),
+                                  ('bg2', PRIORITY_BACKGROUND), ('user2', PRIORITY_USER))]
+   assert loader.queue_depth() == 4
+   release.set()
+   loader.wait(jobs)
+   assert order == ['user1', 'user2', 'bg1', 'bg2']
+   assert loader.stats()['completed'] == 5
+
+def test_jobs_with_the_same_key_are_shared(loader):
+   release = _block(loader)
+   calls = []
+   first = loader.submit('a', lambda _: calls.append('a') or 'a', key='k')
+   other = loader.submit('b', lambda _: calls.append('b'))
+   second = loader.submit('a again', lambda _: calls.append('again'), key='k',
+                          priority=PRIORITY_USER)
+   assert second is first
+   assert loader.queue_depth() == 2
+   release.set()
+   assert first.result(5) == 'a'
+   loader.wait([other])
+   # The shared job's priority was raised ahead of the other job
+   assert calls == ['a', 'b']
+   # Once done, the key can be submitted again
+   assert loader.submit('a', lambda _: 'new', key='k').result(5) == 'new'
+
+def test_queued_jobs_can_be_cancelled(loader):
+   release = _block(loader)
+   ran = []
+   job = loader.submit('a', lambda _: ran.append('a'))
+   job.cancel()
+   assert loader.queue_depth() == 0
+   release.set()
+   loader.wait([job, loader.submit('b', lambda _: ran.append('b'))])
+   assert ran == ['b']
+   assert isinstance(job.error(), JobCancelled)
+   assert loader.stats()['cancelled'] == 1
+
+def test_running_jobs_are_cancelled_through_their_token(loader):
+   started = threading.Event()
+   def func(job):
+      started.set()
+      while True:
+         job.token.raise_if_cancelled()
+         job.report_progress(items=1)
+   job = loader.submit('a', func)
+   assert started.wait(5)
+   job.cancel()
+   loader.wait([job])
+   assert isinstance(job.error(), JobCancelled)
+   assert job.items_done > 0
+   stats = loader.stats()
+   assert (stats['cancelled'], stats['completed'], stats['failed']) == (1, 0, 0)
+
+def test_a_job_is_only_cancelled_once_every_submission_is_released(loader):
+   release = _block(loader)
+   first = loader.submit('a', lambda _: 'a', key='k')
+   second = loader.submit('a', lambda _: 'a', key='k')
+   first.release()
+   assert not first.token.cancelled
+   second.release()
+   assert first.token.cancelled
+   release.set()
+   loader.wait([first])
+   assert isinstance(first.error(), JobCancelled)
+
+def test_failed_jobs_are_counted(loader):
+   def fail(_):
+      raise ValueError('failed')
+   job = loader.submit('a', fail)
+   loader.wait([job])
+   assert isinstance(job.error(), ValueError)
+   assert loader.stats()['failed'] == 1
@@ -0,0 +1,83 @@
+"""The play queue, checked against a list receiving the same edits"""
+
+import random
+
+import pytest
+
+from gpmp.playqueue import PlayQueue, QueueChange, INSERT, MOVE, REMOVE
+
+@pytest.mark.parametrize('seed', range(20))
+def test_edits_match_a_list(seed):
+   rng = random.Random(seed)
+   expected = list(range(rng.randrange(0, 50)))
+   queue = PlayQueue(range(len(expected)))
+   changes = []
+   queue.change_callbacks.append(changes.append)
+   next_id = len(expected)
+   for _ in range(300):
+      op = rng.choice((INSERT, REMOVE, MOVE) if expected else (INSERT,))
+      if op == INSERT:
+         index = rng.randrange(len(expected) + 1)
+         count = rng.randrange(1, 5)
+         track_ids = range(next_id, next_id + count)
+         next_id += count
+         queue.insert(index, track_ids)
+         expected[index:index] = track_ids
+      elif op == REMOVE:
+         index = rng.randrange(len(expected))
+         count = rng.randrange(1, 5)
+         queue.remove(index, count)
+         del expected[index:index + count]
+      else:
+         index = rng.randrange(len(expected))
+         dest = rng.randrange(len(expected))
+         queue.move(index, dest)
+         expected.insert(dest, expected.pop(index))
+      assert len(queue) == len(expected)
+      assert list(queue) == expected
+      assert [queue[i] for i in range(-len(expected), len(expected))] == expected * 2
+   assert queue[5:40:3] == expected[5:40:3]
+   assert all(isinstance(change, QueueChange) for change in changes)
+
+@pytest.mark.parametrize('seed', range(20))
+def test_changes_adjust_positions(seed):
+   rng = random.Random(seed)
+   queue = PlayQueue(range(30))
+   changes = []
+   queue.change_callbacks.append(changes.append)
+   for step in range(100):
+      before = list(queue)
+      changes.clear()
+      op = rng.choice((INSERT, REMOVE, MOVE))
+      if op == INSERT:
+         queue.insert(rng.randrange(len(queue) + 1), (-1 - step,))
+      elif op == REMOVE and len(queue) > 1:
+         queue.remove(rng.randrange(len(queue)), rng.randrange(1, 3))
+      else:
+         queue.move(rng.randrange(len(queue)), rng.randrange(len(queue)))
+      for change in changes:
+         for i, song_id in enumerate(before):
+            j = change.adjust(i)
+            if j is None:
+               assert song_id not in queue
+            else:
+               assert queue[j] == song_id
+
+def test_base_is_the_unedited_sequence():
+   track_ids = list(range(10))
+   queue = PlayQueue(track_ids)
+   assert queue.base() is track_ids
+   queue.move(0, 9)
+   assert queue.base() is None
+   queue.reset(track_ids)
+   assert queue.base() is track_ids
+
+def test_out_of_range_edits_raise():
+   queue = PlayQueue(range(3))
+   with pytest.raises(IndexError):
+      queue.remove(3)
+   with pytest.raises(IndexError):
+      queue.move(0, 3)
+   with pytest.raises(IndexError):
+      _ = queue[3]
+   assert list(queue) == [0, 1, 2]
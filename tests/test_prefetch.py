@@ -0,0 +1,53 @@
+"""Prefetching of stream urls for the upcoming tracks"""
+
+import time
+
+import pytest
+
+from localplayer import local_player, stop_player
+
+from gpmp import player as gpmp_player
+from gpmp import prefetch
+
+TRACKS = 2
+TRACK_SECS = 3.5
+
+@pytest.mark.usefixtures('fake_vlc')
+def test_urls_are_refreshed_for_tracks_longer_than_they_last(tmp_path, monkeypatch):
+   # Local paths have no expiry in them, so last DEFAULT_URL_TTL
+   monkeypatch.setattr(prefetch, 'DEFAULT_URL_TTL', 2.0)
+   monkeypatch.setattr(gpmp_player, 'URL_REFRESH_SECS', 1.0)
+   player, _ = local_player(tmp_path, TRACKS, TRACK_SECS, gapless=False, prefetch_depth=1)
+   try:
+      player.play_next_track()
+      deadline = time.monotonic() + TRACKS * TRACK_SECS + 5
+      while len(player.track_gaps) < TRACKS - 1 and time.monotonic() < deadline:
+         time.sleep(0.05)
+   finally:
+      stop_player(player)
+   switches = {source: len(times) for source, times in player.track_switch_times.items()}
+   # Only the first track is fetched when it starts
+   assert switches['fetched'] == 1
+   assert switches['prefetched'] == TRACKS - 1
+
+def test_prefetch_refetches_urls_about_to_expire(monkeypatch):
+   monkeypatch.setattr(prefetch, 'DEFAULT_URL_TTL', 5.0)
+   class Api:
+      # pylint: disable-msg=too-few-public-methods
+      calls = 0
+      def get_stream_url(self, song_id):
+         Api.calls += 1
+         return '/{}/{}'.format(song_id, Api.calls)
+   prefetcher = prefetch.StreamUrlPrefetcher(Api())
+   try:
+      prefetcher.prefetch(['a'])
+      assert prefetcher.get('a') == ('/a/1', True)
+      prefetcher.prefetch(['a'])
+      assert Api.calls == 1
+      prefetcher.prefetch(['a'], valid_for=10.0)
+      deadline = time.monotonic() + 5
+      while prefetcher.get('a')[0] != '/a/2' and time.monotonic() < deadline:
+         time.sleep(0.01)
+      assert prefetcher.get('a') == ('/a/2', True)
+   finally:
+      prefetcher.shutdown()
@@ -0,0 +1,66 @@
+"""Retries and circuit breakers of API calls"""
+
+import pytest
+
+pytest.importorskip('requests')
+
+# pylint: disable-msg=wrong-import-position
+from gpmp.api import Client
+from gpmp.fakeapi import FakeBackend, FakeConfig
+from gpmp.metrics import MetricsRegistry
+from gpmp.resilience import CallPolicy, CircuitOpenError
+
+THRESHOLD = 5
+
+def _client(**config):
+   """A Client of a fake backend, which doesn't wait between retries"""
+   backend = FakeBackend(FakeConfig(songs=10, playlists=0, **config))
+   client = Client(mobileclient_factory=backend, metrics=MetricsRegistry(),
+                   shared_endpoints={},
+                   policies={'get_stream_url': CallPolicy(base_delay=0, breaker_threshold=THRESHOLD)})
+   client.resilience.sleep = lambda secs: None
+   client.authenticate()
+   return client, backend
+
+def _fail_calls(client, song_id, count):
+   for _ in range(count):
+      with pytest.raises(Exception) as info:
+         client.get_stream_url(song_id)
+      assert not isinstance(info.value, CircuitOpenError)
+
+def test_simulated_errors_open_the_breaker():
+   # As set by --error-sim-enable --error-sim-attr-re get_stream_url
+   client, _ = _client()
+   client.set_simulated_error_function_re('get_stream_url')
+   client.simulate_immediate_error = True
+   try:
+      _fail_calls(client, 'fake-00000001', THRESHOLD)
+      with pytest.raises(CircuitOpenError):
+         client.get_stream_url('fake-00000001')
+   finally:
+      client.shutdown()
+   stats = client.stats()['endpoints']['get_stream_url']
+   assert stats['breaker'] == 'open'
+   assert stats['breaker_trips'] == 1
+
+def test_server_errors_open_the_breaker():
+   client, backend = _client(failure_rate=1.0, failure_re='get_stream_url', failure='error')
+   try:
+      _fail_calls(client, 'fake-00000001', THRESHOLD)
+      with pytest.raises(CircuitOpenError):
+         client.get_stream_url('fake-00000001')
+   finally:
+      client.shutdown()
+   # Server errors aren't retried
+   assert backend.stats()['failures'] == THRESHOLD
+
+def test_unavailable_tracks_do_not_open_the_breaker():
+   client, backend = _client()
+   try:
+      _fail_calls(client, 'missing', THRESHOLD * 2)
+      assert client.get_stream_url('fake-00000001')
+   finally:
+      client.shutdown()
+   assert client.stats()['endpoints']['get_stream_url']['breaker'] == 'closed'
+   # Nor are they retried
+   assert backend.stats()['requests'] == 1 + THRESHOLD * 2 + 1
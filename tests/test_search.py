@@ -0,0 +1,73 @@
+"""Searching the library's songs"""
+
+import pytest
+
+from gpmp.search import SearchIndex
+from gpmp.songtable import SongTable
+
+SONGS = [
+   ('s1', 'Yesterday', 'The Beatles', 'Help!'),
+   ('s2', 'Yellow Submarine', 'The Beatles', 'Revolver'),
+   ('s3', 'Yellow', 'Coldplay', 'Parachutes'),
+   ('s4', 'Paranoid Android', 'Radiohead', 'OK Computer'),
+   ('s5', 'Karma Police', 'Radiohead', 'OK Computer'),
+   ('s6', 'Café del Mar', 'Energy 52', None),
+   ('s7', 'Yellowknife Blues', 'Various', None),
+]
+
+@pytest.fixture(name='index')
+def index_fixture():
+   songs = SongTable()
+   for song_id, title, artist, album in SONGS:
+      songs.add(song_id, title, artist, album)
+   return SearchIndex(songs)
+
+def test_exact_matches_rank_before_prefix_matches(index):
+   assert index.search('yellow')[2:] == ['s7']
+   assert set(index.search('yel')) == {'s2', 's3', 's7'}
+   assert set(index.search('ye')) == {'s1', 's2', 's3', 's7'}
+
+def test_every_term_must_match(index):
+   assert index.search('radiohead karma') == ['s5']
+   assert index.search('beatles yell') == ['s2']
+   assert index.search('beatles karma') == []
+
+def test_titles_rank_before_albums(index):
+   # 'para' starts a title of s4 and the album of s3
+   assert index.search('para') == ['s4', 's3']
+
+def test_substrings_match(index):
+   assert index.search('roid') == ['s4']
+
+def test_typos_match(index):
+   assert index.search('karmma') == ['s5']
+   assert index.search('krma') == ['s5']
+   assert index.search('qqrma') == []
+   assert set(index.search('radiohaed')) == {'s4', 's5'}
+   assert index.search('submarnie') == ['s2']
+
+def test_accents_are_ignored(index):
+   assert index.search('cafe') == ['s6']
+   assert index.search('CAFÉ') == ['s6']
+
+def test_removed_songs_are_not_found(index):
+   songs = index.songs
+   assert index.search('police') == ['s5']
+   index.update_row(songs.row_of('s5'), lambda: songs.remove('s5'))
+   assert index.search('police') == []
+   assert index.search('radiohead') == ['s4']
+
+def test_removed_songs_not_yet_reindexed_are_not_found(index):
+   assert index.search('yesterday') == ['s1']
+   index.songs.remove('s1')
+   assert index.search('yesterday') == []
+
+def test_changed_and_added_songs_are_found(index):
+   songs = index.songs
+   index.update()
+   index.update_row(songs.row_of('s3'),
+                    lambda: songs.add('s3', 'Clocks', 'Coldplay', 'A Rush of Blood'))
+   assert index.search('yellow') == ['s2', 's7']
+   assert index.search('clocks') == ['s3']
+   songs.add('s8', 'Fix You', 'Coldplay', 'X&Y')
+   assert set(index.search('coldplay')) == {'s3', 's8'}
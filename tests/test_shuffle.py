@@ -0,0 +1,54 @@
+"""Lazy shuffling: the permutation, and the artist spread and recent track constraints"""
+
+import pytest
+
+from gpmp.shuffle import FeistelPermutation, RecentlyPlayed, ShuffledTracks
+
+@pytest.mark.parametrize('n', [0, 1, 2, 3, 5, 16, 17, 100, 1000, 4097])
+def test_permutation_is_a_bijection(n):
+   perm = FeistelPermutation(n, seed=1)
+   assert sorted(perm[i] for i in range(n)) == list(range(n))
+   with pytest.raises(IndexError):
+      _ = perm[n]
+
+def test_permutation_is_reproducible_from_its_seed():
+   first = [FeistelPermutation(1000, seed=42)[i] for i in range(1000)]
+   assert [FeistelPermutation(1000, seed=42)[i] for i in range(1000)] == first
+   assert [FeistelPermutation(1000, seed=43)[i] for i in range(1000)] != first
+   assert first != list(range(1000))
+
+def test_shuffle_skips_removed_tracks():
+   track_ids = ['t{}'.format(i) if i % 3 else None for i in range(300)]
+   shuffled = ShuffledTracks(track_ids, seed=1)
+   assert sorted(shuffled) == sorted(song_id for song_id in track_ids if song_id)
+   assert list(ShuffledTracks(track_ids, seed=1)) == list(shuffled)
+
+def test_shuffle_spreads_artists():
+   artists = 20
+   track_ids = list(range(1000))
+   spread = 5
+   shuffled = ShuffledTracks(track_ids, seed=3, artist_of=lambda i: i % artists,
+                             artist_spread=spread)
+   order = list(shuffled)
+   assert sorted(order) == track_ids
+   assert order != list(ShuffledTracks(track_ids, seed=3))
+   # Best effort, so a few may be let through at the ends of the blocks
+   close = sum(1 for i in range(1, len(order))
+               if order[i] % artists in {j % artists for j in order[max(i - spread, 0):i]})
+   assert close <= len(order) // 100
+
+def test_shuffle_holds_back_recent_tracks():
+   track_ids = list(range(1000))
+   recent = RecentlyPlayed(maxlen=20)
+   for song_id in range(0, 100, 2):
+      recent.add(song_id)
+   assert len(recent) == 20
+   assert 58 not in recent and 60 in recent
+   plain = list(ShuffledTracks(track_ids, seed=5))
+   shuffled = list(ShuffledTracks(track_ids, seed=5, recent=recent))
+   assert sorted(shuffled) == track_ids
+   # Each block plays its recent tracks last, in their shuffled order
+   for start in range(0, len(track_ids), 256):
+      block = shuffled[start:start + 256]
+      held = [song_id for song_id in plain[start:start + 256] if song_id in recent]
+      assert block[len(block) - len(held):] == held
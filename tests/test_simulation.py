@@ -0,0 +1,73 @@
+"""Latency distributions and fault timelines for the simulated server"""
+
+import random
+
+import pytest
+
+from gpmp.simulation import (FaultTimeline, FixedLatency, LognormalLatency, UniformLatency,
+                             parse_endpoint_latency, parse_latency)
+
+class Clock:
+   # pylint: disable-msg=too-few-public-methods
+   def __init__(self):
+      self.now = 100.0
+
+   def __call__(self):
+      return self.now
+
+def test_latency_specs_are_parsed_in_milliseconds():
+   assert isinstance(parse_latency('fixed:200'), FixedLatency)
+   assert parse_latency('fixed:200').sample(random.Random()) == 0.2
+   uniform = parse_latency('uniform:50,400')
+   assert isinstance(uniform, UniformLatency)
+   assert (uniform.low, uniform.high) == (0.05, 0.4)
+   assert repr(parse_latency('lognormal:120,2000')) == 'lognormal:120,2000'
+   pattern, latency = parse_endpoint_latency('get_stream_url=fixed:10')
+   assert pattern.search('get_stream_url') and latency.secs == 0.01
+   assert parse_endpoint_latency('fixed:10')[0].search('anything')
+
+@pytest.mark.parametrize('spec', ['gaussian:10', 'fixed', 'fixed:1,2', 'uniform:1',
+                                  'uniform:a,b', 'lognormal:200,100', 'lognormal:0,10'])
+def test_invalid_latency_specs_are_rejected(spec):
+   with pytest.raises(ValueError):
+      parse_latency(spec)
+
+def test_lognormal_latency_has_the_given_percentiles():
+   rng = random.Random(0)
+   latency = LognormalLatency(0.12, 2.0)
+   samples = sorted(latency.sample(rng) for _ in range(20000))
+   assert samples[10000] == pytest.approx(0.12, rel=0.05)
+   assert samples[19800] == pytest.approx(2.0, rel=0.15)
+
+def test_fault_timeline():
+   timeline = FaultTimeline.parse("""
+      # start end endpoint fault
+      10 20 get_stream_url timeout
+      15 30 . lognormal:500,4000
+      repeat 60
+   """)
+   clock = Clock()
+   timeline.clock = clock
+   assert timeline.events_for('get_stream_url') == []
+   timeline.start()
+   assert timeline.running
+   def faults(endpoint):
+      return [event.fault or repr(event.latency) for event in timeline.events_for(endpoint)]
+   clock.now += 12
+   assert faults('get_stream_url') == ['timeout']
+   assert faults('get_all_songs') == []
+   clock.now += 5
+   assert faults('get_stream_url') == ['timeout', 'lognormal:500,4000']
+   clock.now += 15
+   assert faults('get_all_songs') == []
+   # Repeated every 60s
+   clock.now += 40
+   assert faults('get_stream_url') == ['timeout']
+   timeline.stop()
+   assert faults('get_stream_url') == []
+
+@pytest.mark.parametrize('text', ['10 20 . timeout extra', '10 20 ( timeout', '10 x . timeout',
+                                  '10 20 . slow', 'repeat'])
+def test_invalid_fault_timelines_are_rejected(text):
+   with pytest.raises(ValueError, match='line 1'):
+      FaultTimeline.parse(text)
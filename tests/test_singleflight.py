@@ -0,0 +1,96 @@
+"""Sharing of identical calls in flight, and remembering their results"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+
+import pytest
+
+from gpmp.singleflight import SingleFlight
+
+class Clock:
+   # pylint: disable-msg=too-few-public-methods
+   def __init__(self):
+      self.now = 0.0
+
+   def __call__(self):
+      return self.now
+
+def test_identical_calls_in_flight_are_shared():
+   flight = SingleFlight({'get': 0})
+   release = threading.Event()
+   calls = []
+   def func():
+      calls.append(1)
+      release.wait(5)
+      return ['result']
+   with ThreadPoolExecutor(8) as pool:
+      futures = [pool.submit(flight.call, 'get', ('a',), {}, func) for _ in range(8)]
+      # Every call has either started func or joined the one which has
+      while flight.calls < 8:
+         release.wait(0.01)
+      release.set()
+      results = [future.result() for future in futures]
+   assert len(calls) == 1
+   assert all(result is results[0] for result in results)
+   stats = flight.stats()
+   assert (stats['executed'], stats['joined'], stats['memo_hits']) == (1, 7, 0)
+
+def test_different_or_unshared_calls_are_not_shared():
+   flight = SingleFlight({'get': 10})
+   assert flight.call('get', ('a',), {}, lambda: 1) == 1
+   assert flight.call('get', ('b',), {}, lambda: 2) == 2
+   assert flight.call('get', ('a',), {'x': 1}, lambda: 3) == 3
+   # Unhashable arguments, and endpoints without a ttl, are not shared
+   assert flight.call('get', (['a'],), {}, lambda: 4) == 4
+   assert flight.call('other', ('a',), {}, lambda: 5) == 5
+   assert flight.call('other', ('a',), {}, lambda: 6) == 6
+   assert flight.stats()['executed'] == 3
+
+def test_errors_are_shared_but_not_remembered():
+   flight = SingleFlight({'get': 10})
+   def fail():
+      raise ValueError('failed')
+   with pytest.raises(ValueError):
+      flight.call('get', ('a',), {}, fail)
+   assert flight.call('get', ('a',), {}, lambda: 'ok') == 'ok'
+
+def test_results_are_remembered_for_the_ttl():
+   clock = Clock()
+   flight = SingleFlight({'get': 10}, clock=clock)
+   assert flight.call('get', ('a',), {}, lambda: 1) == 1
+   clock.now = 9.9
+   assert flight.call('get', ('a',), {}, lambda: 2) == 1
+   clock.now = 10.0
+   assert flight.call('get', ('a',), {}, lambda: 3) == 3
+   flight.clear()
+   assert flight.call('get', ('a',), {}, lambda: 4) == 4
+
+def test_none_results_are_remembered():
+   clock = Clock()
+   flight = SingleFlight({'get': 10}, clock=clock)
+   calls = []
+   assert flight.call('get', ('a',), {}, lambda: calls.append(1)) is None
+   assert flight.call('get', ('a',), {}, lambda: calls.append(2)) is None
+   assert calls == [1]
+   future = flight.submit('get', ('a',), {}, lambda: pytest.fail('submitted'))
+   assert future.result(0) is None
+   stats = flight.stats()
+   assert (stats['executed'], stats['memo_hits']) == (1, 2)
+
+def test_submitted_calls_are_shared():
+   flight = SingleFlight({'get': 0})
+   submitted = []
+   def submit():
+      submitted.append(Future())
+      return submitted[-1]
+   first = flight.submit('get', ('a',), {}, submit)
+   second = flight.submit('get', ('a',), {}, submit)
+   assert len(submitted) == 1
+   first.set_result('result')
+   assert second.result(1) == 'result'
+   flight.submit('get', ('a',), {}, submit)
+   assert len(submitted) == 2
+   # Cancelling the submitted call cancels it for the calls sharing it
+   third = flight.submit('get', ('a',), {}, submit)
+   submitted[-1].cancel()
+   assert third.cancelled()
@@ -0,0 +1,92 @@
+"""SongTable, and its memory use compared to the dict per song it replaced"""
+
+import gc
+import json
+import tracemalloc
+
+import pytest
+
+from gpmp.fakeapi import FakeBackend, FakeConfig
+from gpmp.songtable import SongTable
+
+def _raw_song_json(count):
+   """Synthetic raw songs, as the JSON of each song sent by the server"""
+   songs = FakeBackend(FakeConfig(songs=count, playlists=0)).songs
+   return [json.dumps(song) for song in songs]
+
+def _raw_songs(count):
+   return [json.loads(text) for text in _raw_song_json(count)]
+
+def _dict_layout(raw_songs):
+   """The old Library.songs: a dict per song, holding its raw dict"""
+   return {song['id']: {'artist': song['artist'], 'title': song['title'], 'song': song}
+           for song in raw_songs}
+
+def _table_layout(raw_songs):
+   songs = SongTable()
+   for song in raw_songs:
+      songs.add_song(song)
+   return songs
+
+def _retained_bytes(make_songs, song_json):
+   """Bytes still allocated after make_songs builds a library from the
+   parsed raw songs
+   """
+   gc.collect()
+   tracemalloc.start()
+   try:
+      raw_songs = [json.loads(text) for text in song_json]
+      songs = make_songs(raw_songs)
+      del raw_songs
+      gc.collect()
+      current, _ = tracemalloc.get_traced_memory()
+   finally:
+      tracemalloc.stop()
+   assert len(songs) == len(song_json)
+   return current
+
+@pytest.mark.parametrize('count', [10000, pytest.param(100000, marks=pytest.mark.slow)])
+def test_table_uses_a_fraction_of_the_memory_of_dicts(count):
+   song_json = _raw_song_json(count)
+   dict_bytes = _retained_bytes(_dict_layout, song_json)
+   table_bytes = _retained_bytes(_table_layout, song_json)
+   assert table_bytes < dict_bytes / 5
+
+def test_get_returns_a_view_with_the_raw_song_loaded_on_demand():
+   raw = {song['id']: song for song in _raw_songs(10)}
+   songs = SongTable(raw_loader=raw.get)
+   for song in raw.values():
+      songs.add_song(song)
+
+   song_id = 'fake-00000003'
+   info = songs.get(song_id)
+   assert info['title'] == 'Track 3'
+   assert info['artist'] == raw[song_id]['artist']
+   assert info['song'] is raw[song_id]
+   assert songs.get('missing') is None
+   assert song_id in songs and len(songs) == 10
+
+def test_removed_songs_keep_the_other_rows():
+   songs = _table_layout(_raw_songs(3))
+   row = songs.row_of('fake-00000002')
+   songs.remove('fake-00000001')
+   assert 'fake-00000001' not in songs
+   assert songs.row_of('fake-00000002') == row
+   assert songs.ids[1] is None
+   assert songs.keys() == ['fake-00000000', 'fake-00000002']
+
+def test_ids_are_appended_after_the_other_columns():
+   """SearchIndex.update() reads len(ids) without the table's lock, and then
+   the other columns of the rows below it
+   """
+   songs = SongTable()
+   rows_seen = []
+   class Column(list):
+      def append(self, value): # pylint: disable-msg=arguments-renamed
+         rows_seen.append(len(songs.ids))
+         super().append(value)
+   songs.titles, songs.artists, songs.albums, songs.art_urls = (
+      Column(), Column(), Column(), Column())
+   for song in _raw_songs(3):
+      songs.add_song(song)
+   assert rows_seen == [0] * 4 + [1] * 4 + [2] * 4
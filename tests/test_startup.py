@@ -0,0 +1,28 @@
+"""Startup import time budgets. The imports are timed in a fresh
+interpreter, so the budgets are about twice the times measured on a
+developer machine, to leave room for slower ones.
+"""
+
+import pytest
+
+from gpmp.importtime import (CLI_STARTUP_MODULES, DEFERRED_MODULES, GUI_MODULES,
+                             GUI_STARTUP_MODULES, format_report, measure_imports)
+
+CLI_BUDGET_MS = 200
+GUI_BUDGET_MS = 800
+
+def test_cli_startup_is_within_budget():
+   pytest.importorskip('setproctitle')
+   report = measure_imports(CLI_STARTUP_MODULES,
+                            forbidden=DEFERRED_MODULES + GUI_MODULES)
+   print(format_report(report))
+   assert report.imported_early == []
+   assert report.startup_ms <= CLI_BUDGET_MS
+
+def test_gui_startup_is_within_budget():
+   pytest.importorskip('setproctitle')
+   pytest.importorskip('PySide2')
+   report = measure_imports(GUI_STARTUP_MODULES)
+   print(format_report(report))
+   assert report.imported_early == []
+   assert report.startup_ms <= GUI_BUDGET_MS
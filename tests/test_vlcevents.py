@@ -0,0 +1,47 @@
+"""VLC event subscriptions over a long session"""
+
+import pytest
+
+from localplayer import local_player, stop_player
+
+TRACK_CHANGES = 3000
+BATCH = 500
+
+@pytest.mark.slow
+def test_callbacks_per_track_stay_flat(tmp_path, fake_vlc, monkeypatch):
+   monkeypatch.setattr(fake_vlc, 'OPEN_SECS', 0)
+   player, _ = local_player(tmp_path, TRACK_CHANGES, 60, files=2, gapless=False)
+   counts = player.event_dispatcher.counts
+   attached = []
+   # Callbacks fired by each batch of track changes
+   fired = []
+   try:
+      for _ in range(TRACK_CHANGES // BATCH):
+         before = sum(counts.values())
+         for _ in range(BATCH):
+            assert player.play_next_track()
+         fired.append(sum(counts.values()) - before)
+         attached.append(player.player.event_manager().attached)
+   finally:
+      stop_player(player)
+
+   # Each handled event type is subscribed once, however often the player is reused
+   assert attached == [len(player.event_dispatcher.handlers)] * len(attached)
+   # Each track change stops the previous track and plays the next, firing
+   # two callbacks. The first had no previous track, and stop_player stops
+   # the last.
+   assert fired[1:] == [2 * BATCH] * (len(fired) - 1)
+   assert counts == {'MediaPlayerPlaying': TRACK_CHANGES,
+                     'MediaPlayerStopped': TRACK_CHANGES}
+
+def test_handler_errors_are_counted_and_not_raised(fake_vlc):
+   from gpmp.vlcevents import EventDispatcher # pylint: disable-msg=import-outside-toplevel
+   def fail(_event, _player):
+      raise RuntimeError("handler failed")
+   dispatcher = EventDispatcher({'MediaPlayerPlaying': fail})
+   player = fake_vlc.MediaPlayer()
+   dispatcher.attach(player)
+   dispatcher.attach(player)
+   assert player.event_manager().attached == 1
+   player.event_manager().send(fake_vlc.EventType.MediaPlayerPlaying)
+   assert dispatcher.counts == {'MediaPlayerPlaying': 1}